@@ -15,9 +15,20 @@
 # First program by AdamAmott
 # A fork of the Mycroft Spotify skill
 
-import time
+import threading
 from os.path import abspath, dirname, join
 from .song_database_manager import SongDatabase
+from .library_watcher import LibraryWatcher
+from .mount_watcher import MountWatcher
+from .cover_art import CoverArtCache
+from .now_playing import NowPlaying, STATUS_TIMEOUT
+from .queue_feeder import QueueFeeder
+from .playback_start import PlaybackStarter
+from .prefetch import Prefetcher, PREFETCH_AHEAD
+from .metrics import tracer
+from .regex_bank import RegexBank
+from .scan_throttle import (lower_priority, AUDIO_PAUSE_MARGIN,
+                            AUDIO_PAUSE_TIMEOUT, LISTENER_PAUSE_TIMEOUT)
 
 import re
 from mycroft.skills.core import intent_handler
@@ -53,6 +64,9 @@ DIRECT_RESPONSE_CONFIDENCE = 0.8
 
 MATCH_CONFIDENCE = 0.5
 
+# Seconds between two offline-playback.metrics messages
+METRICS_INTERVAL = 60
+
 
 def best_result(results):
     """Return best result from a list of result tuples.
@@ -84,6 +98,10 @@ def best_confidence(title, query):
     return max(fuzzy_match(best, query),
                fuzzy_match(best_stripped, query))
 
+def rate(count, seconds):
+    """Returns: count per second, rounded for a report"""
+    return round(count / seconds, 1) if seconds > 0 else 0.0
+
 def status_info():
     """Return track, artist, album tuple from spotify status.
 
@@ -100,16 +118,21 @@ class OfflinePlaybackSkill(CommonPlaySkill):
 
     def __init__(self):
         super(OfflinePlaybackSkill, self).__init__()
-        self.song_database = SongDatabase()
+        # The scanned library is kept in the skill's data folder so it
+        # doesn't have to be rebuilt on every start
+        self.song_database = SongDatabase(
+            index_path=join(self.file_system.path, 'library.db'),
+            lang=self.lang)
         self.idle_count = 0
         self.ducking = False
         self.mouth_text = None
+        self.shown_status = None  # (artist, track, album, image) last sent
 
         enclosure_config = self.config_core.get('enclosure')
         self.platform = enclosure_config.get('platform', 'unknown')
         self.DEFAULT_VOLUME = 80 if self.platform == 'mycroft_mark_1' else 100
         self._playlists = self.song_database.playlists
-        self.regexes = {}
+        self.regex_bank = None
         self.last_played_type = None  # The last dir type that was started
         self.is_playing = False
         self.use_ducking = self.settings.get('use_ducking', False) #check that this line works
@@ -120,25 +143,31 @@ class OfflinePlaybackSkill(CommonPlaySkill):
         self.queue = {} # involved in shuffle
 
 
+    def load_regexes(self):
+        """Read and compile the .regex files of every locale."""
+        self.regex_bank = RegexBank(join(self.root_dir, 'locale'))
+
     def translate_regex(self, regex):
-        """If the regex is not already in regexes,
-         look for regex files and put them in self.regexes """
-        if regex not in self.regexes:
-            path = self.find_resource(regex + '.regex')
-            if path:
-                with open(path) as f:
-                    string = f.read().strip()
-                self.regexes[regex] = string
-        return self.regexes[regex]
+        """Returns: the compiled regex for the skill's language (falling
+        back to en-us), or None if there is no such regex"""
+        return self.regex_bank.regex(regex, self.lang)
 
     def initialize(self):
         super().initialize()
+        self.load_regexes()
 
         # Setup handlers for playback control messages
         self.add_event('mycroft.audio.service.next', self.next_track)
         self.add_event('mycroft.audio.service.prev', self.prev_track)
         self.add_event('mycroft.audio.service.pause', self.pause)
         self.add_event('mycroft.audio.service.resume', self.resume)
+        # Long selections are handed to the audio service a few tracks at
+        # a time as playback advances
+        self.add_event('mycroft.audio.playing_track',
+                       self.handle_track_started)
+        self.add_event('mycroft.audio.queue_end', self.handle_queue_end)
+        self.add_event('mycroft.audio.service.stop', self.handle_audio_stop)
+        self.add_event('play:start', self.handle_play_start)
 
         self.directory = self.settings.get("music directory")
         if self.directory == "":
@@ -148,10 +177,238 @@ class OfflinePlaybackSkill(CommonPlaySkill):
             
         self.log.info("Music directory set to '{}'".format(self.directory))
         
+        # Threads used to list folders and read tags while scanning
+        self.song_database.scan_workers = max(
+            1, int(self.settings.get('scan_workers') or 4))
+        # Scans run at low priority, at most this many files a second, and
+        # hold while the user speaks (and while audio plays, if set)
+        self.song_database.throttle.files_per_second = float(
+            self.settings.get('scan_files_per_second') or 0)
+        self.scan_pause_while_playing = self.settings.get(
+            'scan_pause_while_playing', True) not in (False, 'false')
+        self.add_event('recognizer_loop:record_begin',
+                       self.pause_scan_for_listener)
+        self.add_event('recognizer_loop:record_begin',
+                       self.handle_listener_started)
+        self.add_event('recognizer_loop:record_end',
+                       self.resume_scan_after_listener)
+
+        # Timings of a share of the queries (and of every library load),
+        # sent on the messagebus and optionally written to a local file
+        sample_rate = self.settings.get('metrics_sample_rate')
+        trace_path = (join(self.file_system.path, 'trace.jsonl')
+                      if self.settings.get('metrics_trace_file') else None)
+        tracer.configure(0.1 if sample_rate in (None, '') else sample_rate,
+                         trace_path)
+        self.schedule_repeating_event(self.send_metrics, None,
+                                      METRICS_INTERVAL,
+                                      name='OfflinePlaybackMetrics')
+
         # Set up music service stuff
         self.audio_service = AudioService(self.bus)
-        self.song_database.load_database(self.directory)
+        self.queue_feeder = QueueFeeder(self.audio_service)
+        # Playback starts when the announcement has been spoken; the first
+        # file is read meanwhile
+        self.playback_starter = PlaybackStarter(self.start_playback)
+        self.add_event('recognizer_loop:audio_output_start',
+                       self.playback_starter.speech_started)
+        self.add_event('recognizer_loop:audio_output_end',
+                       self.playback_starter.speech_ended)
+        # The files of the next few tracks are read ahead, so slow or
+        # spun-down storage doesn't make the start of a track stutter
+        ahead = self.settings.get('prefetch_tracks')
+        budget_mb = self.settings.get('prefetch_budget_mb') or 64
+        self.prefetcher = Prefetcher(
+            ahead=PREFETCH_AHEAD if ahead in (None, '') else int(ahead),
+            budget=int(budget_mb) * 1024 * 1024)
+        self.prefetcher.start()
+
+        # Album covers for the now playing status, extracted in the
+        # background and kept as thumbnails within a disk budget
+        cache_mb = self.settings.get('cover_art_cache_mb') or 50
+        self.cover_art = CoverArtCache(join(self.file_system.path, 'covers'),
+                                       budget=int(cache_mb) * 1024 * 1024,
+                                       on_ready=self.handle_cover_ready)
+        self.cover_art.start()
+        # What is playing, updated on track changes
+        self.now_playing = NowPlaying(self.query_track_info)
+
+        # Scan the library in the background. Queries are answered from the
+        # saved index (and whatever the scan has found so far) meanwhile.
+        self.library_ready = threading.Event()
+        self.library_watcher = LibraryWatcher(
+            self.song_database, self.directory,
+            on_change=self.report_library_change)
+        # Music on USB drives (and other drives mounted in /media or /mnt)
+        # is searchable while they are plugged in
+        self.use_drives = self.settings.get('removable_drives',
+                                            True) not in (False, 'false')
+        self.mount_watcher = MountWatcher(self.handle_drive_attached,
+                                          self.handle_drive_detached)
+        self.scan_thread = threading.Thread(target=self.load_library,
+                                            daemon=True)
+        self.scan_thread.start()
+
+    def load_library(self):
+        """Load the saved index and rescan the music directory.
+
+        Emits offline-playback.scan.started, .progress and .finished on the
+        messagebus so other components can tell when the library is ready.
+        """
+        lower_priority()
+        self.bus.emit(Message('offline-playback.scan.started',
+                              {'directory': self.directory}))
+        summary = None
+        mounted = self.mount_watcher.mounted() if self.use_drives else {}
+        for uuid, mount_point in self.library_drives(mounted).items():
+            self.song_database.add_root(mount_point, self.drive_shard(uuid))
+        try:
+            with tracer.trace('library_load', always=True,
+                              directory=self.directory):
+                # tags only; durations are read afterwards (read_details)
+                summary = self.song_database.load_database(
+                    self.directory, rescan=True,
+                    progress=self.report_scan_progress, details=False)
+                with tracer.span('prepare_playlists'):
+                    self.song_database.prepare_playlists()
+        except Exception as e:
+            self.log.exception('Library scan failed: {}'.format(repr(e)))
+        self.library_ready.set()
+
+        data = {'directory': self.directory,
+                'tracks': len(self.song_database.track_records),
+                'playlists': len(self.song_database.playlists),
+                'success': summary is not None}
+        data.update(summary or {})
+        if summary:
+            data['files_per_second'] = rate(summary['files_read'],
+                                            summary['read_seconds'])
+        # files left out because their tags couldn't be read (in time)
+        data['quarantine'] = len(self.song_database.load_quarantine())
+        if data['quarantine']:
+            self.log.warning('{} files are quarantined; they are skipped '
+                             'until they change'.format(data['quarantine']))
+        self.log.info('Library scan finished: {}'.format(data))
+        self.log.debug('Library memory use (bytes): '
+                       '{}'.format(self.song_database.memory_report()))
+        self.bus.emit(Message('offline-playback.scan.finished', data))
+
+        # Keep up with files added to or removed from the music directory
+        if not self.library_watcher.stopping.is_set():
+            self.library_watcher.start()
+            self.log.info('Watching the library using '
+                          '{}'.format(self.library_watcher.mode))
+            if self.use_drives:
+                self.mount_watcher.start(known=mounted)
+
+        # Second phase: durations, bitrates and sample rates
+        if summary and summary['complete']:
+            self.read_details()
+
+    def read_details(self, roots=None):
+        """Read the durations the tags-only scan left out, and emit
+        offline-playback.scan.details when done."""
+        try:
+            summary = self.song_database.read_details(roots)
+        except Exception as e:
+            self.log.exception('Reading track durations failed: '
+                               '{}'.format(repr(e)))
+            return
+        data = {'roots': roots or [root for root, index in
+                                   self.song_database.root_items()],
+                'files_per_second': rate(summary['read'],
+                                         summary['elapsed'])}
+        data.update(summary)
+        self.log.info('Track durations read: {}'.format(data))
+        self.bus.emit(Message('offline-playback.scan.details', data))
+
+    def drive_shard(self, uuid):
+        """Returns: the index shard file of the drive with this UUID"""
+        return join(self.file_system.path, 'drives', uuid + '.db')
+
+    def library_drives(self, drives):
+        """Returns: the drives (UUID -> mount point) to add to the library,
+        leaving out any the music directory is on or in"""
+        music = self.directory.rstrip('/') + '/'
+        return {uuid: mount_point for uuid, mount_point in drives.items()
+                if not (music.startswith(mount_point.rstrip('/') + '/') or
+                        (mount_point + '/').startswith(music))}
+
+    def handle_drive_attached(self, uuid, mount_point):
+        """Called by the mount watcher when a drive is mounted. Its saved
+        shard is searchable at once; it is scanned in the background."""
+        if not self.library_drives({uuid: mount_point}):
+            return
+        threading.Thread(target=self.attach_drive, args=(uuid, mount_point),
+                         daemon=True).start()
+
+    def attach_drive(self, uuid, mount_point):
+        lower_priority()
+        self.log.info('Adding drive {} at {} to the library'.format(
+            uuid, mount_point))
+        try:
+            summary = self.song_database.attach_root(
+                mount_point, self.drive_shard(uuid), details=False)
+        except Exception as e:
+            self.log.exception('Scanning drive {} failed: {}'.format(
+                mount_point, repr(e)))
+            return
+        data = {'uuid': uuid, 'mount_point': mount_point,
+                'tracks': len(self.song_database.track_records)}
+        data.update(summary)
+        self.bus.emit(Message('offline-playback.drive.attached', data))
+        self.read_details([mount_point])
+
+    def handle_drive_detached(self, uuid, mount_point):
+        """Called by the mount watcher when a drive went away."""
+        if not self.library_drives({uuid: mount_point}):
+            return
+        removed = self.song_database.detach_root(mount_point)
+        self.log.info('Drive {} at {} removed from the library ({} '
+                      'files)'.format(uuid, mount_point, removed))
+        self.bus.emit(Message('offline-playback.drive.detached',
+                              {'uuid': uuid, 'mount_point': mount_point,
+                               'removed': removed}))
+
+    def pause_scan_for_listener(self, message=None):
+        self.song_database.throttle.pause('listener', LISTENER_PAUSE_TIMEOUT)
+
+    def resume_scan_after_listener(self, message=None):
+        self.song_database.throttle.resume('listener')
+
+    def hold_scan_while_playing(self, playing):
+        """Hold library scans while audio plays, if set to; they carry on
+        from where they were when it stops. The hold is renewed at every
+        track and runs out a little after the track would have ended, so
+        a missed stop doesn't hold the scan for good."""
+        if playing and self.scan_pause_while_playing:
+            path = self.queue_feeder.current()
+            record = (self.song_database.get_track_record(path)
+                      if path else None)
+            if record and record['duration']:
+                timeout = record['duration'] + AUDIO_PAUSE_MARGIN
+            else:
+                timeout = AUDIO_PAUSE_TIMEOUT
+            self.song_database.throttle.pause('audio', timeout)
+        else:
+            self.song_database.throttle.resume('audio')
+
+    def report_library_change(self, summary):
+        """Called by the library watcher after it updated the database."""
+        self.bus.emit(Message('offline-playback.library.changed', summary))
+
+    def report_scan_progress(self, done, total):
+        self.bus.emit(Message('offline-playback.scan.progress',
+                              {'directory': self.directory,
+                               'done': done,
+                               'total': total}))
 
+    def send_metrics(self, message=None):
+        """Emit the stage timings and counters collected since the last
+        call as offline-playback.metrics, if anything was collected."""
+        report = tracer.report()
+        if report['traces'] or report['counters']:
+            self.bus.emit(Message('offline-playback.metrics', report))
 
 
     ######################################################################
@@ -195,51 +452,54 @@ class OfflinePlaybackSkill(CommonPlaySkill):
     # Mycroft display handling
 
     def start_monitor(self):
-        """Monitoring and current song display."""
-        # Clear any existing event
-        self.stop_monitor()
-
-        # Schedule a new one every 5 seconds to monitor/update display
-        self.schedule_repeating_event(self._update_display,
-                                      None, 5,
-                                      name='MonitorOfflinePlayer')
-        self.add_event('recognizer_loop:record_begin',
-                       self.handle_listener_started)
+        """Current song display. It follows the audio service's track
+        change events (see handle_track_started) rather than polling."""
+        self.update_now_playing()
 
     def stop_monitor(self):
-        # Clear any existing event
-        self.cancel_scheduled_event('MonitorOfflinePlayer')
-
-    def _update_display(self, message):
-        # Checks once a second for feedback
-        status = self.status()
+        self.now_playing.clear()
+        self._update_display(None)
+
+    def update_now_playing(self):
+        """Work out what is playing from the track fed to the audio service
+        and the tags in the library, and show it if it changed."""
+        path = self.queue_feeder.current()
+        record = self.song_database.get_track_record(path) if path else None
+        if record:
+            status = {'track': self.song_database.track_title(record),
+                      'artist': record['artist'] or '',
+                      'album': record['album'] or '',
+                      'image': self.cover_art.lookup(path, record['album']),
+                      'path': path}
+            self.now_playing.set(status, record['duration'])
+        else:
+            # not one of ours (or not in the library any more)
+            self.now_playing.expire()
+        self._update_display(self.now_playing.get())
 
+    def _update_display(self, status):
+        """Send the play:status and the Mark-1 mouth text, if they differ
+        from what was shown last."""
         if not status:
-            self.stop_monitor()
-            self.mouth_text = None
-            self.enclosure.mouth_reset()
-            self.disable_playing_intents()
+            if self.shown_status is not None:
+                self.shown_status = None
+                self.mouth_text = None
+                self.enclosure.mouth_reset()
+                self.disable_playing_intents()
             return
 
-        # Get the current track info
-        try:
-            artist = status['item']['artists'][0]['name']
-        except Exception:
-            artist = ''
-        try:
-            track = status['item']['name']
-        except Exception:
-            track = ''
-        try:
-            image = status['item']['album']['images'][0]['url']
-        except Exception:
-            image = ''
-
-        self.CPS_send_status(artist=artist, track=track, image=image)
+        shown = (status['artist'], status['track'], status['album'],
+                 status['image'])
+        if shown != self.shown_status:
+            self.shown_status = shown
+            self.CPS_send_status(artist=status['artist'],
+                                 track=status['track'],
+                                 album=status['album'],
+                                 image=status['image'])
 
         # Mark-1
-        if artist and track:
-            text = '{}: {}'.format(artist, track)
+        if status['artist'] and status['track']:
+            text = '{}: {}'.format(status['artist'], status['track'])
         else:
             text = ''
 
@@ -248,12 +508,27 @@ class OfflinePlaybackSkill(CommonPlaySkill):
             self.mouth_text = text
             self.enclosure.mouth_text(text)
 
-    def status(self):
-        if self.audio_service:
-            return self.audio_service.track_info()
-        else:
-            return None
+    def handle_cover_ready(self, file_path):
+        """Called by the cover art cache when a cover was extracted."""
+        status = self.now_playing.status
+        if status and status['path'] and (
+                os.path.dirname(status['path']) ==
+                os.path.dirname(file_path)):
+            self.update_now_playing()
+
+    def query_track_info(self):
+        """Ask the audio service what it is playing, giving up quickly.
+        Returns: its track info dict, or None"""
+        reply = self.bus.wait_for_response(
+            Message('mycroft.audio.service.track_info'),
+            'mycroft.audio.service.track_info_reply',
+            timeout=STATUS_TIMEOUT)
+        return reply.data if reply else None
 
+    def status(self):
+        """Returns: the now playing status dict ('track', 'artist',
+        'album', 'image', 'path'), or None if nothing is playing"""
+        return self.now_playing.get()
 
     def CPS_send_status(self, artist='', track='', album='', image=''):
         data = {'skill': self.name,
@@ -267,18 +542,28 @@ class OfflinePlaybackSkill(CommonPlaySkill):
 
     def CPS_match_query_phrase(self, phrase):
         """Handler for common play framework Query."""
+        with tracer.trace('query', phrase=phrase):
+            return self.match_query_phrase(phrase)
 
+    def match_query_phrase(self, phrase):
+        """Match 'phrase' against the library.
+        Returns: (phrase, CPSMatchLevel, data) or None"""
         offline_specified = 'offline' in phrase or 'locally' in phrase
         bonus = 0.1 if offline_specified else 0.0
-        phrase = re.sub(self.translate_regex('offline'), '', phrase)
+        offline = self.translate_regex('offline')
+        if offline:
+            phrase = offline.sub('', phrase)
 
         #search for the song. Check to see if locally or offline mentioned,
         # search specific phrase, then search generically
-        confidence, data = self.continue_playback(phrase, bonus) #'play offline'
+        with tracer.span('continue_playback'):
+            confidence, data = self.continue_playback(phrase, bonus) #'play offline'
         if not data:
-            confidence, data = self.specific_query(phrase, bonus) #'play x'
+            with tracer.span('specific_query'):
+                confidence, data = self.specific_query(phrase, bonus) #'play x'
             if not data:
-                confidence, data = self.generic_query(phrase, bonus) #'play y'
+                with tracer.span('generic_query'):
+                    confidence, data = self.generic_query(phrase, bonus) #'play y'
 
         if data:
             self.log.info('Offline Player confidence: {}'.format(confidence))
@@ -346,38 +631,34 @@ class OfflinePlaybackSkill(CommonPlaySkill):
 
         Returns: Tuple with confidence and data or NOTHING_FOUND
         """
+        # Saved songs, playlist, album, artist or track, in one match
+        kind, groups = self.regex_bank.classify(phrase, self.lang)
+
         # Check if saved
-         #gets "saved songs" from the phrase if it is there.
-        match = re.match(self.translate_regex('saved_songs'), phrase)
-        if match and self.saved_tracks:
-            return (1.0, {'data': None,
-                          'type': 'saved_tracks'})
+        if kind == 'saved_songs':
+            if self.song_database.saved_tracks:
+                return (1.0, {'data': None,
+                              'type': 'saved_tracks'})
+            # nothing saved; see if one of the others matches instead
+            kind, groups = self.regex_bank.classify(
+                phrase, self.lang, ('playlist', 'album', 'artist', 'song'))
 
         # Check if playlist
-        match = re.match(self.translate_regex('playlist'), phrase)
-        if match:
-            return self.query_playlist(match.groupdict()['playlist'])
+        if kind == 'playlist':
+            return self.query_playlist(groups['playlist'])
 
         # Check album
-        match = re.match(self.translate_regex('album'), phrase)
-        if match:
+        if kind == 'album':
             bonus += 0.1
-            album = match.groupdict()['album']
-            return self.query_album(album, bonus)
-            if match:
-                bonus += 0.1
+            return self.query_album(groups['album'], bonus)
 
         # Check artist
-        match = re.match(self.translate_regex('artist'), phrase)
-        if match:
-            artist = match.groupdict()['artist']
-            return self.query_artist(artist, bonus)
+        if kind == 'artist':
+            return self.query_artist(groups['artist'], bonus)
 
         # Check track
-        match = re.match(self.translate_regex('song'), phrase)
-        if match:
-            song = match.groupdict()['track']
-            return self.query_song(song, bonus)
+        if kind == 'song':
+            return self.query_song(groups['track'], bonus)
         return NOTHING_FOUND
 
     def generic_query(self, phrase, bonus = 0.0):
@@ -386,9 +667,14 @@ class OfflinePlaybackSkill(CommonPlaySkill):
 
         This will try to parse the entire phrase in the following order
         - As a user playlist
-        - As an album
+        - As an artist
         - As a track
-        - As a public playlist
+        - As an album
+
+        All four are looked up in a single pass over the library's search
+        index. Phrases naming an artist ("x by y") still go through
+        query_song and query_album for tracks and albums, so the artist is
+        checked as well.
 
         Arguments:
             phrase (str): Text to match against
@@ -399,47 +685,57 @@ class OfflinePlaybackSkill(CommonPlaySkill):
         self.log.info('Handling "{}" as a genric query...'.format(phrase))
         results = []
 
-        # Check for playlist
-        self.log.info('Checking users playlists')
-        playlist, conf = self.song_database.search_playlists(phrase)
-        if playlist:
-            dir = self.song_database.playlists[playlist]
-            data = {
-                        'data': dir,
-                        'name': playlist,
-                        'type': 'playlist'
-                   }
-        if conf and conf > DIRECT_RESPONSE_CONFIDENCE:
-            return (conf, data)
-        elif conf and conf > MATCH_CONFIDENCE:
-            results.append((conf, data))
-
-        # Check for artist
-        self.log.info('Checking artists')
-        conf, data = self.query_artist(phrase, bonus)
-        if conf and conf > DIRECT_RESPONSE_CONFIDENCE:
-            return conf, data
-        elif conf and conf > MATCH_CONFIDENCE:
-            results.append((conf, data))
-
-        # Check for track
-        self.log.info('Checking tracks')
-        conf, data = self.query_song(phrase, bonus)
-        if conf and conf > DIRECT_RESPONSE_CONFIDENCE:
-            return conf, data
-        elif conf and conf > MATCH_CONFIDENCE:
-            results.append((conf, data))
-
-        # Check for album
-        self.log.info('Checking albums')
-        conf, data = self.query_album(phrase, bonus)
-        if conf and conf > DIRECT_RESPONSE_CONFIDENCE:
-            return conf, data
-        elif conf and conf > MATCH_CONFIDENCE:
-            results.append((conf, data))
+        by_word = ' {} '.format(self.translate('by'))
+        names_artist = len(phrase.split(by_word)) > 1
+        found = self.song_database.search_all(phrase.lower())
+
+        for kind in ('playlists', 'artists', 'tracks', 'albums'):
+            self.log.info('Checking {}'.format(kind))
+            if names_artist and kind == 'tracks':
+                conf, data = self.query_song(phrase, bonus)
+            elif names_artist and kind == 'albums':
+                conf, data = self.query_album(phrase, bonus)
+            else:
+                conf, data = self.search_result(kind, found[kind], phrase,
+                                                bonus)
+            if conf and conf > DIRECT_RESPONSE_CONFIDENCE:
+                return conf, data
+            elif conf and conf > MATCH_CONFIDENCE:
+                results.append((conf, data))
 
         return best_result(results)
 
+    def search_result(self, kind, found, phrase, bonus=0.0):
+        """Turn a SongDatabase.search_all result into the confidence and
+        data that query_playlist/artist/song/album would return.
+
+        Arguments:
+            kind (str): 'playlists', 'artists', 'tracks' or 'albums'
+            found (tuple): (name, match, confidence) from search_all
+            phrase (str): the phrase that was searched for
+            bonus (float): Any bonus to apply to album confidence
+
+        Returns: Tuple with confidence and data or NOTHING_FOUND
+        """
+        name, match, confidence = found
+        if not match:
+            return NOTHING_FOUND
+
+        if kind == 'playlists':
+            return (confidence,
+                    {'data': match, 'name': name, 'type': 'playlist'})
+        elif kind == 'artists':
+            return (min(confidence, 1.0),
+                    {'data': match, 'name': None, 'type': 'artist'})
+        elif kind == 'tracks':
+            return (confidence,
+                    {'data': match, 'name': None, 'type': 'track'})
+        else:
+            # see if confidence improves when parentheses are removed
+            confidence = max(confidence, best_confidence(name, phrase))
+            return (min(confidence + bonus, 1.0),
+                    {'data': match, 'name': None, 'type': 'album'})
+
     def query_artist(self, artist, bonus=0.0):
         """Try to find an artist.
 
@@ -519,12 +815,12 @@ class OfflinePlaybackSkill(CommonPlaySkill):
 
         Returns: Tuple with confidence and data or NOTHING_FOUND
         """
-        result, conf = self.song_database.search_playlists(playlist)
-        if result and conf > 0.5:
-            dir = self.song_database.playlists[result]
+        dir, conf = self.song_database.search_playlists(playlist)
+        if dir and conf > 0.5:
             return (conf, {'data': dir,
                            'name': playlist,
                            'type': 'playlist'})
+        return NOTHING_FOUND
 
     def query_song(self, song, bonus):
         """Try to find a song.
@@ -557,30 +853,31 @@ class OfflinePlaybackSkill(CommonPlaySkill):
 
     def CPS_start(self, phrase, data):
         """Handler for common play framework start playback request."""
-        try:
-            if data['type'] == 'continue':
-                self.acknowledge()
-                self.resume()
-            elif data['type'] == 'playlist':
-                self.start_playlist_playback(data['name'],
-                                             data['data'])
-            else:  # artist, album track
-                self.log.info('playing {}'.format(data['type']))
-                song_data = data['data']
-                data_type = data['type']
-                self.play(song_data, data_type)
-            self.enable_playing_intents()
-            if data.get('type') and data['type'] != 'continue':
-                self.last_played_type = data['type']
-            self.is_playing = True
-
-        except PlaylistNotFoundError:
-            self.speak_dialog('PlaybackFailed',
-                              {'reason': self.translate('PlaylistNotFound')})
-
-        except Exception as e:
-            self.log.exception(str(e))
-            self.speak_dialog('PlaybackFailed', {'reason': str(e)})
+        with tracer.trace('start', type=data.get('type')):
+            try:
+                if data['type'] == 'continue':
+                    self.acknowledge()
+                    self.resume()
+                elif data['type'] == 'playlist':
+                    self.start_playlist_playback(data['name'],
+                                                 data['data'])
+                else:  # artist, album track
+                    self.log.info('playing {}'.format(data['type']))
+                    song_data = data['data']
+                    data_type = data['type']
+                    self.play(song_data, data_type)
+                self.enable_playing_intents()
+                if data.get('type') and data['type'] != 'continue':
+                    self.last_played_type = data['type']
+                self.is_playing = True
+
+            except PlaylistNotFoundError:
+                self.speak_dialog('PlaybackFailed',
+                                  {'reason': self.translate('PlaylistNotFound')})
+
+            except Exception as e:
+                self.log.exception(str(e))
+                self.speak_dialog('PlaybackFailed', {'reason': str(e)})
 
     def create_intents(self):
         """Setup the spotify intents."""
@@ -592,7 +889,6 @@ class OfflinePlaybackSkill(CommonPlaySkill):
         self.register_intent_file('WhatAlbum.intent', self.album_info)
         self.register_intent_file('WhatArtist.intent', self.artist_info)
         self.register_intent_file('StopMusic.intent', self.handle_stop)
-        time.sleep(0.5)
         self.disable_playing_intents()
 
     def enable_playing_intents(self):
@@ -613,29 +909,83 @@ class OfflinePlaybackSkill(CommonPlaySkill):
 
     #come back
     def offline_player_play(self, files=None):
-        """Start playback and log any exceptions."""
+        """Start playing 'files' as soon as the announcement spoken right
+        after this call is over. Returns without waiting for it."""
+        self.log.info(u'Offline_play')
+        if files != None:
+            self.playback_starter.begin(files)
+        else:
+            self.start_monitor()
+
+    def start_playback(self, files):
+        """Called by the playback starter when the announcement is over.
+        Hand the first tracks to the audio service and log any exceptions."""
+        tracer.observe('speech_wait', self.playback_starter.waited)
         try:
-            self.log.info(u'Offline_play')
-            if files != None:
-                self.audio_service.play(files, self.preferred_service, self.repeat)
-            """else:
-                self.resume()"""
+            self.queue_feeder.play(files, self.preferred_service,
+                                   self.repeat)
+            self.update_prefetch()
             self.start_monitor()
 
         except Exception as e:
             self.log.exception(e)
-            raise
+
+    def handle_track_started(self, message):
+        """Top up the audio service's queue as playback advances, and show
+        the new track. Tracks other skills play are left alone."""
+        if not self.queue_feeder.active:
+            return
+        seconds = self.playback_starter.first_audio()
+        if seconds is not None:
+            self.log.info('First audio {:.2f} s after the request'.format(
+                seconds))
+            tracer.observe('time_to_first_audio', seconds)
+        self.queue_feeder.track_started(message.data.get('track'))
+        self.update_prefetch()
+        self.update_now_playing()
+        self.hold_scan_while_playing(True)
+
+    def handle_queue_end(self, message):
+        self.queue_feeder.queue_ended()
+        self.update_prefetch()
+        if not self.queue_feeder.active:
+            self.stop_monitor()
+            self.hold_scan_while_playing(False)
+
+    def handle_audio_stop(self, message):
+        self.queue_feeder.stop()
+        self.update_prefetch()
+        self.stop_monitor()
+        self.hold_scan_while_playing(False)
+
+    def update_prefetch(self):
+        """Read ahead the tracks queued after the one playing (none when
+        the feeder was stopped)."""
+        self.prefetcher.update(
+            self.queue_feeder.upcoming(self.prefetcher.ahead))
+
+    def handle_play_start(self, message):
+        """Stop feeding tracks when another skill starts playing."""
+        if message.data.get('skill_id') != self.skill_id:
+            self.playback_starter.cancel()
+            self.queue_feeder.stop()
+            self.update_prefetch()
+            self.now_playing.clear()
+            self.shown_status = None
 
     def start_playlist_playback(self, name, dir):
         name = name.replace('|', ':')
-        if dir:
+        # The playlist's entries that are in the library, parsed once and
+        # cached until the playlist file changes
+        files = self.song_database.playlist_files(dir) if dir else []
+        if files:
             self.log.info(u'playing {}'.format(name))
+            self.offline_player_play(files)
             self.speak_dialog('ListeningToPlaylist',
                               data={'playlist': name})
-            time.sleep(2)
-            self.offline_player_play(dir)
         else:
-            self.log.info('No playlist found')
+            self.log.info('No playlist found, or none of its files are '
+                          'in the library')
             raise PlaylistNotFoundError
 
     def play(self, song_list, data_type='track', genre_name=None):
@@ -662,9 +1012,8 @@ class OfflinePlaybackSkill(CommonPlaySkill):
         try:
             if data_type == 'saved_tracks':
                 items = self.song_database.saved_tracks
-                self.speak_dialog('ListeningToSavedSongs')
-                time.sleep(2)
                 self.offline_player_play(items)
+                self.speak_dialog('ListeningToSavedSongs')
 
             elif data_type == 'track':
                 song_info = self.song_database.get_song_info(song_list)
@@ -676,36 +1025,37 @@ class OfflinePlaybackSkill(CommonPlaySkill):
                 else: #If no specific choice, play something random
                     song = "random"
                     artist = "random"
-                    dir = self.song_database.get_random_song_list()
+                    #the whole library, shuffled as it plays
+                    song_list = self.song_database.shuffle_tracks()
+                self.offline_player_play(song_list)
                 self.speak_dialog('ListeningToSongBy',
                                   data={'tracks': song,
                                         'artist': artist})
-                time.sleep(2)
-                self.offline_player_play(song_list)
 
             elif data_type == 'artist':
                 (artist, song_list) = self.song_database.get_artist_info(song_list)
+                self.offline_player_play(song_list)
                 self.speak_dialog('ListeningToArtist',
                                   data={'artist': artist})
-                time.sleep(2)
-                self.offline_player_play(song_list)
 
             elif data_type == 'album':
-                #pass the first song
-                song_info = self.song_database.get_song_info(song_list[0])
-                self.speak_dialog('ListeningToAlbumBy',
-                                  data={'album': song_info.get('album'),
-                                        'artist': song_info.get('artist')})
-                time.sleep(2)
+                #the tags of the first song, as stored when it was scanned
+                album, artist = self.song_database.get_album_info(song_list)
                 self.offline_player_play(song_list)
+                self.speak_dialog('ListeningToAlbumBy',
+                                  data={'album': album,
+                                        'artist': artist})
 
             elif data_type == 'genre':
                 genre_name = self.song_database.get_genre_name(song_list)
-                self.log.info("Shuffling songs in ", genre_name)
+                self.log.info("Shuffling songs in {}".format(genre_name))
                 random.shuffle(song_list)
-                self.speak_dialog('ListeningToGenre', genre_name)
-                time.sleep(2)
+                song_info = self.song_database.get_song_info(song_list) or {}
                 self.offline_player_play(song_list)
+                self.speak_dialog('ListeningToGenre',
+                                  data={'genre': genre_name,
+                                        'track': song_info.get('title'),
+                                        'artist': song_info.get('artist')})
 
             else:
                 self.log.error('wrong data_type')
@@ -791,20 +1141,28 @@ class OfflinePlaybackSkill(CommonPlaySkill):
 
     def song_info(self, message):
         """ Speak song info. """
-        status = self.audio_service.track_info()
-        self.speak_dialog('CurrentSong', {'song': status['title'], 'artist': status['artist']})
+        status = self.status()
+        if not status:
+            self.speak_dialog('NothingPlaying')
+            return
+        self.speak_dialog('CurrentSong', {'song': status['track'], 'artist': status['artist']})
 
     def album_info(self, message):
         """ Speak album info. """
-        status = self.audio_service.track_info()
-        if self.last_played_type == 'album':
+        status = self.status()
+        if not status:
+            self.speak_dialog('NothingPlaying')
+        elif self.last_played_type == 'album':
             self.speak_dialog('CurrentAlbum', {'album': status['album']})
         else:
             self.speak_dialog('OnAlbum', {'album': status['album']})
 
     def artist_info(self, message):
         """ Speak artist info. """
-        status = self.audio_service.track_info()
+        status = self.status()
+        if not status:
+            self.speak_dialog('NothingPlaying')
+            return
         self.speak_dialog('CurrentArtist', {'artist': status['artist']})
 
     def __pause(self):
@@ -816,12 +1174,14 @@ class OfflinePlaybackSkill(CommonPlaySkill):
         """ Handler for playback control pause. """
         self.ducking = False
         self.__pause()
+        self.hold_scan_while_playing(False)
 
     def resume(self, message=None):
         """ Handler for playback control resume. """
         # if playback was started by the skill
         if self.audio_service:
             self.log.info('Resuming Music Player')
+        self.hold_scan_while_playing(True)
 
     def next_track(self, message):
         """ Handler for playback control next. """
@@ -857,6 +1217,9 @@ class OfflinePlaybackSkill(CommonPlaySkill):
 
     def stop(self):
         """ Stop playback. """
+        if self.playback_starter.cancel():
+            # stopped while announcing, before anything was played
+            return True
         if self.audio_service and self.is_playing:
             self.schedule_event(self.do_stop, 0, name='StopOfflinePlayer')
             return True
@@ -864,8 +1227,20 @@ class OfflinePlaybackSkill(CommonPlaySkill):
             return False
 
     def shutdown(self):
-        """ Remove the monitor at shutdown. """
+        """ Remove the monitor, stop scanning and save the library
+            snapshot at shutdown. """
+        self.playback_starter.cancel()
         self.stop_monitor()
+        self.mount_watcher.stop()
+        self.cover_art.stop()
+        self.prefetcher.stop()
+        self.library_watcher.stop()
+        self.song_database.stop_scan()
+        self.scan_thread.join(timeout=5)
+        if not self.scan_thread.is_alive():
+            self.song_database.save_snapshot()
+        self.cancel_scheduled_event('OfflinePlaybackMetrics')
+        tracer.close()
 
         # Do normal shutdown procedure
         super(OfflinePlaybackSkill, self).shutdown()
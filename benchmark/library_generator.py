@@ -0,0 +1,294 @@
+"""Generate synthetic music libraries for benchmarking.
+
+The libraries look like real collections to the skill: MP3 files with
+ID3v2.3 tags and FLAC files with Vorbis comments, artists whose
+popularity follows a power law, albums of 6 to 16 tracks, a long tail of
+genres, gaps in the tags, files without any tags, nested folders and
+playlists in several formats. The audio is a few frames of silence, so a
+500k-file library fits in a few hundred MB.
+
+The same parameters and seed always produce the same library.
+"""
+import json
+import os
+import random
+import struct
+from urllib.parse import quote
+
+
+MANIFEST = 'benchmark-manifest.json'
+
+WORDS = (
+    'love night day heart fire time world life dream light dark blue rain '
+    'summer road home river city girl boy song dance ghost king queen '
+    'stone star sun moon wild golden broken lost silver electric black '
+    'white red sweet cold hot lonely crazy little big last first young old '
+    'forever never again tonight morning midnight highway ocean mountain '
+    'window shadow thunder angel devil paradise heaven echo mirror rose '
+    'diamond velvet neon paper glass iron honey sugar storm winter spring '
+    'autumn desert island garden kingdom memory secret whisper silence '
+    'runaway satellite machine rocket circus carnival mystery freedom'
+).split()
+ACCENTED = ['café', 'señor', 'über', 'déjà vu', 'naïve', 'mañana', 'ørsted',
+            'fiancée', 'smörgås', 'garçon']
+GENRES = ['Rock', 'Pop', 'Alternative', 'Indie', 'Electronic', 'Hip-Hop',
+          'Jazz', 'Classical', 'Metal', 'Folk', 'Country', 'R&B', 'Soul',
+          'Blues', 'Reggae', 'Punk', 'Ambient', 'Soundtrack', 'Latin',
+          'Funk', 'Disco', 'House', 'Techno', 'World', 'Gospel']
+
+# One MPEG-1 layer III frame (128 kbit/s, 44.1 kHz) of silence
+MPEG_FRAME = b'\xff\xfb\x90\x64' + b'\x00' * 413
+
+
+def zipf_weights(count, exponent=1.1):
+    return [1.0 / (rank ** exponent) for rank in range(1, count + 1)]
+
+
+def make_name(rng, min_words=1, max_words=4):
+    words = [rng.choice(WORDS)
+             for _ in range(rng.randint(min_words, max_words))]
+    if rng.random() < 0.03:
+        words[rng.randrange(len(words))] = rng.choice(ACCENTED)
+    return ' '.join(words).title()
+
+
+def id3_frame(frame_id, text):
+    data = b'\x01' + text.encode('utf-16')  # UTF-16 with BOM
+    return (frame_id.encode('ascii') + struct.pack('>I', len(data)) +
+            b'\x00\x00' + data)
+
+
+def syncsafe(number):
+    return bytes([(number >> 21) & 0x7f, (number >> 14) & 0x7f,
+                  (number >> 7) & 0x7f, number & 0x7f])
+
+
+def mp3_bytes(tags, frames):
+    """Returns: an MP3 file with an ID3v2.3 tag (none if 'tags' is empty)"""
+    ids = {'title': 'TIT2', 'artist': 'TPE1', 'album': 'TALB',
+           'albumartist': 'TPE2', 'genre': 'TCON', 'year': 'TYER',
+           'track': 'TRCK'}
+    body = b''.join(id3_frame(ids[field], str(value))
+                    for field, value in tags.items() if value is not None)
+    header = b'ID3\x03\x00\x00' + syncsafe(len(body)) if body else b''
+    return header + body + MPEG_FRAME * frames
+
+
+def flac_bytes(tags, frames):
+    """Returns: a FLAC file holding only metadata blocks: STREAMINFO and,
+    unless 'tags' is empty, a Vorbis comment"""
+    samples = 1152 * frames
+    info = struct.pack('>HH', 4096, 4096) + b'\x00' * 6
+    # sample rate (20 bits), channels - 1 (3), bits - 1 (5), samples (36)
+    packed = (44100 << 44) | (1 << 41) | (15 << 36) | samples
+    info += packed.to_bytes(8, 'big') + b'\x00' * 16
+
+    names = {'title': 'TITLE', 'artist': 'ARTIST', 'album': 'ALBUM',
+             'albumartist': 'ALBUMARTIST', 'genre': 'GENRE', 'year': 'DATE',
+             'track': 'TRACKNUMBER'}
+    comments = [('{}={}'.format(names[field], value)).encode('utf-8')
+                for field, value in tags.items() if value is not None]
+    vendor = b'benchmark'
+    comment = (struct.pack('<I', len(vendor)) + vendor +
+               struct.pack('<I', len(comments)) +
+               b''.join(struct.pack('<I', len(c)) + c for c in comments))
+
+    blocks = [(0, info)] + ([(4, comment)] if comments else [])
+    data = b'fLaC'
+    for i, (block_type, block) in enumerate(blocks):
+        last = 0x80 if i == len(blocks) - 1 else 0
+        data += bytes([last | block_type]) + len(block).to_bytes(3, 'big')
+        data += block
+    return data
+
+
+def safe_filename(name):
+    return ''.join('_' if char in '/\\:*?"<>|' else char for char in name)
+
+
+class LibraryGenerator:
+    """Builds a synthetic library of 'tracks' music files under 'root'.
+
+    Arguments:
+        root (str):        folder to create the library in
+        tracks (int):      number of music files
+        seed (int):        random seed
+        depth (int):       folder levels above the files: 1 'Artist -
+                           Album', 2 'Artist/Album', 3 'Genre/Artist/Album',
+                           4 'Genre/Artist/Album/CD n'
+        untagged (float):  share of files without any tags
+        flac (float):      share of FLAC files (the rest are MP3)
+        playlists (int):   number of playlists (None: one per 1000 tracks,
+                           at least 3)
+        frames (int):      MPEG frames of silence per MP3 file
+    """
+    def __init__(self, root, tracks=1000, seed=1, depth=2, untagged=0.05,
+                 flac=0.15, playlists=None, frames=2):
+        self.root = os.path.abspath(root)
+        self.params = {'tracks': tracks, 'seed': seed, 'depth': depth,
+                       'untagged': untagged, 'flac': flac,
+                       'playlists': (max(3, tracks // 1000)
+                                     if playlists is None else playlists),
+                       'frames': frames}
+
+    def manifest_path(self):
+        return os.path.join(self.root, MANIFEST)
+
+    def load_manifest(self):
+        """Returns: the manifest of a library generated earlier with the
+        same parameters, or None"""
+        try:
+            with open(self.manifest_path()) as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return manifest if manifest.get('params') == self.params else None
+
+    def generate(self, reuse=True):
+        """Create the library (or reuse an identical one).
+
+        Returns: manifest dict with the 'params' and the names in the
+        library ('titles', 'artists', 'albums', 'genres', 'playlists') for
+        building queries, plus 'files' and 'bytes' written
+        """
+        if reuse:
+            manifest = self.load_manifest()
+            if manifest:
+                return manifest
+
+        params = self.params
+        rng = random.Random(params['seed'])
+        os.makedirs(self.root, exist_ok=True)
+
+        artist_count = max(5, params['tracks'] // 40)
+        artists = []
+        seen = set()
+        while len(artists) < artist_count:
+            name = make_name(rng, 1, 3)
+            if rng.random() < 0.15:
+                name = 'The ' + name
+            if name not in seen:
+                seen.add(name)
+                artists.append(name)
+        artist_weights = zipf_weights(len(artists))
+        genre_weights = zipf_weights(len(GENRES), 0.9)
+        artist_genres = {artist: rng.choices(GENRES, genre_weights)[0]
+                         for artist in artists}
+
+        manifest = {'params': params, 'titles': [], 'artists': set(),
+                    'albums': [], 'genres': set(), 'playlists': [],
+                    'files': 0, 'bytes': 0}
+        paths = []
+        while len(paths) < params['tracks']:
+            compilation = rng.random() < 0.05
+            album_artist = rng.choices(artists, artist_weights)[0]
+            album = make_name(rng, 1, 4)
+            year = int(rng.triangular(1950, 2024, 2015))
+            genre = artist_genres[album_artist]
+            folder = self.album_folder(rng, genre, album_artist, album)
+            os.makedirs(folder, exist_ok=True)
+            manifest['albums'].append(album)
+
+            size = min(rng.randint(6, 16), params['tracks'] - len(paths))
+            for number in range(1, size + 1):
+                artist = (rng.choices(artists, artist_weights)[0]
+                          if compilation else album_artist)
+                title = make_name(rng)
+                tags = {'title': title, 'artist': artist, 'album': album,
+                        'albumartist': ('Various Artists' if compilation
+                                        else None),
+                        'genre': genre, 'year': year, 'track': number}
+                # real libraries have gaps
+                for field, share in (('album', 0.03), ('genre', 0.1),
+                                     ('year', 0.2)):
+                    if rng.random() < share:
+                        tags[field] = None
+                if rng.random() < params['untagged']:
+                    tags = {}
+
+                is_flac = rng.random() < params['flac']
+                filename = '{:02d} {}.{}'.format(
+                    number, safe_filename(title), 'flac' if is_flac else 'mp3')
+                path = os.path.join(folder, filename)
+                data = (flac_bytes(tags, params['frames']) if is_flac
+                        else mp3_bytes(tags, params['frames']))
+                with open(path, 'wb') as f:
+                    f.write(data)
+                paths.append(path)
+                manifest['bytes'] += len(data)
+                if tags:
+                    manifest['titles'].append(title)
+                    manifest['artists'].add(artist)
+                    if tags['genre']:
+                        manifest['genres'].add(genre)
+
+        manifest['playlists'] = self.write_playlists(rng, paths)
+        manifest['files'] = len(paths) + len(manifest['playlists'])
+        manifest['artists'] = sorted(manifest['artists'])
+        manifest['genres'] = sorted(manifest['genres'])
+        with open(self.manifest_path(), 'w') as f:
+            json.dump(manifest, f)
+        return manifest
+
+    def album_folder(self, rng, genre, artist, album):
+        depth = self.params['depth']
+        artist, album = safe_filename(artist), safe_filename(album)
+        if depth <= 1:
+            parts = ['{} - {}'.format(artist, album)]
+        elif depth == 2:
+            parts = [artist, album]
+        else:
+            parts = [safe_filename(genre), artist, album]
+            if depth >= 4:
+                parts.append('CD {}'.format(rng.randint(1, 2)))
+        return os.path.join(self.root, *parts)
+
+    def write_playlists(self, rng, paths):
+        """Write playlists of 20 to 2000 entries (one of up to 20000) in
+        every supported format, with relative, absolute and missing
+        entries. Returns: list of the playlists' names"""
+        folder = os.path.join(self.root, 'Playlists')
+        os.makedirs(folder, exist_ok=True)
+        names = []
+        formats = ['m3u8', 'm3u', 'xspf', 'asx', 'b4s']
+        for i in range(self.params['playlists']):
+            name = '{} {}'.format(make_name(rng, 1, 3), i)
+            size = (min(20000, len(paths)) if i == 0
+                    else min(rng.randint(20, 2000), len(paths)))
+            entries = rng.sample(paths, size)
+            # a few entries point at files that were since deleted
+            entries += [os.path.join(self.root, 'gone', '{}.mp3'.format(n))
+                        for n in range(max(1, size // 100))]
+            extension = formats[i % len(formats)]
+            path = os.path.join(folder, '{}.{}'.format(
+                safe_filename(name), extension))
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write(self.playlist_text(extension, entries, folder))
+            names.append(name)
+        return names
+
+    def playlist_text(self, extension, entries, folder):
+        if extension in ('m3u', 'm3u8'):
+            return '#EXTM3U\n' + ''.join(
+                os.path.relpath(entry, folder) + '\n' for entry in entries)
+        if extension == 'xspf':
+            return ('<?xml version="1.0" encoding="UTF-8"?>\n'
+                    '<playlist version="1" xmlns="http://xspf.org/ns/0/">'
+                    '<trackList>\n' + ''.join(
+                        '<track><location>file://{}</location></track>\n'
+                        .format(quote(entry)) for entry in entries) +
+                    '</trackList></playlist>\n')
+        if extension == 'asx':
+            return '<asx version="3.0">\n' + ''.join(
+                '<entry><ref href="{}"/></entry>\n'.format(
+                    escape(entry)) for entry in entries) + '</asx>\n'
+        return ('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+                '<WinampXML><playlist num_entries="{}">\n'.format(
+                    len(entries)) + ''.join(
+                    '<entry Playstring="file:{}"/>\n'.format(escape(entry))
+                    for entry in entries) + '</playlist></WinampXML>\n')
+
+
+def escape(text):
+    return (text.replace('&', '&amp;').replace('"', '&quot;')
+            .replace('<', '&lt;').replace('>', '&gt;'))
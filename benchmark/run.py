@@ -0,0 +1,346 @@
+"""Benchmark the offline playback skill on synthetic libraries.
+
+For every library size a library is generated (see library_generator;
+an identical library from an earlier run is reused) and, in a fresh
+process so peak memory is measured per size:
+
+- load_database is timed for a first scan, a tags-only first scan and
+  the pass reading the durations after it, an unchanged rescan and
+  startups from the SQLite index and from the snapshot
+- every search_* method, generic_query and CPS_match_query_phrase are
+  timed on queries drawn from the library's names: exact names, names
+  with a typo and names that aren't in the library
+
+Results are written as JSON (p50/p95/p99 latency in ms, throughput and
+peak RSS) so runs can be compared between releases. Run it from a Python
+environment with mycroft-core installed:
+
+    python benchmark/run.py --sizes 1000 10000 100000 \\
+        --output bench_output.txt
+
+The music files are written by the generator just before the first scan,
+so that scan mostly reads from the page cache.
+"""
+import argparse
+import importlib
+import importlib.util
+import json
+import logging
+import math
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import types
+from os.path import abspath, dirname, join
+
+sys.path.insert(0, dirname(abspath(__file__)))
+from library_generator import LibraryGenerator, make_name  # noqa: E402
+
+
+BENCHMARK_VERSION = 1
+SKILL_DIR = dirname(dirname(abspath(__file__)))
+PACKAGE = 'offline_playback_skill'
+
+SEARCHES = {
+    'search_tracks': 'titles',
+    'search_artists': 'artists',
+    'search_albums': 'albums',
+    'search_genres': 'genres',
+    'search_playlists': 'playlists',
+}
+PHRASES = ['{title}', '{title} by {artist}', 'the song {title}',
+           'the artist {artist}', 'something by {artist}',
+           'the album {album}', 'the album {album} by {artist}',
+           'the playlist {playlist}', '{genre} music', '{title} locally']
+
+
+def load_package():
+    """Import the skill folder as a package without running its
+    __init__ (which needs a running Mycroft), so the database modules
+    can be benchmarked on their own."""
+    if PACKAGE not in sys.modules:
+        package = types.ModuleType(PACKAGE)
+        package.__path__ = [SKILL_DIR]
+        sys.modules[PACKAGE] = package
+    return sys.modules[PACKAGE]
+
+
+def load_skill_module():
+    """Run the skill's __init__ into the package. Returns: the package"""
+    package = load_package()
+    if not hasattr(package, 'create_skill'):
+        spec = importlib.util.spec_from_file_location(
+            PACKAGE, join(SKILL_DIR, '__init__.py'),
+            submodule_search_locations=[SKILL_DIR])
+        package.__spec__ = spec
+        package.__file__ = spec.origin
+        spec.loader.exec_module(package)
+    return package
+
+
+def peak_rss_kb():
+    # kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def summarize(times):
+    """Returns: latency percentiles (ms) and throughput of timed calls"""
+    if not times:
+        return {'count': 0}
+    ordered = sorted(times)
+
+    def percentile(share):
+        # nearest rank
+        rank = max(1, math.ceil(share * len(ordered)))
+        return round(ordered[rank - 1] * 1000, 3)
+
+    total = sum(ordered)
+    return {'count': len(ordered),
+            'total_s': round(total, 4),
+            'throughput_per_s': round(len(ordered) / total, 2)
+            if total else None,
+            'p50_ms': percentile(0.50),
+            'p95_ms': percentile(0.95),
+            'p99_ms': percentile(0.99),
+            'max_ms': round(ordered[-1] * 1000, 3)}
+
+
+def time_calls(function, arguments):
+    times = []
+    for argument in arguments:
+        start = time.perf_counter()
+        function(argument)
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def typo(rng, text):
+    if len(text) < 4:
+        return text
+    i = rng.randrange(1, len(text) - 1)
+    kind = rng.randrange(3)
+    if kind == 0:  # dropped letter
+        return text[:i] + text[i + 1:]
+    if kind == 1:  # swapped letters
+        return text[:i - 1] + text[i] + text[i - 1] + text[i + 1:]
+    return text[:i] + rng.choice('aeiourstln') + text[i + 1:]
+
+
+def make_queries(rng, names, count):
+    """Returns: 'count' lowercased queries, 60% exact names, 30% names
+    with a typo and 10% names that aren't in the library"""
+    queries = []
+    for i in range(count):
+        share = i % 10
+        if share < 6 and names:
+            query = rng.choice(names)
+        elif share < 9 and names:
+            query = typo(rng, rng.choice(names))
+        else:
+            query = make_name(rng, 2, 4)
+        queries.append(query.lower())
+    return queries
+
+
+def make_phrases(rng, manifest, count):
+    phrases = []
+    for i in range(count):
+        template = PHRASES[i % len(PHRASES)]
+        values = {'title': rng.choice(manifest['titles'] or ['song']),
+                  'artist': rng.choice(manifest['artists'] or ['artist']),
+                  'album': rng.choice(manifest['albums'] or ['album']),
+                  'playlist': rng.choice(manifest['playlists'] or ['mix']),
+                  'genre': rng.choice(manifest['genres'] or ['rock'])}
+        if i % 3 == 2:
+            values = {key: typo(rng, value) for key, value in values.items()}
+        phrases.append(template.format(**values).lower())
+    return phrases
+
+
+def benchmark_load(database_module, root, work_dir, workers):
+    SongDatabase = database_module.SongDatabase
+    index_path = join(work_dir, 'library.db')
+    results = {}
+
+    database = SongDatabase(index_path=index_path, scan_workers=workers)
+    start = time.perf_counter()
+    summary = database.load_database(root)
+    elapsed = time.perf_counter() - start
+    files = summary['added'] if summary else 0
+    results['first_scan'] = {'seconds': round(elapsed, 4),
+                             'files': files,
+                             'files_per_s': round(files / elapsed, 1),
+                             'tracks': len(database.track_records)}
+
+    # the same scan in two phases: tags only, then the durations
+    two_phase = SongDatabase(index_path=join(work_dir, 'two-phase.db'),
+                             scan_workers=workers)
+    two_phase.snapshot_path = None
+    start = time.perf_counter()
+    summary = two_phase.load_database(root, details=False)
+    elapsed = time.perf_counter() - start
+    files = summary['added'] if summary else 0
+    results['tags_only_scan'] = {'seconds': round(elapsed, 4),
+                                 'files': files,
+                                 'files_per_s': round(files / elapsed, 1)}
+    summary = two_phase.read_details()
+    results['details_pass'] = {
+        'seconds': round(summary['elapsed'], 4),
+        'files': summary['read'],
+        'files_per_s': round(summary['read'] / summary['elapsed'], 1)
+        if summary['elapsed'] else 0.0}
+    two_phase.index.close()
+
+    start = time.perf_counter()
+    database.rescan(root)
+    results['unchanged_rescan'] = {
+        'seconds': round(time.perf_counter() - start, 4)}
+
+    from_index = SongDatabase(index_path=index_path, scan_workers=workers)
+    from_index.snapshot_path = None
+    start = time.perf_counter()
+    from_index.load_database(root)
+    results['start_from_index'] = {
+        'seconds': round(time.perf_counter() - start, 4)}
+
+    from_snapshot = SongDatabase(index_path=index_path, scan_workers=workers)
+    start = time.perf_counter()
+    from_snapshot.load_database(root)
+    results['start_from_snapshot'] = {
+        'seconds': round(time.perf_counter() - start, 4),
+        'used_snapshot': from_snapshot.snapshot is not None}
+    return database, results
+
+
+def benchmark_size(args, size):
+    """Run every benchmark on a library of 'size' tracks.
+    Returns: dict of results"""
+    logging.disable(logging.INFO)
+    rng = random.Random(args.seed)
+    root = join(args.library_dir, 'library-{}'.format(size))
+    generator = LibraryGenerator(root, tracks=size, seed=args.seed,
+                                 depth=args.depth)
+    start = time.perf_counter()
+    manifest = generator.generate()
+    result = {'size': size,
+              'library': {'files': manifest['files'],
+                          'bytes': manifest['bytes'],
+                          'params': manifest['params'],
+                          'generate_s': round(time.perf_counter() - start,
+                                              2)},
+              'rss_kb': {'before_load': peak_rss_kb()}}
+
+    load_package()
+    database_module = importlib.import_module(
+        PACKAGE + '.song_database_manager')
+    work_dir = tempfile.mkdtemp(prefix='offline-playback-bench-')
+    try:
+        database, result['load'] = benchmark_load(
+            database_module, root, work_dir, args.workers)
+        result['rss_kb']['after_load'] = peak_rss_kb()
+        result['memory_report'] = database.memory_report()
+
+        queries = {}
+        for method, kind in SEARCHES.items():
+            queries[method] = summarize(time_calls(
+                getattr(database, method),
+                make_queries(rng, manifest[kind], args.queries)))
+
+        phrases = make_phrases(rng, manifest, args.queries)
+        try:
+            package = load_skill_module()
+            skill = package.create_skill()
+            skill.song_database = database
+            skill.load_regexes()
+            queries['generic_query'] = summarize(
+                time_calls(skill.generic_query, phrases))
+            queries['CPS_match_query_phrase'] = summarize(
+                time_calls(skill.CPS_match_query_phrase, phrases))
+        except Exception as e:
+            # the skill itself needs mycroft-core and its configuration
+            result['skill_error'] = repr(e)
+        result['queries'] = queries
+        result['rss_kb']['peak'] = peak_rss_kb()
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return result
+
+
+def run_in_child(args, size):
+    """Run benchmark_size in a forked process, so every size starts with
+    the same memory and peak RSS is per size."""
+    if not hasattr(os, 'fork'):
+        return benchmark_size(args, size)
+    context = multiprocessing.get_context('fork')
+    results = context.Queue()
+
+    def child():
+        try:
+            results.put(benchmark_size(args, size))
+        except Exception as e:
+            results.put({'size': size, 'error': repr(e)})
+
+    process = context.Process(target=child)
+    process.start()
+    result = results.get()
+    process.join()
+    return result
+
+
+def skill_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=SKILL_DIR,
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000],
+                        help='library sizes in tracks (default 1000 10000)')
+    parser.add_argument('--queries', type=int, default=200,
+                        help='queries timed per method (default 200)')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--depth', type=int, default=2,
+                        help='folder levels above the files (1-4)')
+    parser.add_argument('--workers', type=int, default=4,
+                        help='scan_workers of the database')
+    parser.add_argument('--library-dir',
+                        default=join(tempfile.gettempdir(),
+                                     'offline-playback-bench'),
+                        help='where libraries are generated and kept')
+    parser.add_argument('--output', help='JSON file to write (default: '
+                                         'print the JSON)')
+    args = parser.parse_args(argv)
+
+    report = {'benchmark_version': BENCHMARK_VERSION,
+              'created': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+              'revision': skill_revision(),
+              'python': platform.python_version(),
+              'platform': platform.platform(),
+              'cpu_count': os.cpu_count(),
+              'args': vars(args),
+              'results': []}
+    for size in args.sizes:
+        print('Benchmarking {} tracks...'.format(size), file=sys.stderr)
+        report['results'].append(run_in_child(args, size))
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,247 @@
+import hashlib
+import io
+import os
+import queue
+import threading
+import time
+from collections import OrderedDict
+
+from mycroft.util.log import LOG
+from tinytag import TinyTag
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+
+# Longest side of a thumbnail, in pixels
+THUMBNAIL_SIZE = 300
+# Without PIL images are stored as they are, if they aren't bigger than this
+MAX_UNSCALED_BYTES = 512 * 1024
+# Image files looked for next to the music when a file has no embedded art
+FOLDER_IMAGES = ('cover', 'folder', 'front', 'album', 'albumart')
+FOLDER_IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+# A served thumbnail's modification time is refreshed (so its place in the
+# eviction order survives a restart) when it is older than this
+TOUCH_INTERVAL = 24 * 60 * 60
+
+
+def image_extension(data):
+    """Returns: '.jpg' or '.png' for JPEG or PNG data, else None"""
+    if data.startswith(b'\xff\xd8'):
+        return '.jpg'
+    if data.startswith(b'\x89PNG'):
+        return '.png'
+    return None
+
+
+def embedded_image(file_path):
+    """Returns: the embedded cover image of a music file as bytes, or None"""
+    # images are read along with the tags, so those can't be skipped
+    tag = TinyTag.get(file_path, duration=False, image=True)
+    images = getattr(tag, 'images', None)
+    if images is not None:
+        # tinytag 2
+        image = images.front_cover or images.any
+        return image.data if image else None
+    return tag.get_image()
+
+
+def folder_image(folder):
+    """Returns: path of a cover image file in 'folder' (cover.jpg,
+    folder.png, ...), or None"""
+    try:
+        names = os.listdir(folder)
+    except OSError:
+        return None
+    found = {}
+    for name in names:
+        stem, extension = os.path.splitext(name.lower())
+        if extension in FOLDER_IMAGE_EXTENSIONS and stem in FOLDER_IMAGES:
+            found[stem] = name
+    for stem in FOLDER_IMAGES:
+        if stem in found:
+            return os.path.join(folder, found[stem])
+    return None
+
+
+class CoverArtCache:
+    """Album cover thumbnails, extracted once per album in the background.
+
+    lookup() only looks in memory: it returns the thumbnail of a track's
+    album if there is one and otherwise queues the album for the worker
+    thread, which reads the embedded art (or a cover.jpg/folder.png next to
+    the files), scales it down with PIL if that is installed and stores it
+    as a file. The files are kept under 'budget' bytes by deleting the
+    least recently used ones.
+    """
+    def __init__(self, folder, budget=50 * 1024 * 1024,
+                 size=THUMBNAIL_SIZE, on_ready=None):
+        """Arguments:
+            folder (str): where the thumbnails are stored
+            budget (int): most bytes the thumbnails may take up
+            size (int):   longest side of a thumbnail, in pixels
+            on_ready (function): called with the track's file path when a
+                                 cover it was queued for has been stored
+        """
+        self.folder = folder
+        self.budget = budget
+        self.size = size
+        self.on_ready = on_ready
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # key -> [file name, bytes, last use]
+        self.total = 0
+        self.missing = set()  # keys of albums without any art
+        self.pending = set()
+        self.jobs = queue.Queue()
+        self.stopping = threading.Event()
+        self.thread = None
+        self.load()
+
+    def load(self):
+        """Index the thumbnails saved earlier, least recently used first."""
+        os.makedirs(self.folder, exist_ok=True)
+        files = []
+        for name in os.listdir(self.folder):
+            key, extension = os.path.splitext(name)
+            if extension not in ('.jpg', '.png'):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.folder, name))
+            except OSError:
+                continue
+            files.append((stat.st_mtime, key, name, stat.st_size))
+        for mtime, key, name, size in sorted(files):
+            self.entries[key] = [name, size, mtime]
+            self.total += size
+        self.evict()
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+        self.jobs.put(None)
+        if self.thread:
+            self.thread.join(timeout=5)
+
+    def key(self, file_path, album):
+        """Tracks of the same album in the same folder share a cover"""
+        text = '{}\0{}'.format(os.path.dirname(file_path), album or '')
+        return hashlib.sha1(text.encode('utf-8', 'surrogateescape')
+                            ).hexdigest()[:24]
+
+    def lookup(self, file_path, album=None):
+        """Returns: path of the thumbnail for the track's album, or '' if
+        there is none (yet). Albums not looked at yet are queued."""
+        if not file_path:
+            return ''
+        key = self.key(file_path, album)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry:
+                self.entries.move_to_end(key)
+                now = time.time()
+                if now - entry[2] > TOUCH_INTERVAL:
+                    entry[2] = now
+                    touch(os.path.join(self.folder, entry[0]))
+                return os.path.join(self.folder, entry[0])
+            if key not in self.missing and key not in self.pending:
+                self.pending.add(key)
+                self.jobs.put((key, file_path))
+        return ''
+
+    def run(self):
+        while True:
+            job = self.jobs.get()
+            if job is None or self.stopping.is_set():
+                return
+            key, file_path = job
+            try:
+                stored = self.extract(key, file_path)
+            except Exception as e:
+                LOG.info('No cover art for {}: {}'.format(file_path,
+                                                          repr(e)))
+                stored = False
+            with self.lock:
+                self.pending.discard(key)
+                if not stored:
+                    self.missing.add(key)
+            if stored and self.on_ready:
+                self.on_ready(file_path)
+
+    def extract(self, key, file_path):
+        """Find, scale and store the cover of a track's album.
+        Returns: True if a thumbnail was stored"""
+        data = None
+        try:
+            data = embedded_image(file_path)
+        except Exception as e:
+            LOG.debug('Could not read art of {}: {}'.format(file_path,
+                                                            repr(e)))
+        if not data:
+            image_path = folder_image(os.path.dirname(file_path))
+            if image_path:
+                with open(image_path, 'rb') as f:
+                    data = f.read()
+        if not data:
+            return False
+        data, extension = self.thumbnail(data)
+        if not data:
+            return False
+
+        name = key + extension
+        path = os.path.join(self.folder, name)
+        with open(path + '.tmp', 'wb') as f:
+            f.write(data)
+        os.replace(path + '.tmp', path)
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old:
+                self.total -= old[1]
+                if old[0] != name:
+                    remove(os.path.join(self.folder, old[0]))
+            self.entries[key] = [name, len(data), time.time()]
+            self.total += len(data)
+            self.evict()
+        return True
+
+    def thumbnail(self, data):
+        """Returns: (image bytes, extension) of the image scaled down to
+        fit 'size', or (None, None) if it can't be used"""
+        if Image is None:
+            extension = image_extension(data)
+            if extension and len(data) <= MAX_UNSCALED_BYTES:
+                return data, extension
+            return None, None
+        image = Image.open(io.BytesIO(data))
+        image.thumbnail((self.size, self.size))
+        if image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+        output = io.BytesIO()
+        image.save(output, 'JPEG', quality=85)
+        return output.getvalue(), '.jpg'
+
+    def evict(self):
+        """Delete least recently used thumbnails until the budget is met.
+        Call with the lock held (or before the worker is started)."""
+        while self.total > self.budget and self.entries:
+            key, (name, size, last_use) = self.entries.popitem(last=False)
+            self.total -= size
+            remove(os.path.join(self.folder, name))
+
+
+def touch(path):
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+
+
+def remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
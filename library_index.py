@@ -0,0 +1,250 @@
+import os
+import random
+import sqlite3
+import threading
+
+
+# Bump this whenever the table layout changes. An index written with a
+# different version is thrown away and rebuilt by the next scan.
+SCHEMA_VERSION = 3
+
+# Tag fields kept for every track, in column order. 'detailed' is 1 once
+# duration, bitrate and samplerate were read (see SongDatabase.read_details)
+TRACK_FIELDS = ('path', 'title', 'artist', 'album', 'albumartist', 'genre',
+                'year', 'track', 'duration', 'size', 'mtime', 'bitrate',
+                'samplerate', 'detailed')
+
+
+class LibraryIndex:
+    """Persistent on-disk copy of the scanned music library.
+
+    Tracks (with all of their tag fields) and playlists are stored in a
+    SQLite database so the skill can rebuild its search dicts at startup
+    without walking the music directory and opening every file again.
+    """
+    def __init__(self, db_path=None):
+        """Arguments:
+            db_path (str): location of the database file. None keeps the
+                           index in memory only (nothing is persisted).
+        """
+        self.db_path = db_path or ':memory:'
+        if db_path:
+            os.makedirs(os.path.dirname(os.path.abspath(db_path)),
+                        exist_ok=True)
+        self.lock = threading.RLock()
+        self.connection = sqlite3.connect(self.db_path,
+                                          check_same_thread=False)
+        self.connection.row_factory = sqlite3.Row
+        self._create_tables()
+
+    def _create_tables(self):
+        with self.lock, self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS meta '
+                                    '(key TEXT PRIMARY KEY, value TEXT)')
+            version = self.get_meta('schema_version')
+            if version is not None and version != str(SCHEMA_VERSION):
+                self.connection.execute('DROP TABLE IF EXISTS tracks')
+                self.connection.execute('DROP TABLE IF EXISTS playlists')
+                self.connection.execute('DROP TABLE IF EXISTS directories')
+                self.connection.execute('DROP TABLE IF EXISTS quarantine')
+                self.connection.execute('DELETE FROM meta')
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS tracks ('
+                'path TEXT PRIMARY KEY, title TEXT, artist TEXT, '
+                'album TEXT, albumartist TEXT, genre TEXT, year TEXT, '
+                'track TEXT, duration REAL, size INTEGER, mtime REAL, '
+                'bitrate REAL, samplerate INTEGER, detailed INTEGER)')
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS playlists ('
+                'path TEXT PRIMARY KEY, name TEXT, size INTEGER, '
+                'mtime REAL)')
+            # subdirs is a newline separated list of the directory's
+            # subfolders, so unchanged folders don't need to be listed again
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS directories ('
+                'path TEXT PRIMARY KEY, mtime REAL, subdirs TEXT)')
+            # files whose tags couldn't be read (in time), skipped by scans
+            # until their size or modification time changes
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS quarantine ('
+                'path TEXT PRIMARY KEY, size INTEGER, mtime REAL, '
+                'reason TEXT, seconds REAL, time REAL)')
+            self.set_meta('schema_version', SCHEMA_VERSION)
+            if self.get_meta('generation') is None:
+                # random start, so a new index never matches an old snapshot
+                self.set_meta('generation', random.getrandbits(62))
+
+    def get_meta(self, key, default=None):
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row['value'] if row else default
+
+    def set_meta(self, key, value):
+        with self.lock, self.connection:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)',
+                (key, str(value)))
+
+    def generation(self):
+        """Returns: a number that changes whenever tracks or playlists are
+        added, changed or removed, to tell whether a snapshot of the index
+        (see snapshot.py) is still up to date"""
+        return int(self.get_meta('generation'))
+
+    def _bump_generation(self):
+        self.connection.execute(
+            'INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)',
+            ('generation', (self.generation() + 1) % (1 << 63)))
+
+    def is_complete(self):
+        """Returns: whether a scan ran to the end. An interrupted first
+        scan leaves the files it read, but no folder listing."""
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT EXISTS (SELECT 1 FROM directories)').fetchone()
+        return bool(row[0])
+
+    def load_tracks(self):
+        """Returns: list of dicts, one per indexed track, keyed by
+        TRACK_FIELDS."""
+        with self.lock:
+            rows = self.connection.execute(
+                'SELECT {} FROM tracks'.format(', '.join(TRACK_FIELDS)))
+            return [dict(row) for row in rows]
+
+    def load_playlists(self):
+        """Returns: list of dicts with 'path', 'name', 'size' and 'mtime'."""
+        with self.lock:
+            rows = self.connection.execute(
+                'SELECT path, name, size, mtime FROM playlists')
+            return [dict(row) for row in rows]
+
+    def load_directories(self):
+        """Returns: dict of directory path -> (mtime, list of subfolders)"""
+        with self.lock:
+            rows = self.connection.execute(
+                'SELECT path, mtime, subdirs FROM directories')
+            return {row['path']: (row['mtime'],
+                                  row['subdirs'].split('\n')
+                                  if row['subdirs'] else [])
+                    for row in rows}
+
+    def load_quarantine(self):
+        """Returns: dict of file path -> dict with the 'size' and 'mtime'
+        the file had, the 'reason' it was quarantined, the 'seconds' its
+        read took and the 'time' it was quarantined"""
+        with self.lock:
+            rows = self.connection.execute(
+                'SELECT path, size, mtime, reason, seconds, time '
+                'FROM quarantine')
+            return {row['path']: dict(row) for row in rows}
+
+    def save_quarantine(self, entries):
+        """Quarantine files, replacing older entries for them.
+
+        Arguments:
+            entries (list): dicts keyed like those of load_quarantine, plus
+                            'path'
+        """
+        with self.lock, self.connection:
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO quarantine '
+                '(path, size, mtime, reason, seconds, time) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                ((entry['path'], entry['size'], entry['mtime'],
+                  entry['reason'], entry['seconds'], entry['time'])
+                 for entry in entries))
+
+    def save_records(self, tracks, playlists):
+        """Add or update track and playlist dicts. Scans call this in
+        batches so a scan that is interrupted doesn't have to start over."""
+        with self.lock, self.connection:
+            self._insert(tracks, playlists)
+            self._bump_generation()
+
+    def undetailed_paths(self):
+        """Returns: list of the paths of the tracks whose duration, bitrate
+        and sample rate haven't been read yet"""
+        with self.lock:
+            rows = self.connection.execute(
+                'SELECT path FROM tracks WHERE NOT detailed')
+            return [row['path'] for row in rows]
+
+    def save_details(self, details):
+        """Store the duration, bitrate and sample rate read for tracks.
+
+        Arguments:
+            details (list): (path, duration, bitrate, samplerate) tuples;
+                            None values are stored for files that couldn't
+                            be read, so they aren't tried again
+        """
+        with self.lock, self.connection:
+            self.connection.executemany(
+                'UPDATE tracks SET duration = ?, bitrate = ?, '
+                'samplerate = ?, detailed = 1 WHERE path = ?',
+                ((duration, bitrate, samplerate, path)
+                 for path, duration, bitrate, samplerate in details))
+            self._bump_generation()
+
+    def remove_records(self, paths):
+        """Forget the tracks and playlists stored for these file paths."""
+        with self.lock, self.connection:
+            self.connection.executemany('DELETE FROM tracks WHERE path = ?',
+                                        ((path,) for path in paths))
+            self.connection.executemany('DELETE FROM playlists WHERE path = ?',
+                                        ((path,) for path in paths))
+            self.connection.executemany(
+                'DELETE FROM quarantine WHERE path = ?',
+                ((path,) for path in paths))
+            self._bump_generation()
+
+    def save_directories(self, directory, directories):
+        """Store the folder listing of a finished scan.
+
+        Arguments:
+            directory (str):    music directory the scan was run on
+            directories (dict): every scanned directory, as returned by
+                                load_directories
+        """
+        with self.lock, self.connection:
+            self.connection.execute('DELETE FROM directories')
+            self.connection.executemany(
+                'INSERT INTO directories (path, mtime, subdirs) '
+                'VALUES (?, ?, ?)',
+                ((path, mtime, '\n'.join(subdirs))
+                 for path, (mtime, subdirs) in directories.items()))
+            self.connection.execute(
+                'INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)',
+                ('directory', directory))
+
+    def clear(self):
+        """Forget everything, e.g. when the music directory changes."""
+        with self.lock, self.connection:
+            self.connection.execute('DELETE FROM tracks')
+            self.connection.execute('DELETE FROM playlists')
+            self.connection.execute('DELETE FROM directories')
+            self.connection.execute('DELETE FROM quarantine')
+            self.connection.execute("DELETE FROM meta WHERE key = 'directory'")
+            self._bump_generation()
+
+    def _insert(self, tracks, playlists):
+        self.connection.executemany(
+            'INSERT OR REPLACE INTO tracks ({}) VALUES ({})'.format(
+                ', '.join(TRACK_FIELDS),
+                ', '.join('?' * len(TRACK_FIELDS))),
+            ([track.get(field) for field in TRACK_FIELDS]
+             for track in tracks))
+        self.connection.executemany(
+            'INSERT OR REPLACE INTO playlists (path, name, size, mtime) '
+            'VALUES (?, ?, ?, ?)',
+            ((p['path'], p['name'], p.get('size'), p.get('mtime'))
+             for p in playlists))
+        # read fine this time
+        self.connection.executemany(
+            'DELETE FROM quarantine WHERE path = ?',
+            [(record['path'],) for record in list(tracks) + list(playlists)])
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
@@ -0,0 +1,273 @@
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import threading
+import time
+
+from mycroft.util.log import LOG
+
+
+# inotify event flags, see <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o0004000
+IN_CLOEXEC = 0o2000000
+
+# Files are picked up once they are closed after writing (or moved into
+# place, which is how rsync and most downloaders finish a file), so a file
+# being copied produces one event instead of one per write.
+WATCH_MASK = (IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE |
+              IN_DELETE | IN_DELETE_SELF | IN_ONLYDIR)
+
+EVENT_HEADER = struct.Struct('iIII')
+
+# Filesystems where inotify doesn't see changes made by other machines
+NETWORK_FILESYSTEMS = ('nfs', 'nfs4', 'cifs', 'smbfs', 'smb3', 'afs', '9p',
+                       'fuse.sshfs', 'fuse.rclone', 'davfs', 'ceph',
+                       'glusterfs')
+
+
+class WatchError(Exception):
+    pass
+
+
+def filesystem_type(path):
+    """Returns: the type of the filesystem 'path' is on (e.g. 'ext4',
+    'nfs4') according to /proc/mounts, or None if it can't be told."""
+    path = os.path.realpath(path)
+    best, fs_type = '', None
+    try:
+        with open('/proc/mounts') as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) < 3:
+                    continue
+                # spaces in mount points are escaped as \040
+                mount_point = fields[1].replace('\\040', ' ')
+                if ((path == mount_point or
+                     path.startswith(mount_point.rstrip('/') + '/')) and
+                        len(mount_point) >= len(best)):
+                    best, fs_type = mount_point, fields[2]
+    except OSError:
+        return None
+    return fs_type
+
+
+class Inotify:
+    """Minimal ctypes wrapper around the Linux inotify API."""
+    def __init__(self):
+        libc_name = ctypes.util.find_library('c')
+        if not libc_name:
+            raise WatchError('libc not found')
+        self.libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(self.libc, 'inotify_init1'):
+            raise WatchError('inotify is not supported on this system')
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise WatchError(os.strerror(ctypes.get_errno()))
+
+    def add_watch(self, path, mask):
+        """Returns: watch descriptor, or None if the folder is gone.
+        Raises WatchError when the system runs out of watches."""
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            error = ctypes.get_errno()
+            if error in (errno.ENOENT, errno.ENOTDIR, errno.EACCES):
+                return None
+            raise WatchError('{}: {}'.format(path, os.strerror(error)))
+        return wd
+
+    def read_events(self):
+        """Returns: list of (watch descriptor, mask, name) tuples"""
+        try:
+            data = os.read(self.fd, 256 * 1024)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset + EVENT_HEADER.size <= len(data):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = data[offset:offset + length].split(b'\0', 1)[0]
+            offset += length
+            events.append((wd, mask, os.fsdecode(name)))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class LibraryWatcher:
+    """Keeps a SongDatabase up to date with changes in the music directory.
+
+    inotify is used where it works; on network mounts (or if inotify can't
+    be set up, e.g. because there are more folders than allowed watches) the
+    directory is polled with SongDatabase.rescan instead, which only lists
+    folders whose modification time changed.
+
+    Changed paths are collected and handed to SongDatabase.update_files in
+    batches once events have settled for 'settle' seconds (or every
+    'max_delay' seconds during a long copy), so thousands of new files
+    don't cause thousands of updates.
+    """
+    def __init__(self, song_database, directory, on_change=None,
+                 settle=2.0, max_delay=30.0, poll_interval=300.0):
+        """Arguments:
+            song_database (SongDatabase): database to keep up to date
+            directory (str):    music directory to watch
+            on_change (function): called with the update summary after
+                                  each batch that changed something
+            settle (float):     seconds without events before a batch is
+                                applied
+            max_delay (float):  longest time to hold back a batch
+            poll_interval (float): seconds between rescans when polling
+        """
+        self.song_database = song_database
+        self.directory = directory
+        self.on_change = on_change
+        self.settle = settle
+        self.max_delay = max_delay
+        self.poll_interval = poll_interval
+        self.mode = None
+        self.inotify = None
+        self.watches = {}  # watch descriptor -> folder
+        self.pending = set()
+        self.first_event = None
+        self.last_event = None
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def start(self):
+        if filesystem_type(self.directory) in NETWORK_FILESYSTEMS:
+            self.mode = 'polling'
+        else:
+            try:
+                self.inotify = Inotify()
+                folders = list(self.song_database.index.load_directories())
+                for folder in folders or [self.directory]:
+                    self.watch_tree(folder, recursive=not folders)
+                self.mode = 'inotify'
+            except (WatchError, OSError):
+                self.close_inotify()
+                self.mode = 'polling'
+
+        target = self.run_inotify if self.mode == 'inotify' else self.run_polling
+        self.thread = threading.Thread(target=target, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+        if self.thread:
+            self.thread.join(timeout=5)
+        self.close_inotify()
+
+    def close_inotify(self):
+        if self.inotify:
+            self.inotify.close()
+            self.inotify = None
+        self.watches = {}
+
+    def watch_tree(self, folder, recursive=True):
+        """Add watches for a folder (and everything below it)."""
+        folders = os.walk(folder) if recursive else [(folder, None, None)]
+        for path, subfolders, files in folders:
+            wd = self.inotify.add_watch(path, WATCH_MASK)
+            if wd is not None:
+                self.watches[wd] = path
+
+    def forget_tree(self, folder):
+        """Drop the watch paths of a folder that was moved away. The kernel
+        keeps the watches; if the folder shows up again it is re-added."""
+        prefix = folder.rstrip(os.sep) + os.sep
+        for wd, path in list(self.watches.items()):
+            if path == folder or path.startswith(prefix):
+                del self.watches[wd]
+
+    def run_inotify(self):
+        while not self.stopping.is_set():
+            try:
+                ready, _, _ = select.select([self.inotify.fd], [], [], 0.5)
+                if ready:
+                    self.handle_events(self.inotify.read_events())
+            except WatchError:
+                # out of watches for new folders: keep going by polling
+                self.close_inotify()
+                self.mode = 'polling'
+                self.pending.add(self.directory)
+                self.flush()
+                self.run_polling()
+                return
+            if self.batch_due():
+                self.flush()
+
+    def handle_events(self, events):
+        now = time.monotonic()
+        for wd, mask, name in events:
+            if mask & IN_Q_OVERFLOW:
+                # events were lost; let update_files walk everything
+                self.pending.add(self.directory)
+                continue
+            if mask & IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+            folder = self.watches.get(wd)
+            if folder is None:
+                continue
+            path = os.path.join(folder, name) if name else folder
+
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    self.watch_tree(path)
+                elif mask & IN_MOVED_FROM:
+                    self.forget_tree(path)
+            elif mask & IN_CREATE:
+                # a file was created; wait for IN_CLOSE_WRITE
+                continue
+            self.pending.add(path)
+
+        if self.pending:
+            self.first_event = self.first_event or now
+            self.last_event = now
+
+    def batch_due(self):
+        if not self.pending:
+            return False
+        now = time.monotonic()
+        return (now - self.last_event >= self.settle or
+                now - self.first_event >= self.max_delay)
+
+    def flush(self):
+        """Apply the collected changes to the database."""
+        paths = self.pending
+        self.pending = set()
+        self.first_event = self.last_event = None
+        try:
+            if self.directory in paths:
+                summary = self.song_database.rescan(self.directory)
+            else:
+                summary = self.song_database.update_files(paths)
+        except Exception as e:
+            LOG.exception('Updating the library failed: {}'.format(repr(e)))
+            return
+        self.report(summary)
+
+    def run_polling(self):
+        while not self.stopping.wait(self.poll_interval):
+            self.pending.add(self.directory)
+            self.flush()
+
+    def report(self, summary):
+        if self.on_change and (summary['added'] or summary['changed'] or
+                               summary['removed']):
+            self.on_change(summary)
@@ -0,0 +1,201 @@
+import json
+import math
+import random
+import threading
+import time
+
+
+# Durations kept per stage between two reports, for the percentiles
+MAX_SAMPLES = 512
+
+
+class NullSpan:
+    """Stand-in for Span when nothing is being traced."""
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+NULL_SPAN = NullSpan()
+
+
+class Span:
+    """Times one stage of the trace running in this thread."""
+    def __init__(self, trace, name):
+        self.trace = trace
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        elapsed = time.perf_counter() - self.start
+        self.trace.spans[self.name] = (self.trace.spans.get(self.name, 0.0) +
+                                       elapsed)
+        return False
+
+
+class Trace:
+    """Timings and counters of one traced call (e.g. one voice query)."""
+    def __init__(self, tracer, name, fields):
+        self.tracer = tracer
+        self.name = name
+        self.fields = fields
+        self.spans = {}  # stage -> seconds (summed if entered repeatedly)
+        self.counters = {}
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        self.tracer.local.trace = self
+        return self
+
+    def __exit__(self, *exc_info):
+        self.spans[self.name] = time.perf_counter() - self.start
+        self.tracer.local.trace = None
+        self.tracer.record(self)
+        return False
+
+
+class Tracer:
+    """Cheap per-stage timing of sampled calls.
+
+    A sampled call is wrapped in trace(); inside it (in the same thread)
+    span() times stages and count() adds to its counters. Outside a
+    sampled trace span() does nothing, so the instrumentation can stay in
+    place in production and its cost is set by the sample rate. Counts
+    made outside a trace (e.g. in the scan's worker threads) go straight
+    into the totals while the tracer is enabled.
+
+    Finished traces are summed up per stage until report() is called and,
+    if a trace file is set, written to it as one JSON object per line.
+    """
+    def __init__(self, sample_rate=0.0, trace_path=None):
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.sample_rate = sample_rate
+        self.trace_path = None
+        self.trace_file = None
+        self.configure(sample_rate, trace_path)
+        self.reset()
+
+    def configure(self, sample_rate=None, trace_path=None):
+        """Arguments:
+            sample_rate (float): share of calls to trace, 0 to 1
+            trace_path (str):    JSON-lines file to append traces to, or
+                                 None for no file
+        """
+        with self.lock:
+            if sample_rate is not None:
+                self.sample_rate = min(max(float(sample_rate), 0.0), 1.0)
+            if trace_path != self.trace_path:
+                if self.trace_file:
+                    self.trace_file.close()
+                self.trace_path = trace_path
+                self.trace_file = (open(trace_path, 'a', encoding='utf-8')
+                                   if trace_path else None)
+
+    def reset(self):
+        self.traces = 0
+        self.durations = {}  # stage -> list of seconds
+        self.totals = {}  # stage -> [calls, seconds, max seconds]
+        self.counters = {}
+        self.since = time.time()
+
+    def trace(self, name, always=False, **fields):
+        """Context manager tracing one call, if it is sampled.
+
+        Arguments:
+            name (str):     stage name of the whole call
+            always (bool):  trace whenever the tracer is enabled, for rare
+                            calls such as loading the library
+            fields:         extra values for the trace file
+        """
+        if (self.sample_rate <= 0 or getattr(self.local, 'trace', None) or
+                (not always and random.random() >= self.sample_rate)):
+            return NULL_SPAN
+        return Trace(self, name, fields)
+
+    def span(self, name):
+        trace = getattr(self.local, 'trace', None)
+        return Span(trace, name) if trace else NULL_SPAN
+
+    def count(self, name, amount=1):
+        trace = getattr(self.local, 'trace', None)
+        if trace:
+            trace.counters[name] = trace.counters.get(name, 0) + amount
+        elif self.sample_rate > 0:
+            with self.lock:
+                self.counters[name] = self.counters.get(name, 0) + amount
+
+    def observe(self, name, seconds, **fields):
+        """Record a duration measured across threads or events (which
+        trace() can't time), e.g. from a request to the first audio.
+        Recorded whenever the tracer is enabled."""
+        if self.sample_rate <= 0:
+            return
+        trace = Trace(self, name, fields)
+        trace.spans[name] = seconds
+        self.record(trace)
+
+    def record(self, trace):
+        with self.lock:
+            self.traces += 1
+            for stage, seconds in trace.spans.items():
+                totals = self.totals.setdefault(stage, [0, 0.0, 0.0])
+                totals[0] += 1
+                totals[1] += seconds
+                totals[2] = max(totals[2], seconds)
+                durations = self.durations.setdefault(stage, [])
+                if len(durations) < MAX_SAMPLES:
+                    durations.append(seconds)
+                else:
+                    # keep a uniform sample of the durations
+                    i = random.randrange(totals[0])
+                    if i < MAX_SAMPLES:
+                        durations[i] = seconds
+            for counter, amount in trace.counters.items():
+                self.counters[counter] = self.counters.get(counter, 0) + amount
+            if self.trace_file:
+                line = dict(trace.fields, name=trace.name, time=time.time(),
+                            spans_ms={stage: round(seconds * 1000, 3)
+                                      for stage, seconds in
+                                      trace.spans.items()},
+                            counters=trace.counters)
+                self.trace_file.write(json.dumps(line) + '\n')
+                self.trace_file.flush()
+
+    def report(self):
+        """Sum up the traces since the last report and start over.
+        Returns: dict for the metrics message"""
+        with self.lock:
+            stages = {}
+            for stage, (calls, seconds, longest) in self.totals.items():
+                durations = sorted(self.durations[stage])
+                stages[stage] = {
+                    'count': calls,
+                    'mean_ms': round(seconds / calls * 1000, 3),
+                    'p50_ms': round(percentile(durations, 0.5) * 1000, 3),
+                    'p95_ms': round(percentile(durations, 0.95) * 1000, 3),
+                    'max_ms': round(longest * 1000, 3)}
+            report = {'traces': self.traces,
+                      'sample_rate': self.sample_rate,
+                      'seconds': round(time.time() - self.since, 1),
+                      'stages': stages,
+                      'counters': dict(self.counters)}
+            self.reset()
+        return report
+
+    def close(self):
+        self.configure(trace_path=None)
+
+
+def percentile(ordered, share):
+    """Nearest-rank percentile of a sorted, non-empty list"""
+    return ordered[max(1, math.ceil(share * len(ordered))) - 1]
+
+
+# The skill's tracer; the database and the skill both report to it
+tracer = Tracer()
@@ -0,0 +1,148 @@
+import os
+import re
+import select
+import threading
+
+from mycroft.util.log import LOG
+
+
+# Where desktops and automounters put removable drives
+DRIVE_FOLDERS = ('/media/', '/run/media/', '/mnt/')
+
+UUID_FOLDER = '/dev/disk/by-uuid'
+
+# Spaces and the like are escaped as \ooo (octal) in /proc/mounts
+ESCAPE = re.compile(r'\\([0-7]{3})')
+
+
+def unescape(field):
+    return ESCAPE.sub(lambda m: chr(int(m.group(1), 8)), field)
+
+
+def filesystem_uuids():
+    """Returns: dict of device path -> filesystem UUID, from the symlinks
+    udev keeps in /dev/disk/by-uuid"""
+    uuids = {}
+    try:
+        names = os.listdir(UUID_FOLDER)
+    except OSError:
+        return uuids
+    for uuid in names:
+        device = os.path.realpath(os.path.join(UUID_FOLDER, uuid))
+        uuids[device] = uuid
+    return uuids
+
+
+def mounted_drives(drive_folders=DRIVE_FOLDERS):
+    """Returns: dict of filesystem UUID -> mount point of the drives mounted
+    below one of 'drive_folders'. Drives without a UUID are left out, as
+    they can't be recognized when they come back."""
+    drives = {}
+    uuids = None
+    try:
+        with open('/proc/mounts') as f:
+            lines = f.readlines()
+    except OSError:
+        return drives
+    for line in lines:
+        fields = line.split()
+        if len(fields) < 2 or not fields[0].startswith('/dev/'):
+            continue
+        mount_point = unescape(fields[1])
+        if not (mount_point + '/').startswith(drive_folders):
+            continue
+        if uuids is None:
+            uuids = filesystem_uuids()
+        uuid = uuids.get(os.path.realpath(fields[0]))
+        if uuid:
+            drives[uuid] = mount_point
+    return drives
+
+
+class MountWatcher:
+    """Reports drives being mounted and unmounted.
+
+    The kernel flags /proc/mounts whenever the mount table changes, so the
+    watcher sleeps in poll() until something is (un)mounted; every
+    'poll_interval' seconds the table is read anyway in case the flag isn't
+    supported.
+    """
+    def __init__(self, on_attach, on_detach, drive_folders=DRIVE_FOLDERS,
+                 poll_interval=10.0):
+        """Arguments:
+            on_attach (function): called as on_attach(uuid, mount point)
+                                  for each drive that was mounted
+            on_detach (function): called as on_detach(uuid, mount point)
+                                  for each drive that went away
+            drive_folders (tuple): folders removable drives are mounted in
+            poll_interval (float): longest time between two looks at the
+                                   mount table
+        """
+        self.on_attach = on_attach
+        self.on_detach = on_detach
+        self.drive_folders = drive_folders
+        self.poll_interval = poll_interval
+        self.drives = {}
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def mounted(self):
+        """Returns: dict of UUID -> mount point of the drives mounted now"""
+        return mounted_drives(self.drive_folders)
+
+    def start(self, known=None):
+        """Arguments:
+            known (dict): drives (as returned by mounted) the caller already
+                          handled; others that are mounted now are reported
+        """
+        self.drives = dict(known or {})
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+        if self.thread:
+            self.thread.join(timeout=5)
+
+    def run(self):
+        try:
+            mounts = open('/proc/mounts')
+        except OSError:
+            mounts = None
+        poller = select.poll()
+        if mounts:
+            poller.register(mounts, select.POLLPRI | select.POLLERR)
+        try:
+            self.check()
+            while not self.stopping.is_set():
+                # poll in short steps so stop() doesn't have to wait long
+                waited = 0.0
+                while waited < self.poll_interval and not (
+                        self.stopping.is_set() or poller.poll(500)):
+                    waited += 0.5
+                if mounts:
+                    mounts.seek(0)
+                    mounts.read()  # clears the change flag
+                if not self.stopping.is_set():
+                    self.check()
+        finally:
+            if mounts:
+                mounts.close()
+
+    def check(self):
+        """Compare the mount table with the drives seen last time."""
+        drives = self.mounted()
+        for uuid, mount_point in self.drives.items():
+            if drives.get(uuid) != mount_point:
+                self.report(self.on_detach, uuid, mount_point)
+        for uuid, mount_point in drives.items():
+            if self.drives.get(uuid) != mount_point:
+                self.report(self.on_attach, uuid, mount_point)
+        self.drives = drives
+
+    def report(self, callback, uuid, mount_point):
+        try:
+            callback(uuid, mount_point)
+        except Exception as e:
+            LOG.exception('Handling drive {} at {} failed: {}'.format(
+                uuid, mount_point, repr(e)))
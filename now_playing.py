@@ -0,0 +1,88 @@
+import threading
+import time
+
+
+# Seconds a status is trusted without a track change event; for a track of
+# known length, at least until it should have ended
+STATUS_TTL = 60.0
+# Seconds to wait for the audio service to answer a track info query
+STATUS_TIMEOUT = 0.5
+# Slack added to a track's duration before its status expires
+DURATION_SLACK = 10.0
+
+FIELDS = ('track', 'artist', 'album', 'image', 'path')
+
+
+def normalize_track_info(info):
+    """Turn an audio service track info reply (field names vary between
+    backends) into a status dict, or None if nothing is playing."""
+    if not info:
+        return None
+    artists = info.get('artists') or ['']
+    status = {'track': info.get('title') or info.get('name') or '',
+              'artist': info.get('artist') or artists[0] or '',
+              'album': info.get('album') or '',
+              'image': info.get('image') or '',
+              'path': None}
+    if not (status['track'] or status['artist']):
+        return None
+    return status
+
+
+class NowPlaying:
+    """Cache of what is playing.
+
+    The skill sets the status on every track change event, from the tags
+    it already has, so reading it costs nothing. Only when no event came
+    for a while (longer than the track should take) is the audio service
+    asked, through 'query', which should time out quickly.
+    """
+    def __init__(self, query, ttl=STATUS_TTL):
+        """Arguments:
+            query (function): returns the audio service's track info dict,
+                              or None when it didn't answer
+            ttl (float):      seconds a status is trusted by default
+        """
+        self.query = query
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.status = None
+        self.expires = 0.0
+
+    def set(self, status, duration=None):
+        """Arguments:
+            status (dict):    'track', 'artist', 'album', 'image' and the
+                              file 'path' (None when not known)
+            duration (float): length of the track in seconds, if known
+        Returns: True if the status changed"""
+        ttl = max(self.ttl, (duration or 0) + DURATION_SLACK)
+        with self.lock:
+            changed = status != self.status
+            self.status = status
+            self.expires = time.monotonic() + ttl
+        return changed
+
+    def clear(self):
+        """Nothing is playing. Returns: True if something was"""
+        with self.lock:
+            changed = self.status is not None
+            self.status = None
+            self.expires = float('inf')
+        return changed
+
+    def expire(self):
+        """Ask the audio service the next time the status is read."""
+        with self.lock:
+            self.expires = 0.0
+
+    def get(self):
+        """Returns: the status dict, or None if nothing is playing"""
+        with self.lock:
+            if time.monotonic() < self.expires:
+                return self.status
+        status = normalize_track_info(self.query())
+        if status:
+            self.set(status)
+        else:
+            self.clear()
+        return status
@@ -0,0 +1,182 @@
+import re
+import unicodedata
+from difflib import SequenceMatcher
+
+
+# Spelling rules applied (in order) before the consonant skeleton is taken.
+# They fold letters that sound alike in the language together, so that
+# speech recognition spelling a name the way it sounds ("shopin", "beat
+# alls") gives the same key as the name in the tags ("Chopin", "Beatles").
+# '0' stands for the "th" sound and 'x' for the "sh" sound.
+COMMON_RULES = [
+    (r'ph', 'f'),
+    (r'ck', 'k'),
+    (r'q', 'k'),
+    (r'x', 'ks'),
+]
+
+LANGUAGE_RULES = {
+    'en': [
+        (r'^kn', 'n'), (r'^gn', 'n'), (r'^wr', 'r'), (r'^ps', 's'),
+        (r'mb$', 'm'), (r'tch', 'x'), (r'sch', 'sk'), (r'sh', 'x'),
+        (r'ch', 'x'), (r'th', '0'), (r'dg', 'j'), (r'gh', ''),
+        (r'wh', 'w'), (r'c(?=[eiy])', 's'), (r'c', 'k'), (r'z', 's'),
+    ],
+    'de': [
+        (r'sch', 'x'), (r'ch', 'x'), (r'tz', 's'), (r'z', 's'),
+        (r'v', 'f'), (r'w', 'v'), (r'dt', 't'), (r'c', 'k'),
+    ],
+    'nl': [
+        (r'sch', 'sk'), (r'ij', 'y'), (r'ch', 'x'), (r'g', 'x'),
+        (r'v', 'f'), (r'w', 'v'), (r'dt', 't'), (r'c(?=[eiy])', 's'),
+        (r'c', 'k'), (r'z', 's'),
+    ],
+    'da': [
+        (r'hv', 'v'), (r'hj', 'j'), (r'dt', 't'), (r'ch', 'x'),
+        (r'sj', 'x'), (r'c(?=[eiy])', 's'), (r'c', 'k'), (r'z', 's'),
+        (r'w', 'v'),
+    ],
+    'es': [
+        (r'll', 'y'), (r'ch', 'x'), (r'c(?=[ei])', 's'), (r'c', 'k'),
+        (r'z', 's'), (r'v', 'b'), (r'j', 'h'), (r'g(?=[ei])', 'h'),
+        (r'gu(?=[ei])', 'g'),
+    ],
+    'it': [
+        (r'gn', 'ny'), (r'gl(?=i)', 'y'), (r'sc(?=[ei])', 'x'),
+        (r'c(?=[ei])', 'x'), (r'g(?=[ei])', 'j'), (r'ch', 'k'),
+        (r'gh', 'g'), (r'c', 'k'), (r'z', 's'),
+    ],
+}
+
+# Russian names are transliterated first and then keyed like English.
+CYRILLIC = dict(zip(
+    'абвгдеёжзийклмнопрстуфхцчшщъыьэюя',
+    ['a', 'b', 'v', 'g', 'd', 'e', 'e', 'zh', 'z', 'i', 'y', 'k', 'l', 'm',
+     'n', 'o', 'p', 'r', 's', 't', 'u', 'f', 'kh', 'ts', 'ch', 'sh', 'shch',
+     '', 'y', '', 'e', 'yu', 'ya']))
+LANGUAGE_RULES['ru'] = LANGUAGE_RULES['en']
+
+# Letters that don't decompose into a base letter and an accent
+SPECIAL_LETTERS = {'ß': 'ss', 'ñ': 'ny', 'ø': 'o', 'æ': 'ae', 'œ': 'oe'}
+
+# Leading articles speech recognition often drops or adds
+ARTICLES = {
+    'en': ('the', 'a', 'an'),
+    'de': ('der', 'die', 'das', 'den'),
+    'nl': ('de', 'het', 'een'),
+    'da': ('den', 'det', 'de', 'en', 'et'),
+    'es': ('el', 'la', 'los', 'las'),
+    'it': ('il', 'lo', 'la', 'i', 'gli', 'le', 'l'),
+    'ru': (),
+}
+
+# Letters left out of keys after the first letter
+SILENT = 'aeiouyhw'
+
+
+class PhoneticEncoder:
+    """Turns names into phonetic keys using the rules of one language.
+
+    A key is the name's consonant skeleton after the language's spelling
+    rules, with spaces, punctuation, doubled letters and vowels (other than
+    a leading one, which becomes 'a') removed: "Metallica" and "metal ica"
+    both become "mtlk".
+    """
+    def __init__(self, lang='en-us'):
+        self.lang = (lang or 'en').split('-')[0].lower()
+        rules = COMMON_RULES + LANGUAGE_RULES.get(self.lang,
+                                                  LANGUAGE_RULES['en'])
+        self.rules = [(re.compile(pattern), value) for pattern, value in rules]
+        self.articles = ARTICLES.get(self.lang, ARTICLES['en'])
+
+    def keys(self, name):
+        """Returns: set of keys for a name, with and without a leading
+        article ("The Beatles" -> {"0btls", "btls"})"""
+        keys = {self.key(name)}
+        words = name.lower().split()
+        if len(words) > 1 and words[0] in self.articles:
+            keys.add(self.key(' '.join(words[1:])))
+        keys.discard('')
+        return keys
+
+    def similarity(self, query, name):
+        """How alike 'query' and 'name' sound, from 0.0 to 1.0.
+
+        1.0 when the query's whole key is one of the name's keys ("beat
+        alls" -> "The Beatles"). When only part of the query sounds like
+        the name, e.g. once its leading article is dropped ("a story" ->
+        "Star"), it is the similarity of the query's key to the closest of
+        the name's keys."""
+        query_key = self.key(query)
+        name_keys = self.keys(name)
+        if query_key in name_keys:
+            return 1.0
+        return max((SequenceMatcher(None, query_key, key).ratio()
+                    for key in name_keys), default=0.0)
+
+    def key(self, name):
+        text = name.lower()
+        if self.lang == 'ru':
+            text = ''.join(CYRILLIC.get(char, char) for char in text)
+        text = ''.join(SPECIAL_LETTERS.get(char, char) for char in text)
+        text = unicodedata.normalize('NFKD', text)
+        text = ''.join(char for char in text
+                       if char.isalnum() and not unicodedata.combining(char))
+        for pattern, value in self.rules:
+            text = pattern.sub(value, text)
+        if not text:
+            return ''
+
+        # every leading vowel sounds alike enough to be one key letter
+        key = 'a' if text[0] in 'aeiou' else text[0]
+        previous = text[0]
+        for char in text[1:]:
+            if char != previous and char not in SILENT:
+                key += char
+            previous = char
+        return key
+
+
+class PhoneticIndex:
+    """Phonetic key -> names, for every kind of name in the library.
+
+    Used as a second chance when fuzzy matching finds nothing good, which
+    is typical for names speech recognition spelled the way they sound.
+    """
+    def __init__(self, lang='en-us'):
+        self.encoder = PhoneticEncoder(lang)
+        self.names = {}  # key -> {kind: set of names}
+
+    def add(self, name, kind):
+        for key in self.encoder.keys(name):
+            self.names.setdefault(key, {}).setdefault(kind, set()).add(name)
+
+    def remove(self, name, kind):
+        for key in self.encoder.keys(name):
+            names = self.names.get(key, {}).get(kind)
+            if names is None:
+                continue
+            names.discard(name)
+            if not names:
+                del self.names[key][kind]
+                if not self.names[key]:
+                    del self.names[key]
+
+    def clear(self):
+        self.names = {}
+
+    def copy(self):
+        index = PhoneticIndex()
+        index.encoder = self.encoder
+        index.names = {key: {kind: set(names) for kind, names in kinds.items()}
+                       for key, kinds in self.names.items()}
+        return index
+
+    def lookup(self, query, kinds):
+        """Returns: dict of kind -> set of names that sound like 'query'"""
+        found = {kind: set() for kind in kinds}
+        for key in self.encoder.keys(query):
+            for kind, names in self.names.get(key, {}).items():
+                if kind in found:
+                    found[kind].update(names)
+        return found
@@ -0,0 +1,103 @@
+import threading
+import time
+from itertools import chain
+
+from mycroft.util.log import LOG
+from .prefetch import warm_file
+
+
+# Longest wait for the announcement to start being spoken; after that
+# playback starts anyway (no TTS, or its message got lost)
+SPEECH_START_TIMEOUT = 2.0
+# Longest wait for an announcement that is being spoken to end
+SPEECH_END_TIMEOUT = 30.0
+
+
+class PlaybackStarter:
+    """Starts playback as soon as the skill's announcement has been spoken.
+
+    begin() is called just before the announcement is spoken. A worker
+    thread takes the first track from the selection and reads its start
+    into the page cache while the TTS speaks, then waits for the speech to
+    end ('recognizer_loop:audio_output_end', see speech_started and
+    speech_ended) and hands the tracks to 'play'. The intent handler
+    doesn't wait for any of this.
+    """
+    def __init__(self, play, speech_start_timeout=SPEECH_START_TIMEOUT,
+                 speech_end_timeout=SPEECH_END_TIMEOUT):
+        """Arguments:
+            play (function): called with the tracks (an iterable of file
+                             paths) when playback should start
+            speech_start_timeout (float): longest wait for speech to start
+            speech_end_timeout (float):   longest wait for speech to end
+        """
+        self.play = play
+        self.speech_start_timeout = speech_start_timeout
+        self.speech_end_timeout = speech_end_timeout
+        self.lock = threading.Lock()
+        self.started = threading.Event()
+        self.ended = threading.Event()
+        self.pending = 0  # number of the start being prepared, 0 if none
+        self.count = 0
+        self.begun = None  # when the last start was begun
+        self.waited = 0.0  # seconds the last start waited for speech
+
+    def begin(self, tracks):
+        """Prepare playing 'tracks' once the announcement spoken next is
+        over. Replaces a start that is still pending."""
+        with self.lock:
+            self.count += 1
+            self.pending = number = self.count
+            self.begun = time.monotonic()
+            self.started.clear()
+            self.ended.clear()
+        threading.Thread(target=self.run, args=(number, tracks),
+                         daemon=True).start()
+
+    def cancel(self):
+        """Drop the pending start, e.g. when stopped while announcing.
+        Returns: True if a start was pending"""
+        with self.lock:
+            pending = self.pending != 0
+            self.pending = 0
+            self.begun = None
+        self.started.set()
+        self.ended.set()
+        return pending
+
+    def speech_started(self, message=None):
+        self.started.set()
+
+    def speech_ended(self, message=None):
+        self.started.set()
+        self.ended.set()
+
+    def first_audio(self):
+        """Call when the audio service started a track.
+        Returns: seconds since the last start was begun, the first time
+        this is called for it, else None"""
+        with self.lock:
+            begun, self.begun = self.begun, None
+        return time.monotonic() - begun if begun is not None else None
+
+    def run(self, number, tracks):
+        if isinstance(tracks, (list, tuple)):
+            first = tracks[0] if tracks else None
+        else:
+            # a lazily picked selection: keep the track taken
+            tracks = iter(tracks)
+            first = next(tracks, None)
+            tracks = chain([first], tracks)
+        if first is not None and not warm_file(first):
+            LOG.info('Could not read {} ahead of playback'.format(first))
+
+        waiting = time.monotonic()
+        if self.started.wait(self.speech_start_timeout):
+            self.ended.wait(self.speech_end_timeout)
+        with self.lock:
+            if self.pending != number:
+                return  # cancelled or replaced
+            self.pending = 0
+            self.waited = time.monotonic() - waiting
+        if first is not None:
+            self.play(tracks)
@@ -0,0 +1,167 @@
+import os
+import re
+import xml.etree.ElementTree as ElementTree
+from urllib.parse import unquote, urlsplit
+
+
+# Windows drive letter paths (C:\Music\...) can't be resolved here
+WINDOWS_DRIVE = re.compile(r'^[a-zA-Z]:[\\/]')
+ASX_REF = re.compile(r'<ref\s[^>]*href\s*=\s*"([^"]*)"', re.IGNORECASE)
+
+
+def read_m3u(file_path):
+    """Yields the entries of an .m3u/.m3u8 playlist one line at a time.
+    .m3u8 files are UTF-8; plain .m3u files are often Latin-1."""
+    with open(file_path, 'rb') as f:
+        for line in f:
+            try:
+                line = line.decode('utf-8-sig')
+            except UnicodeDecodeError:
+                line = line.decode('latin-1')
+            line = line.strip()
+            if line and not line.startswith('#'):
+                yield line, False
+
+
+def iter_xml(file_path):
+    """Yields (lowercased tag without namespace, element) as elements end,
+    clearing them afterwards so large playlists aren't kept in memory."""
+    for event, element in ElementTree.iterparse(file_path):
+        yield element.tag.rsplit('}', 1)[-1].lower(), element
+        element.clear()
+
+
+def read_xspf(file_path):
+    """Yields the <location> URIs of an .xspf playlist."""
+    for tag, element in iter_xml(file_path):
+        if tag == 'location' and element.text:
+            yield element.text.strip(), True
+
+
+def read_asx(file_path):
+    """Yields the <ref href="..."> entries of an .asx playlist. Many .asx
+    files aren't well-formed XML; those are scanned line by line from
+    where the XML parser gave up."""
+    count = 0
+    try:
+        for tag, element in iter_xml(file_path):
+            if tag == 'ref':
+                href = {key.lower(): value
+                        for key, value in element.attrib.items()}.get('href')
+                if href:
+                    count += 1
+                    yield href.strip(), False
+    except ElementTree.ParseError:
+        with open(file_path, encoding='utf-8', errors='replace') as f:
+            for line in f:
+                for href in ASX_REF.findall(line):
+                    if count:
+                        count -= 1  # already read by the XML parser
+                        continue
+                    yield href.strip(), False
+
+
+def read_b4s(file_path):
+    """Yields the Playstring entries of a Winamp .b4s playlist."""
+    for tag, element in iter_xml(file_path):
+        if tag == 'entry':
+            playstring = {key.lower(): value
+                          for key, value in element.attrib.items()
+                          }.get('playstring')
+            if playstring:
+                yield playstring.strip(), False
+
+
+PLAYLIST_READERS = {
+    '.m3u': read_m3u,
+    '.m3u8': read_m3u,
+    '.xspf': read_xspf,
+    '.asx': read_asx,
+    '.b4s': read_b4s,
+}
+
+
+def read_entries(file_path):
+    """Yields the entries of a playlist file as (entry, is_uri), in order.
+    Raises ValueError for unsupported formats."""
+    extension = os.path.splitext(file_path)[1].lower()
+    if extension not in PLAYLIST_READERS:
+        raise ValueError('Unsupported playlist format: ' + extension)
+    return PLAYLIST_READERS[extension](file_path)
+
+
+def entry_path(entry, folder, is_uri=False):
+    """Turn a playlist entry into a normalized local file path.
+
+    Arguments:
+        entry (str):   path or URI as written in the playlist
+        folder (str):  folder of the playlist, relative entries start there
+        is_uri (bool): entry is a URI even without a scheme (XSPF), so
+                       %-escapes have to be decoded
+    Returns: the path, or None for streams and paths from other systems
+    """
+    if entry.lower().startswith('file:'):
+        path = unquote(urlsplit(entry).path)
+        # b4s writes file:C:\..., urlsplit leaves that path as is
+    elif '://' in entry:
+        return None  # stream, nothing to play offline
+    else:
+        path = unquote(entry) if is_uri else entry
+    if WINDOWS_DRIVE.match(path):
+        return None
+    if os.sep == '/':
+        path = path.replace('\\', '/')
+    return os.path.normpath(os.path.join(folder, os.path.expanduser(path)))
+
+
+class PlaylistCache:
+    """Parsed playlists as the file paths of their entries.
+
+    An entry is used as long as the playlist file's size and modification
+    time are what they were when it was parsed. The paths are looked up in
+    the library when the playlist is played, so changes to the library
+    don't make a playlist be parsed again; the paths found are kept until
+    the library changes.
+    """
+    def __init__(self):
+        self.entries = {}  # playlist path -> (size, mtime, paths)
+        # playlist path -> (paths, library version, paths in the library)
+        self.files = {}
+
+    def get(self, file_path, stat):
+        """Returns: the cached paths, or None"""
+        entry = self.entries.get(file_path)
+        if entry and entry[:2] == (stat.st_size, stat.st_mtime):
+            return entry[2]
+        return None
+
+    def put(self, file_path, stat, paths):
+        self.entries[file_path] = (stat.st_size, stat.st_mtime, paths)
+
+    def get_files(self, file_path, paths, version):
+        """Returns: the playlist's paths that were found in the library, if
+        they were looked up for these 'paths' and library 'version', or
+        None"""
+        entry = self.files.get(file_path)
+        if entry and entry[0] is paths and entry[1] == version:
+            return entry[2]
+        return None
+
+    def put_files(self, file_path, paths, version, files):
+        self.files[file_path] = (paths, version, files)
+
+    def discard(self, file_path):
+        self.entries.pop(file_path, None)
+        self.files.pop(file_path, None)
+
+    def clear(self):
+        self.entries = {}
+        self.files = {}
+
+
+def playlist_paths(file_path):
+    """Yields the local file path of every entry of a playlist, in order,
+    or None for entries that can't be played from disk (e.g. streams)."""
+    folder = os.path.dirname(file_path)
+    for entry, is_uri in read_entries(file_path):
+        yield entry_path(entry, folder, is_uri)
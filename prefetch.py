@@ -0,0 +1,170 @@
+import os
+import threading
+import time
+
+from mycroft.util.log import LOG
+from .metrics import tracer
+
+
+# Tracks after the one playing whose files are read ahead
+PREFETCH_AHEAD = 3
+# Most bytes of upcoming tracks kept read ahead, i.e. page cache the
+# prefetch may take up
+PREFETCH_BUDGET = 64 * 1024 * 1024
+# Most bytes read ahead per second, so the track playing (and anything
+# else using the disk) isn't starved
+PREFETCH_RATE = 4 * 1024 * 1024
+# Bytes asked for at a time
+CHUNK = 1024 * 1024
+
+# Bytes at the start of a file read by warm_file
+WARM_BYTES = 256 * 1024
+# Of those, bytes read right away (the rest is left to the kernel), which
+# also wakes up a spun-down disk
+WARM_READ_BYTES = 64 * 1024
+
+
+def read_ahead(fd, offset, length):
+    """Have the kernel read part of an open file into the page cache:
+    asynchronously with posix_fadvise(WILLNEED) where there is one, else
+    by reading it."""
+    if hasattr(os, 'posix_fadvise'):
+        os.posix_fadvise(fd, offset, length, os.POSIX_FADV_WILLNEED)
+    else:
+        os.lseek(fd, offset, os.SEEK_SET)
+        while length > 0:
+            data = os.read(fd, min(length, CHUNK))
+            if not data:
+                break
+            length -= len(data)
+
+
+def warm_file(file_path, length=WARM_BYTES):
+    """Get the start of a file into the page cache.
+    Returns: True if the file could be read"""
+    try:
+        fd = os.open(file_path, os.O_RDONLY)
+    except OSError:
+        return False
+    try:
+        read_ahead(fd, 0, length)
+        os.read(fd, min(length, WARM_READ_BYTES))
+        return True
+    except OSError:
+        return False
+    finally:
+        os.close(fd)
+
+
+class Prefetcher:
+    """Reads the files of the next few tracks into the page cache before
+    they are played, so a slow SD card or a spun-down USB disk doesn't make
+    the start of each track stutter.
+
+    update() is called with the upcoming tracks on every track change; a
+    worker thread reads them in order, one chunk at a time, at no more
+    than 'rate' bytes per second and no more than 'budget' bytes for all of
+    them together. Files that are no longer upcoming are dropped between
+    two chunks.
+    """
+    def __init__(self, ahead=PREFETCH_AHEAD, budget=PREFETCH_BUDGET,
+                 rate=PREFETCH_RATE):
+        """Arguments:
+            ahead (int):  number of upcoming tracks to read ahead
+            budget (int): most bytes read ahead for the upcoming tracks
+            rate (int):   most bytes read ahead per second
+        """
+        self.ahead = ahead
+        self.budget = budget
+        self.rate = rate
+        self.changed = threading.Condition()
+        self.wanted = []  # upcoming file paths, next one first
+        self.progress = {}  # file path -> [bytes read ahead, file size]
+        self.stopping = False
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        with self.changed:
+            self.stopping = True
+            self.changed.notify()
+        if self.thread:
+            self.thread.join(timeout=5)
+
+    def update(self, upcoming):
+        """Arguments:
+            upcoming (list): file paths of the tracks queued after the one
+                             playing, next one first (empty when stopped)
+        """
+        wanted = list(upcoming)[:self.ahead]
+        with self.changed:
+            if wanted != self.wanted:
+                self.wanted = wanted
+                self.progress = {path: self.progress[path] for path in wanted
+                                 if path in self.progress}
+                self.changed.notify()
+
+    def run(self):
+        while True:
+            with self.changed:
+                chunk = self.next_chunk()
+                while chunk is None and not self.stopping:
+                    self.changed.wait()
+                    chunk = self.next_chunk()
+                if self.stopping:
+                    return
+            file_path, offset, length = chunk
+
+            if length is None:
+                # not looked at yet (stat can take a while on a sleeping
+                # disk, so not with the lock held)
+                try:
+                    size = os.path.getsize(file_path)
+                except OSError:
+                    size = 0
+                with self.changed:
+                    if file_path in self.progress:
+                        self.progress[file_path][1] = size
+                continue
+
+            try:
+                fd = os.open(file_path, os.O_RDONLY)
+                try:
+                    read_ahead(fd, offset, length)
+                finally:
+                    os.close(fd)
+                tracer.count('prefetch_bytes', length)
+            except OSError as e:
+                LOG.debug('Could not read ahead {}: {}'.format(file_path,
+                                                                repr(e)))
+                offset = float('inf')  # give up on this file
+            with self.changed:
+                if file_path in self.progress:
+                    self.progress[file_path][0] = offset + length
+
+                # keep to the rate
+                until = time.monotonic() + (length / self.rate
+                                            if self.rate > 0 else 0)
+                while not self.stopping and time.monotonic() < until:
+                    self.changed.wait(until - time.monotonic())
+
+    def next_chunk(self):
+        """Returns: (file path, offset, length) of the next part to read
+        ahead, with length None if the file's size isn't known yet, or None
+        if the upcoming files are read as far as the budget allows.
+        Call with the lock held."""
+        left = self.budget
+        for file_path in self.wanted:
+            if left <= 0:
+                break
+            done, size = self.progress.setdefault(file_path, [0, None])
+            if size is None:
+                return file_path, 0, None
+            size = min(size, left)
+            if done < size:
+                return file_path, done, min(CHUNK, size - done)
+            left -= size
+        return None
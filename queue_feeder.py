@@ -0,0 +1,176 @@
+import os
+import threading
+from collections import deque
+from itertools import islice
+from urllib.parse import unquote, urlsplit
+
+
+# Tracks handed to the audio service when playback starts
+START_WINDOW = 5
+# Top the queue up when no more than this many tracks are left after the
+# one playing
+LOW_WATER = 2
+# Tracks added per top-up
+TOP_UP = 10
+# Tracks handed over most recently that are remembered for current()
+RECENT = 50
+
+
+class QueueFeeder:
+    """Feeds a long selection of tracks to the audio service a few at a
+    time.
+
+    Playback starts with a small window, so starting 10000 tracks takes
+    as long as starting five and the bus never carries the whole list.
+    Every track change ('mycroft.audio.playing_track') is looked up among
+    the tracks handed over recently, so skipping back or resuming a track
+    doesn't move the position on; when the backend is about to run out of
+    tracks, the next batch is queued. The selection can be any iterable,
+    so tracks that are picked on the fly (e.g. shuffled) are only picked
+    when needed.
+
+    Backends report the track as a path, a file:// URI or, for some, just
+    a file name. A track that can't be matched moves the position on by
+    one.
+    """
+    def __init__(self, audio_service, start_window=START_WINDOW,
+                 low_water=LOW_WATER, top_up=TOP_UP):
+        self.audio_service = audio_service
+        self.start_window = start_window
+        self.low_water = low_water
+        self.top_up = top_up
+        self.lock = threading.Lock()
+        self.source = None
+        self.tracks = None  # iterator over the tracks not handed over yet
+        self.repeat = False
+        self.fed = 0  # tracks handed to the audio service
+        self.playing = -1  # index among the tracks handed over, -1: none
+        self.recent = deque(maxlen=RECENT)  # the last tracks handed over
+
+    @property
+    def active(self):
+        return self.tracks is not None
+
+    def play(self, tracks, utterance=None, repeat=False):
+        """Start playing a selection of tracks.
+
+        Arguments:
+            tracks (iterable): file paths. Repeating only works for
+                               selections that can be iterated again
+                               (lists, not generators).
+            utterance (str):   passed on to AudioService.play to pick the
+                               backend
+            repeat (bool):     start over at the end of the selection
+        Returns: number of tracks handed over to start with
+        """
+        with self.lock:
+            self.source = tracks
+            self.tracks = iter(tracks)
+            self.repeat = repeat and self.tracks is not tracks
+            self.fed = 0
+            self.playing = -1
+            self.recent.clear()
+            window = self._take(self.start_window)
+            if not window:
+                self.tracks = None
+                return 0
+            self.fed = len(window)
+            self.recent.extend(window)
+            # the backend's own repeat would only repeat the window
+            self.audio_service.play(window, utterance, False)
+            return len(window)
+
+    def track_started(self, track=None):
+        """Call on every track change of the audio service.
+
+        Arguments:
+            track (str): the track as reported by the audio service
+                         (message.data['track']), None if unknown
+        """
+        with self.lock:
+            if not self.active:
+                return
+            position = self._find(track) if track else None
+            if position is None:
+                self.playing += 1
+            else:
+                self.playing = self.fed - len(self.recent) + position
+            if self.fed - self.playing - 1 < self.low_water:
+                self._queue(self._take(self.top_up))
+
+    def queue_ended(self):
+        """Call when the audio service ran out of tracks. Normally the
+        queue is topped up long before; this catches up if track changes
+        were missed."""
+        with self.lock:
+            if not self.active:
+                return
+            window = self._take(self.start_window)
+            if window:
+                self.fed += len(window)
+                self.recent.extend(window)
+                self.playing = self.fed - len(window) - 1
+                self.audio_service.play(window, None, False)
+            else:
+                self.tracks = None
+
+    def current(self):
+        """Returns: the file path of the track that is most likely playing,
+        going by the track changes seen, or None"""
+        with self.lock:
+            position = self._position()
+            if position is not None and 0 <= position < len(self.recent):
+                return self.recent[position]
+            return None
+
+    def upcoming(self, count):
+        """Returns: list of the file paths of (up to) 'count' tracks the
+        audio service has queued after the one playing"""
+        with self.lock:
+            position = self._position()
+            if position is None:
+                return []
+            start = max(position + 1, 0)
+            return list(islice(self.recent, start, start + count))
+
+    def stop(self):
+        """Stop feeding, e.g. when playback was stopped or another skill
+        took over the audio service."""
+        with self.lock:
+            self.source = self.tracks = None
+
+    def _position(self):
+        """Returns: index into self.recent of the track playing, or None"""
+        if not self.active:
+            return None
+        return max(self.playing, 0) - (self.fed - len(self.recent))
+
+    def _find(self, track):
+        """Returns: index into self.recent of the track the audio service
+        reported, or None. A track handed over more than once (repeat) is
+        taken to be the next one, else the one playing, else the closest
+        one, earlier ones first."""
+        if track.startswith('file://'):
+            track = unquote(urlsplit(track).path)
+        name = os.path.basename(track)
+        matches = [index for index, path in enumerate(self.recent)
+                   if path == track or (name == track and
+                                        os.path.basename(path) == name)]
+        if not matches:
+            return None
+        next_track = self.playing + 1 - (self.fed - len(self.recent))
+        return min(matches, key=lambda index: (abs(index - next_track),
+                                               index > next_track))
+
+    def _queue(self, tracks):
+        if tracks:
+            self.fed += len(tracks)
+            self.recent.extend(tracks)
+            self.audio_service.queue(tracks)
+
+    def _take(self, count):
+        tracks = list(islice(self.tracks, count))
+        if len(tracks) < count and self.repeat:
+            self.tracks = iter(self.source)
+            tracks += list(islice(self.tracks, count - len(tracks)))
+        return tracks
@@ -0,0 +1,122 @@
+import os
+import re
+from mycroft.util.log import LOG
+
+
+# Locale whose regexes stand in for ones a locale doesn't ship
+FALLBACK_LANG = 'en-us'
+
+# Regexes specific_query tries on a phrase, in order
+QUERY_REGEXES = ('saved_songs', 'playlist', 'album', 'artist', 'song')
+
+# (?P<name> and (?P=name); renamed when patterns are combined
+GROUP_NAME = re.compile(r'(\(\?P[<=])(\w+)')
+# Numbered backreferences would point at the wrong group once combined
+NUMBERED_BACKREFERENCE = re.compile(r'\\[1-9]')
+
+
+class RegexBank:
+    """The .regex files of every locale, read and compiled once.
+
+    For each locale the query regexes are also joined into one alternation,
+    so a phrase is classified in a single re.match instead of one per
+    regex. Alternatives are tried in QUERY_REGEXES order, so the result is
+    the same as trying the regexes one after the other.
+
+    Arguments:
+        locale_dir (str): the skill's locale folder, one folder per language
+    """
+    def __init__(self, locale_dir):
+        self.regexes = {}  # lang -> {name: compiled pattern}
+        self.dispatchers = {}  # lang -> (combined pattern, groups) or None
+        try:
+            langs = sorted(os.listdir(locale_dir))
+        except OSError:
+            langs = []
+        for lang in langs:
+            folder = os.path.join(locale_dir, lang)
+            if os.path.isdir(folder):
+                self.regexes[lang.lower()] = self.read_folder(folder)
+
+        fallback = self.regexes.get(FALLBACK_LANG, {})
+        for lang, regexes in self.regexes.items():
+            for name, pattern in fallback.items():
+                regexes.setdefault(name, pattern)
+            self.dispatchers[lang] = combine(
+                [(name, regexes[name]) for name in QUERY_REGEXES
+                 if name in regexes])
+
+    def read_folder(self, folder):
+        regexes = {}
+        for filename in sorted(os.listdir(folder)):
+            if not filename.endswith('.regex'):
+                continue
+            path = os.path.join(folder, filename)
+            try:
+                with open(path, encoding='utf-8') as f:
+                    regexes[filename[:-len('.regex')]] = re.compile(
+                        f.read().strip())
+            except (OSError, re.error) as e:
+                LOG.warning('Skipping regex {}: {}'.format(path, repr(e)))
+        return regexes
+
+    def regex(self, name, lang):
+        """Returns: the compiled regex 'name' of 'lang' (or of the fallback
+        locale), or None if neither has it"""
+        regexes = (self.regexes.get(lang.lower()) or
+                   self.regexes.get(FALLBACK_LANG, {}))
+        return regexes.get(name)
+
+    def classify(self, phrase, lang, names=QUERY_REGEXES):
+        """Find the first of the query regexes 'names' matching the start
+        of 'phrase'.
+        Returns: (regex name, dict of its named groups) or (None, {})"""
+        lang = lang.lower()
+        if lang not in self.regexes:
+            lang = FALLBACK_LANG
+        dispatcher = self.dispatchers.get(lang)
+        if dispatcher and names == QUERY_REGEXES:
+            pattern, groups = dispatcher
+            match = pattern.match(phrase)
+            if not match:
+                return None, {}
+            name, renamed = groups[match.lastgroup]
+            return name, {group: match.group(alias)
+                          for alias, group in renamed.items()}
+
+        for name in names:
+            pattern = self.regex(name, lang)
+            match = pattern.match(phrase) if pattern else None
+            if match:
+                return name, match.groupdict()
+        return None, {}
+
+
+def combine(patterns):
+    """Join compiled patterns into one alternation. Each alternative is
+    wrapped in a group named _<n>, and its named groups become _<n>_<name>
+    since a pattern can't use a group name twice.
+
+    Arguments:
+        patterns (list): (name, compiled pattern), in the order to try them
+    Returns: (combined pattern, dict of _<n> -> (name, {_<n>_<group>:
+             group})), or None if the patterns can't be combined
+    """
+    parts = []
+    groups = {}
+    for n, (name, pattern) in enumerate(patterns):
+        if (pattern.flags & ~re.UNICODE or
+                NUMBERED_BACKREFERENCE.search(pattern.pattern)):
+            return None
+        prefix = '_{}_'.format(n)
+        renamed = {prefix + group: group for group in pattern.groupindex}
+        source = GROUP_NAME.sub(lambda m: m.group(1) + prefix + m.group(2),
+                                pattern.pattern)
+        parts.append('(?P<_{}>{})'.format(n, source))
+        groups['_{}'.format(n)] = (name, renamed)
+    if not parts:
+        return None
+    try:
+        return re.compile('|'.join(parts)), groups
+    except re.error:
+        return None
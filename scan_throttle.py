@@ -0,0 +1,121 @@
+import os
+import threading
+import time
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+
+# CPU niceness of the scan threads (19 is the lowest priority)
+SCAN_NICE = 19
+# I/O priority of the scan threads: lowest level of the best-effort class.
+# (The idle class could starve a scan completely on a busy disk.)
+SCAN_IO_LEVEL = 7
+# Seconds a pause for the listener lasts if its end is never reported
+LISTENER_PAUSE_TIMEOUT = 30.0
+# Seconds a pause for audio outlasts the track playing, in case the end of
+# playback is never reported; tracks of unknown length get the default
+AUDIO_PAUSE_MARGIN = 30.0
+AUDIO_PAUSE_TIMEOUT = 900.0
+# Seconds between checks for a stopped scan while paused
+POLL_INTERVAL = 0.5
+
+
+def lower_priority(nice=SCAN_NICE, io_level=SCAN_IO_LEVEL):
+    """Run the calling thread at low CPU and I/O priority, so a scan
+    doesn't make playback or wake word detection stutter. On Linux both
+    apply to the thread only. Does nothing where it isn't supported."""
+    thread_id = threading.get_native_id()
+    try:
+        current = os.getpriority(os.PRIO_PROCESS, thread_id)
+        if current < nice:
+            os.setpriority(os.PRIO_PROCESS, thread_id, nice)
+    except (AttributeError, OSError):
+        pass
+    # CFQ and BFQ already derive a lower I/O priority from the niceness;
+    # set it explicitly for the other schedulers
+    if psutil is not None and hasattr(psutil, 'IOPRIO_CLASS_BE'):
+        try:
+            psutil.Process(thread_id).ionice(psutil.IOPRIO_CLASS_BE,
+                                             io_level)
+        except (psutil.Error, OSError, ValueError):
+            pass
+
+
+class ScanThrottle:
+    """Paces a library scan and holds it while it would be in the way.
+
+    Scan threads call take() before reading a file: it waits while the scan
+    is paused (for any reason, e.g. 'audio' while music plays and
+    'listener' while the user speaks) and keeps to 'files_per_second'.
+    Pausing doesn't interrupt the scan; it just carries on from the next
+    file when the last reason is gone. One throttle is shared by every scan,
+    so the rate is the total of all of them; each scan passes its own stop
+    event ('abort'), which ends its waits.
+    """
+    def __init__(self, files_per_second=0):
+        """Arguments:
+            files_per_second (float): most files read per second, 0 for no
+                                      limit
+        """
+        self.files_per_second = files_per_second
+        self.changed = threading.Condition()
+        self.paused = {}  # reason -> time.monotonic() the pause ends at
+        self.next_slot = 0.0
+
+    def pause(self, reason, timeout=None):
+        """Hold the scan until resume(reason) is called or, if given,
+        'timeout' seconds have passed."""
+        with self.changed:
+            self.paused[reason] = (time.monotonic() + timeout
+                                   if timeout is not None else float('inf'))
+
+    def resume(self, reason):
+        with self.changed:
+            self.paused.pop(reason, None)
+            self.changed.notify_all()
+
+    def is_paused(self):
+        with self.changed:
+            return self._pause_left() > 0
+
+    def _pause_left(self):
+        """Returns: seconds until every pause has ended (inf if one has no
+        timeout), 0 when not paused. Call with the lock held."""
+        now = time.monotonic()
+        for reason, until in list(self.paused.items()):
+            if until <= now:
+                del self.paused[reason]
+        return max(self.paused.values(), default=now) - now
+
+    def wait(self, abort):
+        """Wait while the scan is paused.
+        Arguments:
+            abort (threading.Event): set when the scan is to stop
+        Returns: False if the scan was stopped"""
+        with self.changed:
+            while not abort.is_set():
+                left = self._pause_left()
+                if left <= 0:
+                    break
+                self.changed.wait(min(left, POLL_INTERVAL))
+        return not abort.is_set()
+
+    def take(self, abort):
+        """Wait for the turn to read the next file.
+        Arguments:
+            abort (threading.Event): set when the scan is to stop
+        Returns: False if the scan was stopped"""
+        if not self.wait(abort):
+            return False
+        if self.files_per_second <= 0:
+            return True
+        with self.changed:
+            now = time.monotonic()
+            slot = max(now, self.next_slot)
+            self.next_slot = slot + 1.0 / self.files_per_second
+        if slot > now:
+            abort.wait(slot - now)
+        return not abort.is_set()
@@ -0,0 +1,124 @@
+import heapq
+from collections import Counter
+
+
+# Largest number of names handed to the fuzzy matcher per kind and query
+MAX_CANDIDATES = 40
+
+
+def ngrams(text, n=3):
+    """Returns: set of the n-grams in 'text', lowercased and padded with
+    spaces so short words and word starts still produce n-grams."""
+    text = ' {} '.format(' '.join(text.lower().split()))
+    return {text[i:i + n] for i in range(max(len(text) - n + 1, 1))}
+
+
+class NgramIndex:
+    """Inverted n-gram index over the names in the library.
+
+    Every name (track title, artist, album, genre, playlist) is indexed
+    once, together with the kinds of thing it names, so "Abbey Road" the
+    album and "Abbey Road" the song share one entry. Looking up a query
+    returns the few names that share the most n-grams with it, so the slow
+    fuzzy comparison only has to run on those instead of on every name in
+    the library.
+    """
+    def __init__(self, n=3):
+        self.n = n
+        self.postings = {}  # n-gram -> set of names containing it
+        self.sizes = {}  # name -> number of n-grams in it
+        self.kinds = {}  # name -> set of kinds ('artists', 'albums'...)
+
+    def __len__(self):
+        return len(self.sizes)
+
+    def __contains__(self, name):
+        return name in self.sizes
+
+    def add(self, name, kind):
+        if name in self.kinds:
+            self.kinds[name].add(kind)
+            return
+        grams = ngrams(name, self.n)
+        self.sizes[name] = len(grams)
+        self.kinds[name] = {kind}
+        for gram in grams:
+            self.postings.setdefault(gram, set()).add(name)
+
+    def remove(self, name, kind):
+        kinds = self.kinds.get(name)
+        if not kinds:
+            return
+        kinds.discard(kind)
+        if kinds:
+            return
+        del self.kinds[name]
+        del self.sizes[name]
+        for gram in ngrams(name, self.n):
+            names = self.postings.get(gram)
+            if names is not None:
+                names.discard(name)
+                if not names:
+                    del self.postings[gram]
+
+    def clear(self):
+        self.postings = {}
+        self.sizes = {}
+        self.kinds = {}
+
+    def copy(self):
+        index = NgramIndex(self.n)
+        index.postings = {gram: set(names)
+                          for gram, names in self.postings.items()}
+        index.sizes = dict(self.sizes)
+        index.kinds = {name: set(kinds) for name, kinds in self.kinds.items()}
+        return index
+
+    def candidates(self, query, kind, limit=MAX_CANDIDATES):
+        """Find the names of one kind most similar to 'query'.
+        Returns: list of at most 'limit' names, best first"""
+        return self.search(query, (kind,), limit)[kind]
+
+    def search(self, query, kinds, limit=MAX_CANDIDATES):
+        """Find the names most similar to 'query' for several kinds at once.
+
+        Names are ranked by the Dice coefficient of their n-gram sets with
+        the query's, which follows difflib's ratio closely enough that the
+        best fuzzy match is among the top few. The postings are only walked
+        once, however many kinds are asked for.
+
+        Returns: dict of kind -> list of at most 'limit' names, best first
+        """
+        grams = ngrams(query, self.n)
+        counts = Counter()
+        for gram in grams:
+            names = self.postings.get(gram)
+            if names:
+                counts.update(names)
+        return rank(counts, len(grams), self.sizes.__getitem__,
+                    self.kinds.__getitem__, kinds, limit)
+
+
+def rank(counts, size, size_of, kinds_of, kinds, limit=MAX_CANDIDATES):
+    """Rank names by the Dice coefficient of their n-gram sets with the
+    query's (see NgramIndex.search). Names that score the same are ranked
+    in name order, so the result doesn't depend on the order of 'counts'.
+
+    Arguments:
+        counts (Counter): name -> number of n-grams shared with the query.
+                          Names may also be numbers that sort like the
+                          names they stand for (see snapshot.py)
+        size (int):       number of n-grams in the query
+        size_of (function): name -> number of n-grams in the name
+        kinds_of (function): name -> kinds the name is listed under
+    Returns: dict of kind -> list of at most 'limit' names, best first
+    """
+    scored = [(2.0 * count / (size + size_of(name)), name)
+              for name, count in counts.items()]
+    results = {}
+    for kind in kinds:
+        ranked = heapq.nsmallest(
+            limit, (item for item in scored if kind in kinds_of(item[1])),
+            key=lambda item: (-item[0], item[1]))
+        results[kind] = [name for score, name in ranked]
+    return results
@@ -0,0 +1,50 @@
+import random
+
+
+# Feistel rounds; a handful is plenty for shuffling music
+ROUNDS = 4
+MASK64 = (1 << 64) - 1
+
+
+class FeistelPermutation:
+    """A seeded pseudo-random permutation of range(size).
+
+    Positions are mapped with a small Feistel network over the smallest
+    even number of bits that covers 'size'; results outside the range are
+    fed through again ("cycle walking") until they land inside it. This
+    gives the i-th element of a shuffle in O(1) time and memory, so a
+    shuffled walk over a huge library never needs a shuffled copy of it.
+    """
+    def __init__(self, size, seed=None):
+        self.size = size
+        bits = max((size - 1).bit_length(), 2)
+        self.half = (bits + 1) // 2
+        self.half_mask = (1 << self.half) - 1
+        rng = random.Random(seed)
+        self.keys = [rng.getrandbits(64) for _ in range(ROUNDS)]
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, position):
+        if not 0 <= position < self.size:
+            raise IndexError(position)
+        value = self.encrypt(position)
+        while value >= self.size:
+            value = self.encrypt(value)
+        return value
+
+    def __iter__(self):
+        return (self[position] for position in range(self.size))
+
+    def encrypt(self, value):
+        left, right = value >> self.half, value & self.half_mask
+        for key in self.keys:
+            left, right = right, left ^ self.round(right, key)
+        return (left << self.half) | right
+
+    def round(self, value, key):
+        # multiply-xorshift mix of the half block with the round key
+        value = ((value ^ key) * 0x9E3779B97F4A7C15) & MASK64
+        value ^= value >> 29
+        return value & self.half_mask
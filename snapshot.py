@@ -0,0 +1,477 @@
+import bisect
+import mmap
+import os
+import struct
+import sys
+import zlib
+from array import array
+from collections import Counter
+from collections.abc import Mapping
+
+from .phonetic import PhoneticEncoder
+from .search_index import MAX_CANDIDATES, ngrams, rank
+
+
+# Bump this whenever the file layout changes. Snapshots with another
+# version are ignored and rewritten after the next scan.
+SNAPSHOT_VERSION = 2
+MAGIC = b'OPLSNAP\0'
+
+# magic, version, byte order (0 little, 1 big), number of sections,
+# crc32 of everything after the header, index generation, n-gram size,
+# language
+HEADER = struct.Struct('<8sHBBIQH14s')
+SECTION = struct.Struct('<QQ')  # offset, length
+
+# The kinds of names, in the order of their bits in the name table
+KINDS = ('tracks', 'artists', 'albums', 'genres', 'playlists')
+KIND_SETS = [frozenset(kind for bit, kind in enumerate(KINDS)
+                       if mask & (1 << bit))
+             for mask in range(1 << len(KINDS))]
+
+# Sections, in file order. All numbers are in the byte order of the machine
+# that wrote the file; a snapshot is never shared between machines.
+(STRING_OFFSETS,  # u32 per string + 1, into STRING_DATA
+ STRING_DATA,  # utf-8
+ TRACK_STRINGS,  # u32 string ids per track, see TRACK_STRING_FIELDS
+ DURATIONS,  # double per track, 0 when unknown
+ SIZES,  # int64 per track
+ MTIMES,  # double per track
+ PATH_ORDER,  # u32 track ids sorted by path
+ NAMES,  # u32 string id, kinds bit mask, n-gram count; sorted by name
+ TRACK_KEYS,  # per kind: u32 name string id, posting start, posting count
+ ARTIST_KEYS,  # sorted by name
+ ALBUM_KEYS,
+ GENRE_KEYS,
+ PLAYLIST_KEYS,
+ POSTINGS,  # u32 track ids (playlists: path string ids, keys: name ids)
+ GRAM_KEYS,  # u32 n-gram string id, posting start, count; sorted
+ SOUND_KEYS,  # u32 phonetic key string id, posting start, count; sorted
+ ) = range(16)
+SECTION_COUNT = 16
+KIND_SECTIONS = dict(zip(KINDS, range(TRACK_KEYS, PLAYLIST_KEYS + 1)))
+
+TRACK_STRING_FIELDS = ('folder', 'filename', 'title', 'artist', 'album',
+                       'albumartist', 'genre', 'year', 'track')
+
+
+class SnapshotError(Exception):
+    pass
+
+
+class Snapshot:
+    """Read-only view of the music library stored in a snapshot file.
+
+    The file is memory-mapped and nothing is decoded up front: names, paths
+    and tags are read from the mapped pages when a query needs them, and
+    lookups are binary searches over the sorted key tables. Opening a
+    snapshot without checking its checksum (see verify) costs the same for
+    100 or 100000 tracks, and every process opening the file shares the
+    same pages.
+
+    A snapshot offers the attributes SongDatabase searches through
+    (tracks, artists, albums, genres, playlists, track_records) and the
+    search methods of NgramIndex and PhoneticIndex, so the database can
+    answer queries from it until the full index has been loaded.
+    """
+    def __init__(self, path, generation=None, lang=None, verify=True):
+        """Arguments:
+            path (str):       snapshot file
+            generation (int): expected generation of the library index;
+                              SnapshotError is raised for any other
+            lang (str):       expected language of the phonetic keys
+            verify (bool):    check the checksum of the whole file now;
+                              otherwise call verify later
+        """
+        self.file_path = path
+        self.verified = False  # set once verify found the checksum right
+        with open(path, 'rb') as f:
+            try:
+                self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                raise SnapshotError('empty snapshot')
+        try:
+            self._read_header(generation, lang, verify)
+        except (SnapshotError, struct.error, TypeError, ValueError) as e:
+            self.close()
+            if isinstance(e, SnapshotError):
+                raise
+            raise SnapshotError('damaged snapshot: {}'.format(e))
+
+        self.tracks = SnapshotPathView(self, 'tracks')
+        self.artists = SnapshotPathListView(self, 'artists')
+        self.albums = SnapshotPathListView(self, 'albums')
+        self.genres = SnapshotPathListView(self, 'genres')
+        self.playlists = SnapshotPlaylistView(self, 'playlists')
+        self.track_records = SnapshotRecordView(self)
+
+    def _read_header(self, generation, lang, verify):
+        if len(self.map) < HEADER.size:
+            raise SnapshotError('truncated snapshot')
+        (magic, version, byte_order, count, checksum, self.generation,
+         self.n, stored_lang) = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC:
+            raise SnapshotError('not a snapshot')
+        if version != SNAPSHOT_VERSION:
+            raise SnapshotError('snapshot version {}'.format(version))
+        if byte_order != (sys.byteorder == 'big') or count != SECTION_COUNT:
+            raise SnapshotError('snapshot written on another system')
+        self.lang = stored_lang.rstrip(b'\0').decode()
+        if generation is not None and self.generation != generation:
+            raise SnapshotError('stale snapshot')
+        if lang is not None and self.lang != lang:
+            raise SnapshotError('snapshot made for another language')
+        self.checksum = checksum
+        if verify and not self.verify():
+            raise SnapshotError('snapshot checksum mismatch')
+
+        view = memoryview(self.map)
+        self.buffers = [view]  # released by close, innermost last
+        sections = []
+        for i in range(count):
+            offset, length = SECTION.unpack_from(
+                self.map, HEADER.size + i * SECTION.size)
+            if offset + length > len(self.map):
+                raise SnapshotError('truncated snapshot')
+            sections.append(view[offset:offset + length])
+        self.buffers.extend(sections)
+
+        def cast(section, code='I'):
+            array_view = sections[section].cast(code)
+            self.buffers.append(array_view)
+            return array_view
+
+        self.string_offsets = cast(STRING_OFFSETS)
+        self.string_data = sections[STRING_DATA]
+        self.track_strings = cast(TRACK_STRINGS)
+        self.durations = cast(DURATIONS, 'd')
+        self.sizes = cast(SIZES, 'q')
+        self.mtimes = cast(MTIMES, 'd')
+        self.path_order = cast(PATH_ORDER)
+        self.names = cast(NAMES)
+        self.postings = cast(POSTINGS)
+        self.keys = {kind: KeyTable(self, cast(section))
+                     for kind, section in KIND_SECTIONS.items()}
+        self.grams = KeyTable(self, cast(GRAM_KEYS))
+        self.sounds = KeyTable(self, cast(SOUND_KEYS))
+        self.encoder = PhoneticEncoder(self.lang)
+
+    @property
+    def size(self):
+        return len(self.map)
+
+    def verify(self):
+        """Check the checksum, which reads the whole file.
+        Returns: False if the snapshot is damaged. Raises ValueError if it
+        was closed"""
+        self.verified = (zlib.crc32(memoryview(self.map)[HEADER.size:]) ==
+                         self.checksum)
+        return self.verified
+
+    def close(self):
+        """Unmap the file. Only safe once nothing reads the snapshot."""
+        for buffer in reversed(getattr(self, 'buffers', [])):
+            buffer.release()
+        self.buffers = []
+        try:
+            self.map.close()
+        except BufferError:
+            pass  # a caller still holds a slice; unmapped when it's freed
+
+    def string(self, string_id):
+        start, end = self.string_offsets[string_id:string_id + 2]
+        return str(self.string_data[start:end], 'utf-8', 'surrogateescape')
+
+    def track_count(self):
+        return len(self.sizes)
+
+    def track_string(self, track_id, field):
+        string_id = self.track_strings[
+            track_id * len(TRACK_STRING_FIELDS) +
+            TRACK_STRING_FIELDS.index(field)]
+        return self.string(string_id) if string_id else None
+
+    def path(self, track_id):
+        return os.path.join(self.track_string(track_id, 'folder'),
+                            self.track_string(track_id, 'filename'))
+
+    def record(self, track_id):
+        """Returns: the track as a dict, like SongDatabase.read_track"""
+        record = {'path': self.path(track_id),
+                  'duration': self.durations[track_id] or None,
+                  'size': self.sizes[track_id],
+                  'mtime': self.mtimes[track_id]}
+        for field in TRACK_STRING_FIELDS[2:]:
+            record[field] = self.track_string(track_id, field)
+        return record
+
+    def find_track(self, path):
+        """Returns: id of the track at 'path', or None"""
+        paths = SnapshotSequence(self.path_order, self.path)
+        i = bisect.bisect_left(paths, path)
+        if i < len(paths) and paths[i] == path:
+            return self.path_order[i]
+        return None
+
+    def candidates(self, query, kind, limit=MAX_CANDIDATES):
+        """Like NgramIndex.candidates"""
+        return self.search(query, (kind,), limit)[kind]
+
+    def search(self, query, kinds, limit=MAX_CANDIDATES):
+        """Like NgramIndex.search"""
+        grams = ngrams(query, self.n)
+        counts = Counter()
+        for gram in grams:
+            i = self.grams.find(gram)
+            if i is not None:
+                counts.update(self.grams.postings(i))
+        found = rank(counts, len(grams), lambda name: self.names[name * 3 + 2],
+                     lambda name: KIND_SETS[self.names[name * 3 + 1]],
+                     kinds, limit)
+        return {kind: [self.string(self.names[name * 3]) for name in names]
+                for kind, names in found.items()}
+
+    def lookup(self, query, kinds):
+        """Like PhoneticIndex.lookup"""
+        found = {kind: set() for kind in kinds}
+        for key in self.encoder.keys(query):
+            i = self.sounds.find(key)
+            if i is None:
+                continue
+            for name in self.sounds.postings(i):
+                for kind in KIND_SETS[self.names[name * 3 + 1]]:
+                    if kind in found:
+                        found[kind].add(self.string(self.names[name * 3]))
+        return found
+
+
+class SnapshotSequence:
+    """Sequence of the values 'decode' gives for the numbers in 'ids',
+    for bisecting sorted tables without decoding all of them."""
+    def __init__(self, ids, decode):
+        self.ids = ids
+        self.decode = decode
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, i):
+        return self.decode(self.ids[i])
+
+
+class KeyTable:
+    """Sorted (key string id, posting start, posting count) entries."""
+    def __init__(self, snapshot, entries):
+        self.snapshot = snapshot
+        self.entries = entries
+
+    def __len__(self):
+        return len(self.entries) // 3
+
+    def key(self, i):
+        return self.snapshot.string(self.entries[i * 3])
+
+    def find(self, key):
+        """Returns: the entry number of 'key', or None"""
+        keys = SnapshotSequence(range(len(self)), self.key)
+        i = bisect.bisect_left(keys, key)
+        if i < len(self) and self.key(i) == key:
+            return i
+        return None
+
+    def postings(self, i):
+        start, count = self.entries[i * 3 + 1:i * 3 + 3]
+        return self.snapshot.postings[start:start + count]
+
+
+class SnapshotPathView(Mapping):
+    """Read-only title -> file path view of a snapshot."""
+    def __init__(self, snapshot, kind):
+        self.snapshot = snapshot
+        self.table = snapshot.keys[kind]
+
+    def value(self, postings):
+        return self.snapshot.path(postings[0])
+
+    def __getitem__(self, name):
+        i = self.table.find(name)
+        if i is None:
+            raise KeyError(name)
+        return self.value(self.table.postings(i))
+
+    def __contains__(self, name):
+        return self.table.find(name) is not None
+
+    def __iter__(self):
+        return (self.table.key(i) for i in range(len(self.table)))
+
+    def __len__(self):
+        return len(self.table)
+
+
+class SnapshotPathListView(SnapshotPathView):
+    """Read-only artist/album/genre -> list of file paths view."""
+    def value(self, postings):
+        return [self.snapshot.path(track_id) for track_id in postings]
+
+
+class SnapshotPlaylistView(SnapshotPathView):
+    """Read-only playlist name -> file path view."""
+    def value(self, postings):
+        return self.snapshot.string(postings[0])
+
+
+class SnapshotRecordView(Mapping):
+    """Read-only file path -> track dict view of a snapshot."""
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
+
+    def __getitem__(self, path):
+        track_id = self.snapshot.find_track(path)
+        if track_id is None:
+            raise KeyError(path)
+        return self.snapshot.record(track_id)
+
+    def __contains__(self, path):
+        return self.snapshot.find_track(path) is not None
+
+    def __iter__(self):
+        return (self.snapshot.path(track_id)
+                for track_id in range(self.snapshot.track_count()))
+
+    def __len__(self):
+        return self.snapshot.track_count()
+
+
+class SnapshotWriter:
+    """Collects the contents of a SongDatabase into snapshot sections."""
+    def __init__(self):
+        self.strings = {}
+        self.string_list = [None]  # string id 0 stands for None
+        self.postings = array('I')
+
+    def intern(self, string):
+        string_id = self.strings.get(string)
+        if string_id is None:
+            string_id = self.strings[string] = len(self.string_list)
+            self.string_list.append(string)
+        return string_id
+
+    def key_table(self, items):
+        """Arguments:
+            items (iterable): (key, list of posting values)
+        Returns: array of sorted (key string id, start, count) entries
+        """
+        entries = array('I')
+        for key, values in sorted(items, key=lambda item: item[0]):
+            entries.extend((self.intern(key), len(self.postings),
+                            len(values)))
+            self.postings.extend(values)
+        return entries
+
+    def build(self, database, generation, lang):
+        """Returns: the snapshot file contents as bytes"""
+        store = database.store
+        sections = [None] * SECTION_COUNT
+
+        # tracks are renumbered 0..n-1, skipping free slots in the store
+        store_ids = list(store.ids())
+        track_ids = {store_id: i for i, store_id in enumerate(store_ids)}
+        track_strings = array('I')
+        paths = []
+        for store_id in store_ids:
+            record = store.record(store_id)
+            folder, filename = os.path.split(record['path'])
+            paths.append(record['path'])
+            track_strings.extend(
+                self.intern(value) if value is not None else 0
+                for value in [folder, filename] + [
+                    record[field] for field in TRACK_STRING_FIELDS[2:]])
+        sections[TRACK_STRINGS] = track_strings
+        sections[DURATIONS] = array('d', (store.duration[i] or 0.0
+                                          for i in store_ids))
+        sections[SIZES] = array('q', (store.size[i] for i in store_ids))
+        sections[MTIMES] = array('d', (store.mtime[i] for i in store_ids))
+        sections[PATH_ORDER] = array('I', sorted(range(len(paths)),
+                                                 key=paths.__getitem__))
+
+        # every indexed name with the kinds it names. The database only
+        # builds its n-gram index once a search needs it
+        search_index = (database.ngram_index if database.ngram_ready
+                        else database.build_ngram_index())
+        name_ids = {}
+        names = array('I')
+        # in name order, so ranking ties broken by name id come out the
+        # same as those broken by name in the store (see search_index.rank)
+        for name, kinds in sorted(search_index.kinds.items()):
+            name_ids[name] = len(name_ids)
+            names.extend((self.intern(name),
+                          sum(1 << KINDS.index(kind) for kind in kinds),
+                          search_index.sizes[name]))
+        sections[NAMES] = names
+
+        sections[TRACK_KEYS] = self.key_table(
+            (title, [track_ids[track_id]])
+            for title, track_id in database.title_ids.items())
+        for kind in ('artists', 'albums', 'genres'):
+            sections[KIND_SECTIONS[kind]] = self.key_table(
+                (name, [track_ids[track_id] for track_id in ids])
+                for name, ids in database.group_ids[kind].items())
+        sections[PLAYLIST_KEYS] = self.key_table(
+            (name, [self.intern(path)])
+            for name, path in database.playlist_paths.items())
+        sections[GRAM_KEYS] = self.key_table(
+            (gram, sorted(name_ids[name] for name in gram_names))
+            for gram, gram_names in search_index.postings.items())
+        sections[SOUND_KEYS] = self.key_table(
+            (key, sorted({name_ids[name] for names in kinds.values()
+                          for name in names if name in name_ids}))
+            for key, kinds in database.sound_index.names.items())
+        sections[POSTINGS] = self.postings
+
+        # strings go last, every section above adds to them
+        data = bytearray()
+        offsets = array('I', [0, 0])
+        for string in self.string_list[1:]:
+            data += string.encode('utf-8', 'surrogateescape')
+            offsets.append(len(data))
+        sections[STRING_OFFSETS] = offsets
+        sections[STRING_DATA] = bytes(data)
+
+        return pack(sections, generation, search_index.n, lang)
+
+
+def pack(sections, generation, n, lang):
+    """Lay out the header, section table and sections (each aligned to 8
+    bytes so they can be cast to arrays in place)."""
+    table = bytearray()
+    body = bytearray()
+    start = HEADER.size + SECTION_COUNT * SECTION.size
+    for section in sections:
+        data = section.tobytes() if isinstance(section, array) else section
+        table += SECTION.pack(start + len(body), len(data))
+        body += data
+        body += b'\0' * (-len(body) % 8)
+    contents = table + body
+    header = HEADER.pack(MAGIC, SNAPSHOT_VERSION, sys.byteorder == 'big',
+                         SECTION_COUNT, zlib.crc32(contents), generation, n,
+                         lang.encode()[:14])
+    return header + contents
+
+
+def write_snapshot(path, database, generation, lang):
+    """Write a snapshot of 'database', which mustn't change meanwhile (a
+    copy of it taken by SongDatabase.snapshot_copy, or one whose lock the
+    caller holds).
+
+    The file is replaced atomically, so processes that have the old
+    snapshot mapped keep reading it undisturbed.
+    """
+    contents = SnapshotWriter().build(database, generation, lang)
+    temp_path = path + '.tmp'
+    with open(temp_path, 'wb') as f:
+        f.write(contents)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, path)
+    return len(contents)
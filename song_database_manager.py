@@ -1,123 +1,333 @@
 from mycroft.util.parse import match_one, fuzzy_match
 from pathlib import Path
+import copy
+import hashlib
 import os.path
 from tinytag import TinyTag
 import random
+import sys
+import time
+from array import array
+import threading
+import heapq
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeout
+from mycroft.util.log import LOG
+from .library_index import LibraryIndex
+from .metrics import tracer
+from .scan_throttle import ScanThrottle, lower_priority
+from .search_index import NgramIndex
+from .phonetic import PhoneticIndex
+from .shuffle import FeistelPermutation
+from .playlists import PlaylistCache, playlist_paths
+from .snapshot import Snapshot, SnapshotError, write_snapshot
+from .track_store import TrackStore, RecordView, PathView, PathListView
+
+MUSIC_EXTENSIONS = ('.mp3', '.aac', '.cda', '.flac', '.ogg', '.opus', '.wma',
+                    '.zab')
+PLAYLIST_EXTENSIONS = ('.asx', '.xspf', '.b4s', '.m3u', '.m3u8')
+
+#number of scanned files added to the database at a time
+SCAN_BATCH_SIZE = 500
+
+#seconds a file's tags may take to read. Files that take longer (or can't
+#be read) are quarantined: left out of the library and skipped by later
+#scans until they change
+FILE_TIME_BUDGET = 5.0
+#seconds between checks on a read that hasn't finished yet
+READ_POLL_INTERVAL = 0.25
+#a read that timed out keeps its thread until it returns, if ever. A scan
+#that would leave more than this many such threads stops with a ScanError
+MAX_STUCK_READS = 8
+#number of slowest reads listed in scan summaries
+SLOWEST_FILES = 10
+
+#search dicts with more names than this are narrowed down with the n-gram
+#index before fuzzy matching
+FULL_MATCH_LIMIT = 200
+
+#a name that sounds like the query is used if nothing matched better than
+#this. It gets this confidence if the query's whole phonetic key matches,
+#less if only part of it does (see PhoneticEncoder.similarity)
+PHONETIC_CONFIDENCE = 0.75
+
+
+class ScanError(Exception):
+    """A scan stopped before it was done, e.g. because reads got stuck."""
+
+
+def shutdown_pool(pool, futures, wait=False):
+    #drops the futures that haven't started; shutdown(cancel_futures=True)
+    #needs Python 3.9
+    for future in futures:
+        future.cancel()
+    pool.shutdown(wait=wait)
 
 class SongDatabase:
-    def __init__(self, music_directory = str(Path.home()) + "/Music"):
+    def __init__(self, music_directory = str(Path.home()) + "/Music",
+                 index_path=None, scan_workers=4, lang='en-us'):
         #self.directory = music_directory
-        self.playlists = {}
-        self.artists = {}
-        self.albums = {}
-        self.tracks = {}
-        self.genres = {}
+        #number of threads listing folders and reading tags during a scan
+        self.scan_workers = max(1, scan_workers)
+        self.file_time_budget = FILE_TIME_BUDGET
+        #futures of reads that timed out and may still hold their thread
+        self.stuck_reads = []
+        #searches and scans running in other threads share the dicts below
+        self.lock = threading.RLock()
+        #stop events of the scans that are running (see new_scan); a scan's
+        #event is dropped from here when the scan ends
+        self.active_scans = weakref.WeakSet()
+        #paces scans and holds them while audio plays or the user speaks;
+        #scan threads run at low CPU and I/O priority
+        self.throttle = ScanThrottle()
+        #persistent copy of the library. With no index_path nothing is saved
+        self.index = LibraryIndex(index_path)
+        #library root -> its index shard. The music directory uses 'index';
+        #drives attached with add_root/attach_root have their own
+        self.roots = {}
+        #tracks are kept by id in a compact store (see track_store)
+        self.store = TrackStore()
+        self.title_ids = {} #title -> track id
+        self.group_ids = {'artists': {}, 'albums': {}, 'genres': {}}
+        self.playlist_records = {} #file path -> playlist dict
+        self.playlist_paths = {} #playlist name -> file path
+        #playlist contents as file paths, parsed ahead of playback
+        self.playlist_cache = PlaylistCache()
+        #n-gram index of the names in all of the search dicts, built when a
+        #search first needs it (see name_index)
+        self.ngram_index = NgramIndex()
+        self.ngram_ready = False
+        #names by how they sound, for names speech recognition misspelled
+        self.sound_index = PhoneticIndex(lang)
+        #memory-mapped copy of the search dicts, written after scans so the
+        #next startup can answer queries before the index is loaded
+        self.lang = lang
+        self.snapshot_path = (os.path.splitext(index_path)[0] + '.snapshot'
+                              if index_path else None)
+        self.snapshot = None
+        self.snapshot_generation = None
+        #held while the index is loaded into the store, so two threads
+        #switching from the snapshot to the store don't fill it at once
+        self.load_lock = threading.RLock()
+        self.snapshot_write_lock = threading.Lock()
+        self._use_store()
         self.previous_tracks = {}
         self.saved_tracks = {} #TODO - make a way to load and save saved tracks
 
     def get_random_song(self):
     #returns a single random song directory as a string
-        return random.choice(list(self.tracks.values()))
+        songs = self.get_random_song_list(1)
+        return songs[0] if songs else None
+
+    def get_random_song_list(self, count=400):
+    #returns a list of up to 'count' random song file directories. Track ids
+    #index straight into the store, so this takes O(count), not O(library)
+        with self.lock:
+            if self.snapshot is not None:
+                total = self.snapshot.track_count()
+                return [self.snapshot.path(track_id) for track_id in
+                        random.sample(range(total), min(count, total))]
+
+            store = self.store
+            count = min(count, len(store))
+            if count > len(store) // 2:
+                chosen = random.sample(list(store.ids()), count)
+            else:
+                #pick slots at random, skipping those of removed tracks
+                chosen = set()
+                while len(chosen) < count:
+                    track_id = random.randrange(len(store.filename))
+                    if store.filename[track_id] is not None:
+                        chosen.add(track_id)
+                chosen = list(chosen)
+                random.shuffle(chosen)
+            return [store.path(track_id) for track_id in chosen]
+
+    def shuffle_tracks(self, seed=None):
+        """Endless-feeling shuffle: yields every track of the library once,
+        in a random order, without building a shuffled list (see
+        shuffle.FeistelPermutation). Tracks removed while the shuffle runs
+        are skipped; tracks added meanwhile aren't included.
+
+        Arguments:
+            seed: the same seed gives the same order for the same library
+        Returns: generator of file paths
+        """
+        with self.lock:
+            snapshot = self.snapshot
+            size = (snapshot.track_count() if snapshot is not None
+                    else len(self.store.filename))
+        played = set() #paths yielded from the snapshot
+        for track_id in FeistelPermutation(size, seed):
+            with self.lock:
+                if snapshot is not None:
+                    if self.snapshot is not snapshot:
+                        break #closed
+                    path = snapshot.path(track_id)
+                    played.add(path)
+                else:
+                    live = (track_id < len(self.store.filename) and
+                            self.store.filename[track_id] is not None)
+                    path = self.store.path(track_id) if live else None
+            if path:
+                yield path
+        else:
+            return
+        #the index was loaded meanwhile; shuffle the rest from the store
+        for path in self.shuffle_tracks(seed):
+            if path not in played:
+                yield path
+
+    def playlist_entries(self, playlist_path):
+        """The entries of a playlist as local file paths, in playlist
+        order. The playlist is only read again after its file changed, so
+        replaying a long playlist doesn't touch it; changes to the library
+        don't matter, as the paths are looked up when it is played.
+
+        Arguments:
+            playlist_path (str): playlist file
+        Returns: tuple of file paths, None for entries that aren't local
+                 files (empty if the playlist can't be read)
+        """
+        try:
+            stat = os.stat(playlist_path)
+        except OSError:
+            return ()
+        with self.lock:
+            paths = self.playlist_cache.get(playlist_path, stat)
+        if paths is None:
+            paths = tuple(self.read_playlist_paths(playlist_path))
+            with self.lock:
+                self.playlist_cache.put(playlist_path, stat, paths)
+        return paths
 
-    def get_random_song_list(self):
-    #returns a list of random song file directories
-        num_songs = len(self.tracks.values())
-        if num_songs > 400:
-            return random.sample(list(self.tracks.values()), 400)
-        return random.sample(list(self.tracks.values()), num_songs)
+    def playlist_files(self, playlist_path):
+        """Returns: list of the playlist's files that are in the library,
+        in playlist order, ready to be handed to the audio service. They
+        are only looked up again after the playlist or the library
+        changed, so replaying a long playlist costs nothing."""
+        paths = self.playlist_entries(playlist_path)
+        with self.lock:
+            #a snapshot never changes; the store counts its changes
+            version = (self.snapshot.generation if self.snapshot is not None
+                       else None, self.store.version)
+            files = self.playlist_cache.get_files(playlist_path, paths,
+                                                  version)
+            if files is None:
+                files = [path for path in paths
+                         if path and path in self.track_records]
+                self.playlist_cache.put_files(playlist_path, paths, version,
+                                              files)
+        files = list(files)
+        if len(files) < len(paths):
+            LOG.info('{} of {} entries of {} are not in the library'.format(
+                len(paths) - len(files), len(paths), playlist_path))
+        return files
 
+    def prepare_playlists(self):
+        """Read every playlist ahead of time, so starting one only has to
+        look up its cached entries. Stops with stop_scan."""
+        abort = self.new_scan()
+        with self.lock:
+            paths = list(self.playlist_records)
+        for path in paths:
+            if abort.is_set():
+                break
+            self.playlist_entries(path)
+
+    def read_playlist_paths(self, playlist_path):
+        """Returns: list of the playlist's entries as local file paths (None
+        for entries that aren't local files), empty if it can't be read"""
+        tracer.count('file_opens')
+        try:
+            with tracer.span('read_playlist'):
+                return list(playlist_paths(playlist_path))
+        except (OSError, ValueError, SyntaxError) as e:
+            LOG.warning('Could not read playlist {}: {}'.format(
+                playlist_path, repr(e)))
+            return []
 
     def get_artists(self, song_files):
     #receives a list of song files
     #returns a list of artists who wrote songs
         artists = []
         for song in song_files:
-            tag = TinyTag(song)
-            artists.append(tag.artist)
+            record = self.get_track_record(song)
+            artists.append(record['artist'] if record else None)
         return artists
 
     def get_playlists(self):
         return self.playlists
 
+    def get_track_record(self, song):
+        """Input:   song    (file path or track title)
+           Output:  the track dict stored at scan time (see read_track) OR
+                    None if the song isn't in the library"""
+        return self.from_snapshot(self._get_track_record, song)
+
+    def _get_track_record(self, song):
+        with self.lock:
+            record = self.track_records.get(song)
+            if record is None and song in self.tracks:
+                record = self.track_records.get(self.tracks[song])
+        return record
+
     def get_song_info(self, song=None):
-        """returns the name of the artist of a known song
-        input: song title
-        return: dict of song info
+        """returns the tags of a known song, as read when it was scanned
+        input: song title or file path (or a list of them, then the first
+               song is used)
+        return: dict of song info OR None if the song isn't in the library
         """
         data_type = type(song)
         if data_type is list or data_type is tuple: #If it is a list of songs, get the info from the first song
-            return self.get_song_info(song[0])
+            return self.get_song_info(song[0]) if song else None
         if data_type is dict:
-            return self.get_song_info(song.values()[0])
-        else:
-            if song in self.tracks:
-                track_dir = self.tracks[song]
-                tag = TinyTag.get(track_dir)
-                info = {
-                'title': tag.title,
-                'artist': tag.artist,
-                'album': tag.album,
-                'album artist': tag.albumartist,
-                'genre': tag.genre,
-                'year': tag.year,
-                'dir': self.tracks[song]
-                }
-                return info
-            else:
-                #try: #try to open it as a filepath
-                tag = TinyTag.get(song)
-                info = {
-                'title': tag.title,
-                'artist': tag.artist,
-                'album': tag.album,
-                'album artist': tag.albumartist,
-                'genre': tag.genre,
-                'year': tag.year,
-                'dir': song
-                }
-                return info
-                """except:
-                    info = {
-                    'title': 'unknown',
-                    'artist': 'unknown',
-                    'album': 'unknown',
-                    'album artist': 'unknown',
-                    'genre': 'unknown',
-                    'year': 'unknown',
-                    'dir': 'unknown'
-                    }
-                    return info"""
+            return self.get_song_info(next(iter(song.values()), None))
+
+        record = self.get_track_record(song)
+        if not record:
+            return None
+        info = {
+        'title': record['title'],
+        'artist': record['artist'],
+        'album': record['album'],
+        'album artist': record['albumartist'],
+        'genre': record['genre'],
+        'year': record['year'],
+        'track': record['track'],
+        'duration': record['duration'],
+        'dir': record['path']
+        }
+        return info
 
     def get_artist_info(self, artist):
-        # input:    an artist name
+        # input:    an artist name, or a list of songs by that artist
+        #           (as returned by search_artists)
         #returns:   a tuple with artist name and
         #           list of all the songs written by that artist
         if type(artist) is list or type(artist) is tuple:
-            return artist, self.artists[artist[0]]
+            record = self.get_track_record(artist[0]) if artist else None
+            return (record['artist'] if record else None), list(artist)
         else:
-            return artist, self.artists[artist]
+            with self.lock:
+                return artist, self.artists[artist]
 
     def get_album_info(self, song_list):
         #takes a list of song files (presumably an album)
-        if song_list is list:
-            song_tags = TinyTag.get(song_list[0])
-            album = song_tags.album
-            artist = song_tags.albumartist
-
-        return album, artists, album
+        #returns a tuple with the album name and its artist
+        record = self.get_track_record(song_list[0]) if song_list else None
+        if not record:
+            return None, None
+        return record['album'], record['albumartist'] or record['artist']
 
     def get_genre_name(self, song):
         """Input:   song        (item(s) to get the genre of)
            Output:  genre_name  (name of the genre OR None)"""
-        if genre is list:
-            song_tags = TinyTag.get(song_list[0])
-            genre_names = song_tags.genre
-        elif genre is string:
-            song_tags = TinyTag.get(song_list)
-            genre_names = song_tags.genre
-        else:
-            return None
-        return genre_name
+        if type(song) is list or type(song) is tuple:
+            song = song[0] if song else None
+        record = self.get_track_record(song)
+        return record['genre'] if record else None
 
     def search(self, query, type):
         """Input:   query       (term to search for)
@@ -141,24 +351,21 @@ class SongDatabase:
         """Input:   query       (genre to search for)
            Output:  match       (a list of songs in the album) OR None (if no matches found)
                     confidence  (0.0 to 1.0)"""
-        match, confidence = match_one(query, self.genres)
+        match, confidence = self.match_in(query, 'genres')
         return match, confidence
 
     def search_playlists(self, query):
         """Input:   query       (playlist to search for)
            Output:  match       (a list of songs in the album) OR None (if no matches found)
                     confidence  (0.0 to 1.0)"""
-        if self.playlists:
-            match, confidence = match_one(query, self.playlists)
-            return match, confidence
-        else:
-            return None, 0.0
+        match, confidence = self.match_in(query, 'playlists')
+        return match, confidence
 
     def search_artists(self, query):
         """Input:   query       (artist name to search for)
            Output:  match       (a list of songs in the album) OR None (if no matches found)
                     confidence  (0.0 to 1.0)"""
-        match, confidence = match_one(query, self.artists)
+        match, confidence = self.match_in(query, 'artists')
         return match, confidence
 
     def search_albums(self, album_name, artist = "any_artist"):
@@ -167,23 +374,23 @@ class SongDatabase:
            Output:  match       (a list of songs in the album) OR None (if no matches found)
                     confidence  (0.0 to 1.0)"""
         #fuzzy match the album name
-        match, confidence = match_one(album_name, self.albums)
+        match, confidence = self.match_in(album_name, 'albums')
 
         #artist match within album
         if artist != "any_artist" and confidence > 0.1: #make sure there is a match. Confidence can be adjusted.
             #Check for album artist match
-            tag = TinyTag.get(match[0])
+            record = self.get_track_record(match[0])
             artist_confidence = 0
-            if tag.albumartist:
-                artist_confidence = fuzzy_match(tag.albumartist, artist)
+            if record and record['albumartist']:
+                artist_confidence = fuzzy_match(record['albumartist'], artist)
 
             # check for artist match on each song
             if artist_confidence < 0.7:
                 confidences = []
                 for song in match:
-                    tag = TinyTag.get(match)
-                    if tag.artist:
-                        artist_confidence = fuzzy_match(tag.artist, artist)
+                    record = self.get_track_record(song)
+                    if record and record['artist']:
+                        artist_confidence = fuzzy_match(record['artist'], artist)
                         confidences.append(artist_confidence)
                 #Choose the best artist from the songs
                 if confidences:
@@ -197,7 +404,7 @@ class SongDatabase:
                 #search again, but this time with "by" + artist
                 # Fixes problems with "by" in song name.
                 # Ex. "Cake by the ocean floor"
-                possible_match, possible_confidence = match_one(album_name + " by " + artist, self.albums)
+                possible_match, possible_confidence = self.match_in(album_name + " by " + artist, 'albums')
 
                 if possible_confidence > confidence:
                     match = possible_match
@@ -211,19 +418,20 @@ class SongDatabase:
 
 
     def search_tracks(self, track_name, artist = "any_artist"):
-        match, confidence = match_one(track_name, self.tracks)
+        match, confidence = self.match_in(track_name, 'tracks')
 
         #The rest of this code is to check artists
         if artist != "any_artist" and confidence > 0.1: #make sure there is a match. Confidence can be adjusted.
-            tag = TinyTag.get(match)
+            record = self.get_track_record(match)
             artist_confidence = 0
-            artist_confidence = fuzzy_match(tag.artist, artist)
+            if record and record['artist']:
+                artist_confidence = fuzzy_match(record['artist'], artist)
             if artist_confidence > 0.6:
                 confidence += artist_confidence / 2
             else:
             #search again, but this time with "by {}".format(artist)
             # Fixes problems with "by" in song name. Ex. "Cake by the ocean floor"
-                possible_match, possible_confidence = match_one(track_name + " by " + artist, self.albums)
+                possible_match, possible_confidence = self.match_in(track_name + " by " + artist, 'albums')
                 if possible_confidence > confidence:
                     match = possible_match
                     confidence = possible_confidence
@@ -231,8 +439,123 @@ class SongDatabase:
         if confidence > 1.0:
             confidence = 1.0
 
+        if match is None:
+            return None, 0.0
         return [match], confidence
 
+    def match_in(self, query, kind):
+        """match_one against one of the search dicts ('tracks', 'artists',
+        'albums', 'genres' or 'playlists'), safe to use while a scan is
+        filling it.
+
+        In large libraries the n-gram index first narrows the names down to
+        the few that share the most letter groups with the query, and only
+        those are fuzzy matched. Small libraries are matched in full. Of
+        names that match equally well the first in name order is used, so
+        the store and a snapshot give the same answer.
+        Returns: (None, 0.0) when there is nothing to match against"""
+        return self.from_snapshot(self._match_in, query, kind)
+
+    def _match_in(self, query, kind):
+        with self.lock:
+            choices = getattr(self, kind)
+            if not choices:
+                return None, 0.0
+            if len(choices) <= FULL_MATCH_LIMIT:
+                names = sorted(choices)
+            else:
+                with tracer.span('ngram_candidates'):
+                    names = self.name_index().candidates(query, kind)
+            match, confidence = None, 0.0
+            if names:
+                tracer.count('candidates_scored', len(names))
+                with tracer.span('fuzzy_match'):
+                    name, confidence = match_one(query, names)
+                match = choices[name]
+
+            if confidence < PHONETIC_CONFIDENCE:
+                name, sound_confidence = self.sounds_like(query, (kind,))[kind]
+                if sound_confidence > confidence:
+                    match, confidence = choices[name], sound_confidence
+            return match, confidence
+
+    def sounds_like(self, query, kinds):
+        """Second chance lookup of names that sound like the query
+        ("beat alls" -> "The Beatles"), for each of 'kinds'. A name scores
+        PHONETIC_CONFIDENCE scaled by how much of the query's phonetic key
+        it matches, or its fuzzy match if that is better.
+        Returns: dict of kind -> (name, confidence) OR (None, 0.0)"""
+        results = {}
+        with self.lock, tracer.span('phonetic'):
+            found = self.phonetic_index.lookup(query, kinds)
+            encoder = self.phonetic_index.encoder
+            for kind in kinds:
+                best = (None, 0.0)
+                for name in sorted(found[kind]):
+                    confidence = max(fuzzy_match(query, name),
+                                     PHONETIC_CONFIDENCE *
+                                     encoder.similarity(query, name))
+                    if confidence > best[1]:
+                        best = (name, confidence)
+                results[kind] = best
+        return results
+
+    def search_all(self, query, kinds=('playlists', 'artists', 'tracks',
+                                        'albums')):
+        """Search several kinds of names for the same query in one pass.
+
+        The n-gram postings are walked once for all kinds, and a name that
+        is e.g. both an album and a song title is only fuzzy matched once.
+        Kinds without a good match get the phonetic second chance.
+
+        Input:   query  (term to search for)
+                 kinds  (search dicts to look in)
+        Output:  dict of kind -> (name, match, confidence), where match is
+                 what the matching search_* method returns (a list of songs,
+                 or the playlist file) OR (None, None, 0.0) for no match
+        """
+        return self.from_snapshot(self._search_all, query, kinds)
+
+    def _search_all(self, query, kinds):
+        results = {}
+        scores = {}
+        with self.lock:
+            #small dicts are matched in full, like match_in does
+            large = [kind for kind in kinds
+                     if len(getattr(self, kind)) > FULL_MATCH_LIMIT]
+            with tracer.span('ngram_candidates'):
+                candidates = (self.name_index().search(query, large)
+                              if large else {})
+            for kind in kinds:
+                if kind not in large:
+                    candidates[kind] = sorted(getattr(self, kind))
+
+            with tracer.span('fuzzy_match'):
+                for kind in kinds:
+                    choices = getattr(self, kind)
+                    best = (None, None, 0.0)
+                    for name in candidates[kind]:
+                        if name not in scores:
+                            scores[name] = fuzzy_match(query, name)
+                        if scores[name] > best[2] or best[0] is None:
+                            best = (name, choices[name], scores[name])
+                    results[kind] = best
+            tracer.count('candidates_scored', len(scores))
+
+            weak = [kind for kind in kinds
+                    if results[kind][2] < PHONETIC_CONFIDENCE]
+            if weak:
+                for kind, (name, confidence) in \
+                        self.sounds_like(query, weak).items():
+                    if confidence > results[kind][2]:
+                        results[kind] = (name, getattr(self, kind)[name],
+                                         confidence)
+
+            if results.get('tracks', (None,))[0] is not None:
+                name, match, confidence = results['tracks']
+                results['tracks'] = (name, [match], confidence)
+        return results
+
     def add_to_queue(self, location):
         success = False
         return success #TODO - make it. It's empty
@@ -241,59 +564,1144 @@ class SongDatabase:
         title = title.replace('-', ' ')
         return Path(title).stem
 
-    def load_database(self, directory= str(Path.home()) + "/Music", music_extension=(
-            '.mp3', '.aac', '.cda', '.flac', '.ogg', '.opus', '.wma', '.zab'),
-        playlist_extension=('.asx', '.xspf', '.b4s', '.m3u', 'm3u8')):
-
-        for root, subfolder, files in os.walk(directory):
-            for item in files:
-                # check for music files
-                if music_extension and item.lower().endswith(music_extension):
-                    file_path = os.path.join(root, item)
-                    tag = TinyTag.get(file_path)
-                    #adds song name and its path to tracks Dict.
-                    if tag.title:
-                        self.tracks[tag.title] = file_path
-                    else:
-                        self.tracks[self.to_standard_title(item)] = file_path
-
-                    #ARTIST: creates a list of tracks under each artist
-                    if tag.artist in self.artists:
-                        self.artists[tag.artist].append(file_path)
-                    else:
-                        self.artists[tag.artist] = [file_path]
-
-                    #ALBUM: adds a list of tracks to each album
-                    if tag.album in self.albums:
-                        self.albums[tag.album].append(file_path)
-                    else:
-                        self.albums[tag.album] = [file_path]
-
-                    #GENRE: adds a list of tracks to each genre
-                    if tag.genre in self.genres:
-                        self.genres[tag.genre].append(file_path)
-                    else:
-                        self.genres[tag.genre] = [file_path]
-
-                # check for playlist files
-                elif playlist_extension and item.lower().endswith(playlist_extension):
-                    file_path = os.path.join(root, item)
-                    self.playlists[self.to_standard_title(item)] = file_path
-
-        if self.albums[None]:
-            #self.albums['unknown album'] = self.albums[None]
-            del self.albums[None]
-        if self.genres[None]:
-            #self.genres['unknown genre'] = self.genres[None]
-            del self.genres[None]        
-        if self.artists[None]:
-            #self.artists['unknown artist'] = self.artists[None]
-            del self.artists[None]
-
-
-        #Debugging
-        #for album in self.albums:
-        #    print(album)
+    def load_database(self, directory= str(Path.home()) + "/Music",
+                      music_extension=MUSIC_EXTENSIONS,
+                      playlist_extension=PLAYLIST_EXTENSIONS, rescan=False,
+                      progress=None, details=True, abort=None):
+        """Fill the search dicts for the music in 'directory'.
+
+        The persistent index is used when it already holds a scan of the
+        same directory, so the files don't have to be opened again. Otherwise
+        (or when 'rescan' is True) the directory is scanned and the result
+        is saved to the index for the next startup. A scan that was
+        interrupted carries on where it stopped.
+
+        Arguments:
+            details (bool): see rescan
+            abort (threading.Event): see rescan
+        Returns: the rescan summary, or None if no scan was needed
+        """
+        abort = self.new_scan(abort)
+        with self.lock:
+            #the music directory comes first, then any drives added
+            self.roots = dict([(directory, self.index)] +
+                              [(root, index) for root, index in
+                               self.roots.items() if root != directory])
+        stored = self.index.get_meta('directory')
+        if stored not in (None, directory):
+            self.index.clear()
+        elif stored is not None:
+            with tracer.span('open_snapshot'):
+                opened = self.open_snapshot()
+            if opened and not rescan:
+                return None
+        with tracer.span('load_index'):
+            self.load_from_index()
+        roots = [root for root, index in self.root_items()
+                 if rescan or not index.is_complete()]
+        if roots:
+            return self.rescan_roots(roots, music_extension,
+                                     playlist_extension, progress, details,
+                                     abort)
+        self.save_snapshot()
+        return None
+
+    def load_from_index(self):
+        """Fill the search dicts from the persistent index (every attached
+        shard of it) without touching the music files."""
+        with self.load_lock:
+            self._load_from_index()
+
+    def _load_from_index(self):
+        tracks = []
+        playlists = []
+        for root, index in self.root_items() or [(None, self.index)]:
+            tracks.extend(index.load_tracks())
+            playlists.extend(index.load_playlists())
+        if self.snapshot is None:
+            self.fill_database(tracks, playlists)
+            return
+        #queries are answered from the snapshot meanwhile; only switching
+        #over to the filled store has to wait for them
+        self._fill_database(tracks, playlists)
+        with self.lock:
+            self._use_store()
+
+    def rescan(self, directory= str(Path.home()) + "/Music",
+               music_extension=MUSIC_EXTENSIONS,
+               playlist_extension=PLAYLIST_EXTENSIONS, progress=None,
+               details=True, abort=None):
+        """Bring the database up to date with the files in 'directory'.
+
+        Only files that are new or whose size or modification time changed
+        have their tags read again, and tracks whose files are gone are
+        dropped. Folders whose modification time is unchanged since the
+        last scan aren't listed again; their known files are only stat'ed.
+
+        Folder listing and tag reading are spread over scan_workers threads
+        (the time goes into waiting on the disk, not into Python). Results
+        are merged here, in os.walk order, so the search dicts come out the
+        same as with a single thread.
+
+        Arguments:
+            progress (function): called as progress(files read, files to
+                                 read) while tags are being read
+            details (bool): also read each file's duration, bitrate and
+                            sample rate. Working out the duration can mean
+                            reading much of the file (VBR MP3s); without it
+                            only the tags at the start are read, and
+                            read_details fills in the rest later.
+            abort (threading.Event): stop event of a larger scan this one
+                                     is part of; None for a scan of its own
+                                     (see new_scan)
+        Returns: dict with the number of 'added', 'changed' and 'removed'
+                 files, whether the scan is 'complete' (False when it was
+                 stopped with stop_scan), the 'elapsed' time in seconds,
+                 the number of files whose tags were read ('files_read') in
+                 how many seconds ('read_seconds'), the number of files
+                 'quarantined' and the 'slowest' reads (see read_files)
+        """
+        start = time.monotonic()
+        abort = self.new_scan(abort)
+        self.ensure_loaded()
+        with self.lock:
+            if not self.roots:
+                self.roots[directory] = self.index
+            index = self.roots.get(directory)
+            known = [path for path in
+                     list(self.track_records) + list(self.playlist_records)
+                     if self.root_of(path) == directory]
+        if index is None:
+            #the root was detached (e.g. its drive unplugged)
+            return {'added': 0, 'changed': 0, 'removed': 0,
+                    'complete': False, 'elapsed': 0.0, 'files_read': 0,
+                    'read_seconds': 0.0, 'quarantined': 0, 'slowest': []}
+        #the files read are saved as the scan goes; mark whose they are, so
+        #an interrupted scan is continued rather than thrown away
+        index.set_meta('directory', directory)
+        known_dirs = index.load_directories()
+        extensions = (music_extension or ()) + (playlist_extension or ())
+        #quarantined files are looked at again in case they were fixed
+        known.extend(path for path in index.load_quarantine()
+                     if path not in self.track_records)
+
+        #music and playlist files the index knows of, grouped by folder
+        known_files = {}
+        for path in known:
+            known_files.setdefault(os.path.dirname(path), []).append(path)
+
+        def list_folder(folder):
+            return self.list_folder(folder, known_dirs.get(folder),
+                                    known_files.get(folder, []), extensions,
+                                    abort)
+
+        with ThreadPoolExecutor(max_workers=self.scan_workers,
+                                initializer=lower_priority) as pool, \
+                tracer.span('scan_folders'):
+            #list the folders one level at a time, each level in parallel
+            listed = {}
+            level = [directory]
+            while level:
+                next_level = []
+                for folder, result in zip(level, pool.map(list_folder, level)):
+                    if result is None:
+                        continue #folder was removed, its files are dropped
+                    listed[folder] = result
+                    next_level.extend(os.path.join(folder, name)
+                                      for name in result[1])
+                level = next_level
+
+            #walk the listings top-down like os.walk to keep the file order
+            scanned_dirs = {}
+            files = []
+            folders = [directory]
+            while folders:
+                folder = folders.pop()
+                if folder not in listed:
+                    continue
+                mtime, subfolders, folder_files = listed[folder]
+                scanned_dirs[folder] = (mtime, subfolders)
+                files.extend(folder_files)
+                folders.extend(os.path.join(folder, name)
+                               for name in reversed(subfolders))
+
+            seen = set(file_path for file_path, stat in files)
+        read_start = time.monotonic()
+        with tracer.span('scan_files'):
+            read = self.read_files(files, music_extension, progress, details,
+                                   abort)
+        read_seconds = time.monotonic() - read_start
+
+        #a drive unplugged during the scan looks like its files were
+        #deleted; keep its shard as it was
+        complete = (not abort.is_set() and directory in listed and
+                    self.roots.get(directory) is index)
+        removed = []
+        if complete:
+            removed = [path for path in known if path not in seen]
+            self.drop_files(removed)
+            index.save_directories(directory, scanned_dirs)
+            with tracer.span('save_snapshot'):
+                self.save_snapshot()
+        if progress:
+            progress(read['read'], read['queued'])
+
+        return {'added': read['added'],
+                'changed': read['changed'],
+                'removed': len(removed),
+                'complete': complete,
+                'elapsed': time.monotonic() - start,
+                'files_read': read['read'],
+                'read_seconds': read_seconds,
+                'quarantined': read['quarantined'],
+                'slowest': read['slowest']}
+
+    def rescan_roots(self, roots, music_extension=MUSIC_EXTENSIONS,
+                     playlist_extension=PLAYLIST_EXTENSIONS, progress=None,
+                     details=True, abort=None):
+        """rescan each of 'roots' in turn, as one scan.
+        Returns: dict like the one returned by rescan, summed over roots"""
+        abort = self.new_scan(abort)
+        summary = {'added': 0, 'changed': 0, 'removed': 0, 'complete': True,
+                   'elapsed': 0.0, 'files_read': 0, 'read_seconds': 0.0,
+                   'quarantined': 0, 'slowest': []}
+        for root in roots:
+            if abort.is_set():
+                summary['complete'] = False
+                break
+            result = self.rescan(root, music_extension, playlist_extension,
+                                 progress, details, abort)
+            for key in ('added', 'changed', 'removed', 'elapsed',
+                        'files_read', 'read_seconds', 'quarantined'):
+                summary[key] += result[key]
+            summary['slowest'] = sorted(
+                summary['slowest'] + result['slowest'],
+                key=lambda item: -item[1])[:SLOWEST_FILES]
+            summary['complete'] = summary['complete'] and result['complete']
+        return summary
+
+    def root_items(self):
+        """Returns: list of (root, index shard) of the attached roots"""
+        with self.lock:
+            return list(self.roots.items())
+
+    def root_of(self, path):
+        """Returns: the attached root 'path' is in (the innermost one if
+        roots are nested), or None"""
+        best = None
+        for root in list(self.roots):
+            if ((path == root or path.startswith(root.rstrip(os.sep) + os.sep))
+                    and (best is None or len(root) > len(best))):
+                best = root
+        return best
+
+    def add_root(self, root, shard_path=None):
+        """Register another library root (e.g. a USB drive) with its own
+        index shard, without loading it. Roots added before load_database
+        are loaded and scanned along with the music directory.
+
+        Arguments:
+            root (str):       folder to add, usually a mount point
+            shard_path (str): database file of the root's index shard;
+                              None keeps it in memory only
+        Returns: the root's LibraryIndex
+        """
+        with self.lock:
+            if root in self.roots:
+                return self.roots[root]
+        index = LibraryIndex(shard_path)
+        if index.get_meta('directory') not in (None, root):
+            #mounted somewhere else this time; the paths in it are wrong
+            index.clear()
+        with self.lock:
+            return self.roots.setdefault(root, index)
+
+    def attach_root(self, root, shard_path=None,
+                    music_extension=MUSIC_EXTENSIONS,
+                    playlist_extension=PLAYLIST_EXTENSIONS, progress=None,
+                    details=True):
+        """Add a library root and make its tracks searchable.
+
+        The tracks saved in the root's shard are added to the search dicts
+        straight away (no files are read), then the root is rescanned to
+        pick up changes made while it was away. A new root is simply
+        scanned. Other roots aren't touched.
+
+        Arguments:
+            details (bool): see rescan
+        Returns: the rescan summary
+        """
+        with self.lock:
+            attached = root in self.roots
+            in_snapshot = self.snapshot is not None
+        index = self.add_root(root, shard_path)
+        if in_snapshot:
+            #loads every attached shard, this one included
+            self.load_from_index()
+        elif not attached:
+            tracks = index.load_tracks()
+            for start in range(0, len(tracks), SCAN_BATCH_SIZE):
+                with self.lock:
+                    for track in tracks[start:start + SCAN_BATCH_SIZE]:
+                        self.add_track(track)
+            with self.lock:
+                for playlist in index.load_playlists():
+                    self.add_playlist(playlist)
+        return self.rescan(root, music_extension, playlist_extension,
+                           progress, details)
+
+    def detach_root(self, root):
+        """Remove a library root, e.g. when its drive was unplugged. Its
+        tracks are dropped from the search dicts but kept in its shard, so
+        attaching it again doesn't need a full scan. Other roots aren't
+        touched.
+        Returns: number of tracks and playlists removed"""
+        with self.lock:
+            index = self.roots.pop(root, None)
+            in_snapshot = self.snapshot is not None
+            before = len(self.track_records) + len(self.playlists)
+        if index is None:
+            return 0
+        if in_snapshot:
+            #the snapshot can't be changed; load the remaining shards
+            self.load_from_index()
+            with self.lock:
+                after = len(self.track_records) + len(self.playlists)
+            return before - after
+        with self.lock:
+            prefix = root.rstrip(os.sep) + os.sep
+            paths = self.store.paths_under(root) + [
+                path for path in self.playlist_records
+                if path.startswith(prefix)]
+            paths = [path for path in paths if self.root_of(path) is None]
+            for path in paths:
+                self.remove_file(path)
+        return len(paths)
+
+    def update_files(self, paths, music_extension=MUSIC_EXTENSIONS,
+                     playlist_extension=PLAYLIST_EXTENSIONS):
+        """Apply a batch of changed paths (e.g. from the library watcher)
+        without rescanning the whole library.
+
+        Arguments:
+            paths (iterable): files or folders that were created, modified,
+                              moved or deleted
+        Returns: dict like the one returned by rescan
+        """
+        start = time.monotonic()
+        abort = self.new_scan()
+        self.ensure_loaded()
+        extensions = (music_extension or ()) + (playlist_extension or ())
+        files = []
+        gone = []
+        for path in set(paths):
+            if os.path.isdir(path):
+                for root, subfolders, items in os.walk(path):
+                    files.extend(os.path.join(root, item) for item in items
+                                 if item.lower().endswith(extensions))
+            elif os.path.exists(path):
+                if path.lower().endswith(extensions):
+                    files.append(path)
+            else:
+                gone.append(path)
+
+        with self.lock:
+            known = list(self.track_records) + list(self.playlist_records)
+        gone_files = set(gone).intersection(known)
+        #anything else that is gone was a folder; drop everything inside it
+        prefixes = tuple(path.rstrip(os.sep) + os.sep
+                         for path in gone if path not in gone_files)
+        if prefixes:
+            gone_files.update(path for path in known
+                              if path.startswith(prefixes))
+        self.drop_files(gone_files)
+
+        stats = []
+        #a file is listed twice when both it and its new folder changed
+        for file_path in dict.fromkeys(files):
+            try:
+                stats.append((file_path, os.stat(file_path)))
+            except OSError:
+                pass
+        read_start = time.monotonic()
+        read = self.read_files(stats, music_extension, abort=abort)
+
+        return {'added': read['added'],
+                'changed': read['changed'],
+                'removed': len(gone_files),
+                'complete': not abort.is_set(),
+                'elapsed': time.monotonic() - start,
+                'files_read': read['read'],
+                'read_seconds': time.monotonic() - read_start,
+                'quarantined': read['quarantined'],
+                'slowest': read['slowest']}
+
+    def read_files(self, files, music_extension, progress=None,
+                   details=True, abort=None):
+        """Read the tags of new and changed files in scan_workers threads
+        and add them to the database in batches, so searches see a partial
+        library while a long scan is still running.
+
+        Each file gets file_time_budget seconds. A file whose tags can't be
+        read, or take longer (its read is left to finish in the background
+        and ignored), is quarantined in its index shard and skipped by later
+        scans until its size or modification time changes. Once
+        MAX_STUCK_READS reads that timed out are still running, the scan
+        stops with a ScanError after saving what it read.
+
+        Arguments:
+            files (list):    (file path, os.stat result) of every file found
+            music_extension (tuple): extensions of music (not playlist) files
+            progress (function): see rescan
+            details (bool): see rescan
+            abort (threading.Event): see rescan
+        Returns: dict with the number of files 'queued' to be read, of
+                 those read that were 'added' or 'changed', of all files
+                 'read' and newly 'quarantined', and the 'slowest' reads
+                 as [file path, seconds] lists, slowest first
+        Raises: ScanError if too many reads are stuck
+        """
+        abort = self.new_scan(abort)
+        quarantine = self.load_quarantine()
+        to_read = []
+        known = set() #files in to_read that were read before
+        for file_path, stat in files:
+            fingerprint = (stat.st_size, stat.st_mtime)
+            known_fingerprint = self.fingerprint(file_path)
+            if known_fingerprint == fingerprint:
+                continue
+            entry = quarantine.get(file_path)
+            if entry and (entry['size'], entry['mtime']) == fingerprint:
+                continue
+            if known_fingerprint:
+                known.add(file_path)
+            to_read.append((file_path, stat))
+
+        started = {} #file path -> when its read started
+
+        def read_file(item):
+            file_path, stat = item
+            if not self.throttle.take(abort):
+                return None, 0.0, None #stopped
+            start = started[file_path] = time.monotonic()
+            try:
+                if file_path.lower().endswith(music_extension or ()):
+                    record = self.read_track(file_path, stat, details)
+                else:
+                    record = self.read_playlist(file_path, stat)
+                return record, time.monotonic() - start, None
+            except FileNotFoundError as e:
+                #gone since it was listed, e.g. its drive was unplugged
+                LOG.info('Could not read {}: {}'.format(file_path, repr(e)))
+                return None, time.monotonic() - start, None
+            except Exception as e:
+                #other OSErrors too: the folder's listing is saved, so a
+                #file that is just left out would never be read again
+                return None, time.monotonic() - start, repr(e)
+
+        pool = ThreadPoolExecutor(max_workers=self.scan_workers,
+                                  initializer=lower_priority)
+        futures = [pool.submit(read_file, item) for item in to_read]
+        slowest = [] #heap of the (seconds, file path) of the slowest reads
+        quarantined = []
+        batch = []
+        done = 0
+        added = changed = 0
+        stuck = 0
+        try:
+            for position, (file_path, stat) in enumerate(to_read):
+                result = self.wait_for_read(futures[position], file_path,
+                                            started, abort)
+                if abort.is_set():
+                    break
+                if result is None:
+                    record, seconds, error = (None, self.file_time_budget,
+                                              'timed out')
+                    #the stuck read keeps its thread; the reads that
+                    #haven't started yet go to new threads
+                    stuck = self.abandon_read(futures[position])
+                    shutdown_pool(pool, futures[position + 1:])
+                    if stuck < MAX_STUCK_READS:
+                        pool = ThreadPoolExecutor(
+                            max_workers=self.scan_workers,
+                            initializer=lower_priority)
+                        for later in range(position + 1, len(to_read)):
+                            if futures[later].cancelled():
+                                futures[later] = pool.submit(read_file,
+                                                             to_read[later])
+                else:
+                    record, seconds, error = result
+                    if error is None and seconds > self.file_time_budget:
+                        record, error = None, 'too slow'
+                heapq.heappush(slowest, (seconds, file_path))
+                if len(slowest) > SLOWEST_FILES:
+                    heapq.heappop(slowest)
+                if error:
+                    LOG.warning('Quarantined {} ({}, {:.1f} s)'.format(
+                        file_path, error, seconds))
+                    quarantined.append({'path': file_path,
+                                        'size': stat.st_size,
+                                        'mtime': stat.st_mtime,
+                                        'reason': error,
+                                        'seconds': seconds,
+                                        'time': time.time()})
+                    if stuck >= MAX_STUCK_READS:
+                        break
+                    continue
+                if record is None:
+                    continue
+                if file_path in known:
+                    changed += 1
+                else:
+                    added += 1
+                batch.append(record)
+                if len(batch) >= SCAN_BATCH_SIZE:
+                    done += len(batch)
+                    self.apply_records(batch)
+                    batch = []
+                    if progress:
+                        progress(done, len(to_read))
+        finally:
+            shutdown_pool(pool, futures, wait=not abort.is_set() and
+                          stuck < MAX_STUCK_READS)
+        done += len(batch)
+        self.apply_records(batch)
+        #a known file that broke is dropped with the tags it had
+        self.drop_files([entry['path'] for entry in quarantined
+                         if self.fingerprint(entry['path'])])
+        for index, entries in self.by_shard(
+                quarantined, key=lambda entry: entry['path']):
+            index.save_quarantine(entries)
+        if stuck >= MAX_STUCK_READS:
+            raise ScanError('{} file reads are stuck; stopped the scan after '
+                            'reading {} files'.format(stuck, done))
+        return {'queued': len(to_read),
+                'added': added,
+                'changed': changed,
+                'read': done,
+                'quarantined': len(quarantined),
+                'slowest': [[file_path, round(seconds, 3)] for
+                            seconds, file_path in sorted(slowest,
+                                                         reverse=True)]}
+
+    def abandon_read(self, future):
+        """Remember a read that timed out, as its thread is lost until the
+        read returns.
+        Returns: number of reads that timed out and are still running"""
+        with self.lock:
+            self.stuck_reads = [read for read in self.stuck_reads
+                                if not read.done()]
+            self.stuck_reads.append(future)
+            return len(self.stuck_reads)
+
+    def wait_for_read(self, future, file_path, started, abort):
+        """Returns: the result of a read_file future, or None if the read
+        has taken longer than file_time_budget (it is left running) or the
+        scan was stopped (abort is set)"""
+        while True:
+            try:
+                return future.result(timeout=READ_POLL_INTERVAL)
+            except FutureTimeout:
+                pass
+            if abort.is_set():
+                return None
+            start = started.get(file_path)
+            if (start is not None and
+                    time.monotonic() - start > self.file_time_budget):
+                return None
+
+    def load_quarantine(self):
+        """Returns: dict of file path -> quarantine entry (see
+        LibraryIndex.load_quarantine) of every attached shard"""
+        quarantine = {}
+        for root, index in self.root_items() or [(None, self.index)]:
+            quarantine.update(index.load_quarantine())
+        return quarantine
+
+    def drop_files(self, paths):
+        """Remove tracks/playlists from the index and the search dicts."""
+        paths = list(paths)
+        if not paths:
+            return
+        for index, shard_paths in self.by_shard(paths):
+            index.remove_records(shard_paths)
+        with self.lock:
+            for path in paths:
+                self.remove_file(path)
+
+    def new_scan(self, abort=None):
+        """Register a scan so stop_scan can stop it. Every scan has its own
+        stop event, so stopping the scans that run (e.g. at shutdown)
+        doesn't affect scans started later.
+
+        Arguments:
+            abort (threading.Event): stop event of a larger scan this one
+                                     is part of, which is used as it is
+        Returns: the scan's stop event. The scan stops when it is set; it
+                 is forgotten once the scan no longer holds it
+        """
+        if abort is None:
+            abort = threading.Event()
+            with self.lock:
+                self.active_scans.add(abort)
+        return abort
+
+    def stop_scan(self):
+        """Ask the running scans to stop. Tracks read so far are kept."""
+        with self.lock:
+            for abort in list(self.active_scans):
+                abort.set()
+
+    def read_details(self, roots=None, progress=None):
+        """Second phase of a scan with details=False: work out the duration,
+        bitrate and sample rate of the tracks whose tags were read without
+        them. Files are read one at a time in a background thread, so this
+        can run without competing with searches and playback for the disk.
+        It stops with stop_scan and carries on where it stopped when called
+        again.
+
+        Like tag reads (see read_files), each file gets file_time_budget
+        seconds. A file that takes longer is quarantined and stored without
+        details, so it isn't tried again until it changes.
+
+        Arguments:
+            roots (list):        library roots to do, None for all
+            progress (function): called as progress(files read, files to
+                                 read)
+        Returns: dict with the number of files 'read', whether all of them
+                 were read ('complete'), the number 'quarantined' and the
+                 'elapsed' time in seconds
+        Raises: ScanError if too many reads are stuck
+        """
+        start = time.monotonic()
+        abort = self.new_scan()
+        self.ensure_loaded()
+        shards = [(root, index) for root, index in self.root_items()
+                  if roots is None or root in roots]
+        todo = [(index, index.undetailed_paths()) for root, index in shards]
+        total = sum(len(paths) for index, paths in todo)
+        done = 0
+        quarantined = 0
+        started = {} #file path -> when its read started
+
+        def read_file(file_path):
+            if not self.throttle.take(abort):
+                return None #stopped
+            started[file_path] = time.monotonic()
+            return self.read_track_details(file_path)
+
+        pool = ThreadPoolExecutor(max_workers=1, initializer=lower_priority)
+        stuck = 0
+        try:
+            with tracer.span('scan_details'):
+                for index, paths in todo:
+                    for batch_start in range(0, len(paths), SCAN_BATCH_SIZE):
+                        if abort.is_set() or stuck >= MAX_STUCK_READS:
+                            break
+                        details = []
+                        timed_out = []
+                        for file_path in paths[batch_start:
+                                               batch_start + SCAN_BATCH_SIZE]:
+                            future = pool.submit(read_file, file_path)
+                            result = self.wait_for_read(future, file_path,
+                                                        started, abort)
+                            if abort.is_set():
+                                break
+                            if result is None:
+                                #the stuck read keeps its thread
+                                stuck = self.abandon_read(future)
+                                shutdown_pool(pool, [])
+                                pool = ThreadPoolExecutor(
+                                    max_workers=1, initializer=lower_priority)
+                                result = (file_path, None, None, None)
+                                timed_out.append(
+                                    self.details_timed_out(file_path))
+                            details.append(result)
+                            if stuck >= MAX_STUCK_READS:
+                                break
+                        index.save_details(details)
+                        index.save_quarantine(timed_out)
+                        with self.lock:
+                            for file_path, duration, bitrate, samplerate \
+                                    in details:
+                                self.store.set_duration(file_path, duration)
+                        done += len(details)
+                        quarantined += len(timed_out)
+                        if progress:
+                            progress(done, total)
+        finally:
+            shutdown_pool(pool, [], wait=not abort.is_set() and
+                          stuck < MAX_STUCK_READS)
+        if done:
+            self.save_snapshot()
+        if stuck >= MAX_STUCK_READS:
+            raise ScanError('{} file reads are stuck; stopped reading track '
+                            'details after {} files'.format(stuck, done))
+        return {'read': done,
+                'complete': done == total,
+                'quarantined': quarantined,
+                'elapsed': time.monotonic() - start}
+
+    def details_timed_out(self, file_path):
+        """Returns: the quarantine entry of a track whose details took
+        longer than file_time_budget to read"""
+        size, mtime = self.fingerprint(file_path) or (None, None)
+        LOG.warning('Quarantined {} (timed out reading details, '
+                    '{:.1f} s)'.format(file_path, self.file_time_budget))
+        return {'path': file_path,
+                'size': size,
+                'mtime': mtime,
+                'reason': 'timed out reading details',
+                'seconds': self.file_time_budget,
+                'time': time.time()}
+
+    def read_track_details(self, file_path):
+        """Returns: (file path, duration, bitrate, samplerate) of a music
+        file, with None values if it can't be read"""
+        tracer.count('file_opens')
+        try:
+            tag = TinyTag.get(file_path)
+        except Exception as e:
+            LOG.info('Could not read the duration of {}: {}'.format(
+                file_path, repr(e)))
+            return file_path, None, None, None
+        return file_path, tag.duration, tag.bitrate, tag.samplerate
+
+    def apply_records(self, records):
+        """Save a batch of scanned track/playlist dicts and add them to the
+        search dicts."""
+        tracks = []
+        playlists = []
+        for index, shard_records in self.by_shard(
+                records, key=lambda record: record['path']):
+            shard_tracks = [record for record in shard_records
+                            if 'title' in record]
+            shard_playlists = [record for record in shard_records
+                               if 'title' not in record]
+            index.save_records(shard_tracks, shard_playlists)
+            tracks.extend(shard_tracks)
+            playlists.extend(shard_playlists)
+        with self.lock:
+            for track in tracks:
+                self.add_track(track)
+            for playlist in playlists:
+                self.add_playlist(playlist)
+
+    def by_shard(self, items, key=None):
+        """Group paths (or records, with key returning the path) by the
+        index shard of their root. Items outside every attached root are
+        left out, e.g. the last files read from a drive that was unplugged.
+        Returns: list of (LibraryIndex, list of items)"""
+        groups = {}
+        with self.lock:
+            if not self.roots:
+                return [(self.index, list(items))]
+            for item in items:
+                root = self.root_of(key(item) if key else item)
+                if root is not None:
+                    groups.setdefault(root, []).append(item)
+            return [(self.roots[root], group) for root, group in groups.items()]
+
+    def generation(self):
+        """Returns: a number that changes whenever the attached roots or
+        any of their shards change, to tell whether a snapshot is up to
+        date. With only the music directory attached it is the index's."""
+        roots = self.root_items()
+        if not roots:
+            return self.index.generation()
+        if len(roots) == 1:
+            return roots[0][1].generation()
+        digest = hashlib.blake2b(digest_size=8)
+        for root, index in sorted(roots, key=lambda item: item[0]):
+            digest.update('{}\0{}\0'.format(root, index.generation())
+                          .encode('utf-8', 'surrogateescape'))
+        return int.from_bytes(digest.digest(), 'little') >> 1
+
+    def list_folder(self, folder, known_dir, known_files, extensions,
+                    abort):
+        """List one folder for rescan. Runs in the scan thread pool.
+
+        Arguments:
+            folder (str):       folder to list
+            known_dir (tuple):  (mtime, subfolders) from the last scan or None
+            known_files (list): music/playlist files indexed in this folder
+            extensions (tuple): file extensions to pick up
+            abort (threading.Event): the scan's stop event
+        Returns: (mtime, subfolders, [(file path, stat)]) or None if the
+                 folder can't be read
+        """
+        self.throttle.wait(abort)
+        try:
+            mtime = os.stat(folder).st_mtime
+        except OSError:
+            return None
+
+        if known_dir and known_dir[0] == mtime:
+            #nothing was added, removed or renamed in here
+            subfolders = known_dir[1]
+            paths = known_files
+        else:
+            subfolders = []
+            paths = []
+            try:
+                with os.scandir(folder) as entries:
+                    for entry in entries:
+                        if entry.is_dir():
+                            subfolders.append(entry.name)
+                        elif entry.name.lower().endswith(extensions):
+                            paths.append(entry.path)
+            except OSError:
+                return None
+
+        files = []
+        for file_path in paths:
+            try:
+                files.append((file_path, os.stat(file_path)))
+            except OSError:
+                pass
+        return mtime, subfolders, files
+
+    def read_track(self, file_path, stat=None, details=True):
+        """Read the tags of a music file.
+        Arguments:
+            details (bool): also work out the duration, bitrate and sample
+                            rate (see rescan)
+        Returns: dict keyed by library_index.TRACK_FIELDS"""
+        stat = stat or os.stat(file_path)
+        tracer.count('file_opens')
+        tag = TinyTag.get(file_path, duration=details)
+        return {
+            'path': file_path,
+            'title': tag.title,
+            'artist': tag.artist,
+            'album': tag.album,
+            'albumartist': tag.albumartist,
+            'genre': tag.genre,
+            #stored as text, like older tinytag versions return them
+            'year': None if tag.year is None else str(tag.year),
+            'track': None if tag.track is None else str(tag.track),
+            'duration': tag.duration if details else None,
+            'size': stat.st_size,
+            'mtime': stat.st_mtime,
+            'bitrate': tag.bitrate if details else None,
+            'samplerate': tag.samplerate if details else None,
+            'detailed': details
+        }
+
+    def read_playlist(self, file_path, stat=None):
+        """Returns: dict with the playlist's 'path', 'name', 'size', 'mtime'"""
+        stat = stat or os.stat(file_path)
+        return {'path': file_path,
+                'name': self.to_standard_title(os.path.basename(file_path)),
+                'size': stat.st_size,
+                'mtime': stat.st_mtime}
+
+    def fill_database(self, tracks, playlists):
+        """Rebuild the tracks/artists/albums/genres/playlists dicts
+        from track and playlist records."""
+        with self.lock:
+            self._fill_database(tracks, playlists)
+            self._use_store()
+
+    def _fill_database(self, tracks, playlists):
+        self.store.clear()
+        self.title_ids.clear()
+        for group in self.group_ids.values():
+            group.clear()
+        self.playlist_records = {}
+        self.playlist_paths.clear()
+        self.ngram_index.clear()
+        self.ngram_ready = False
+        self.sound_index.clear()
+
+        for track in tracks:
+            self.add_track(track)
+        for playlist in playlists:
+            self.add_playlist(playlist)
+
+    def _use_store(self):
+        """Search the in-memory store (instead of a snapshot, which is
+        closed). Call with the lock held.
+
+        tracks, artists, albums, genres and track_records are read-only
+        views of the store that work like the dicts of file paths they
+        used to be."""
+        if self.snapshot is not None:
+            self.snapshot.close()
+        self.snapshot = None
+        self.tracks = PathView(self.title_ids, self.store)
+        self.artists = PathListView(self.group_ids['artists'], self.store)
+        self.albums = PathListView(self.group_ids['albums'], self.store)
+        self.genres = PathListView(self.group_ids['genres'], self.store)
+        self.track_records = RecordView(self.store) #file path -> track dict
+        self.playlists = self.playlist_paths
+        self.phonetic_index = self.sound_index
+
+    def _use_snapshot(self, snapshot):
+        """Search a snapshot (see snapshot.Snapshot), which has the same
+        views and search methods as the store and its indexes. Call with
+        the lock held."""
+        if self.snapshot is not None and self.snapshot is not snapshot:
+            self.snapshot.close()
+        self.snapshot = snapshot
+        self.tracks = snapshot.tracks
+        self.artists = snapshot.artists
+        self.albums = snapshot.albums
+        self.genres = snapshot.genres
+        self.track_records = snapshot.track_records
+        self.playlists = snapshot.playlists
+        self.phonetic_index = snapshot
+
+    def open_snapshot(self):
+        """Answer queries from the snapshot file, if it matches the index.
+
+        Its checksum is checked in a background thread (reading the whole
+        file would make startup take longer the larger the library); if
+        it doesn't match, the index is loaded instead.
+        Returns: True if the snapshot is used"""
+        if not self.snapshot_path or not os.path.exists(self.snapshot_path):
+            return False
+        try:
+            snapshot = Snapshot(self.snapshot_path, self.generation(),
+                                self.lang, verify=False)
+        except (SnapshotError, OSError) as e:
+            LOG.info('Not using the library snapshot: {}'.format(e))
+            return False
+        with self.lock:
+            self._use_snapshot(snapshot)
+            self.snapshot_generation = snapshot.generation
+        threading.Thread(target=self.check_snapshot, args=(snapshot,),
+                         daemon=True).start()
+        return True
+
+    def check_snapshot(self, snapshot):
+        """Verify the checksum of a snapshot queries are answered from, and
+        switch to the index (and rewrite the snapshot) if it's damaged."""
+        lower_priority()
+        try:
+            intact = snapshot.verify()
+        except ValueError:
+            return #closed, the index was loaded meanwhile
+        if intact:
+            return
+        if self.drop_snapshot(snapshot, 'checksum mismatch'):
+            self.save_snapshot()
+
+    def drop_snapshot(self, snapshot, reason):
+        """Stop answering queries from a damaged snapshot and load the index
+        instead.
+        Returns: False if the snapshot wasn't used anymore"""
+        with self.load_lock:
+            with self.lock:
+                if self.snapshot is not snapshot:
+                    return False
+                self.snapshot_generation = None
+            LOG.warning('Not using the library snapshot: {}'.format(reason))
+            self.load_from_index()
+        return True
+
+    def from_snapshot(self, search, *args):
+        """Run search(*args) on the snapshot queries are answered from.
+        Until its checksum was checked (see check_snapshot) a damaged
+        snapshot can hold offsets that are out of range; if reading it
+        fails, the index is loaded and the search runs again on that."""
+        with self.lock:
+            snapshot = self.snapshot
+        if snapshot is None or snapshot.verified:
+            return search(*args)
+        try:
+            return search(*args)
+        except (LookupError, ValueError) as e:
+            if self.drop_snapshot(snapshot, repr(e)):
+                threading.Thread(target=self.save_snapshot,
+                                 daemon=True).start()
+        return search(*args)
+
+    def save_snapshot(self):
+        """Write the search dicts to the snapshot file if they changed
+        since it was last written or opened. Only copying them holds the
+        lock; the snapshot is built and written from the copy, so queries
+        and scans aren't held up meanwhile.
+        Returns: True if a snapshot was written"""
+        if not self.snapshot_path:
+            return False
+        #one writer at a time, so an older copy can't replace a newer one
+        with self.snapshot_write_lock:
+            with self.lock:
+                generation = self.generation()
+                if self.snapshot or generation == self.snapshot_generation:
+                    return False
+                library = self.snapshot_copy()
+            try:
+                write_snapshot(self.snapshot_path, library, generation,
+                               self.lang)
+            except OSError as e:
+                LOG.warning('Could not write the library snapshot: '
+                            '{}'.format(e))
+                return False
+            with self.lock:
+                self.snapshot_generation = generation
+        return True
+
+    def snapshot_copy(self):
+        """Returns: a copy of the database with its own copy of everything
+        a snapshot is built from (see snapshot.SnapshotWriter). Call with
+        the lock held."""
+        library = copy.copy(self)
+        library.store = self.store.copy()
+        library.title_ids = dict(self.title_ids)
+        library.group_ids = {kind: {name: array('I', ids)
+                                    for name, ids in group.items()}
+                             for kind, group in self.group_ids.items()}
+        library.playlist_paths = dict(self.playlist_paths)
+        if self.ngram_ready:
+            library.ngram_index = self.ngram_index.copy()
+        library.sound_index = self.sound_index.copy()
+        return library
+
+    def ensure_loaded(self):
+        """Load the index into memory if queries are still answered from a
+        snapshot, which can't be changed."""
+        with self.load_lock:
+            if self.snapshot is not None:
+                self.load_from_index()
+
+    def add_track(self, track):
+        """Add a track dict (see read_track) to the search dicts, replacing
+        any older entry for the same file."""
+        file_path = track['path']
+        if file_path in self.store:
+            self.remove_file(file_path)
+        track_id = self.store.add(track)
+
+        #adds song name and its id to the tracks
+        title = self.track_title(track)
+        self.title_ids[title] = track_id
+        self.index_name(title, 'tracks')
+
+        #songs without tags aren't listed under an unknown artist/album/genre
+        #ARTIST: creates a list of tracks under each artist
+        #ALBUM: adds a list of tracks to each album
+        #GENRE: adds a list of tracks to each genre
+        for kind, key in (('artists', track['artist']),
+                          ('albums', track['album']),
+                          ('genres', track['genre'])):
+            if key is None:
+                continue
+            group = self.group_ids[kind]
+            if key not in group:
+                group[key] = array('I')
+                self.index_name(key, kind)
+            group[key].append(track_id)
+
+    def add_playlist(self, playlist):
+        self.playlist_records[playlist['path']] = playlist
+        self.playlist_paths[playlist['name']] = playlist['path']
+        self.index_name(playlist['name'], 'playlists')
+
+    def remove_file(self, file_path):
+        """Drop a track or playlist file from the search dicts."""
+        playlist = self.playlist_records.pop(file_path, None)
+        if playlist:
+            self.playlist_cache.discard(file_path)
+            if self.playlist_paths.get(playlist['name']) == file_path:
+                del self.playlist_paths[playlist['name']]
+                self.unindex_name(playlist['name'], 'playlists')
+            return
+
+        track_id = self.store.id_of(file_path)
+        if track_id is None:
+            return
+        track = self.store.record(track_id)
+        self.store.remove(file_path)
+        title = self.track_title(track)
+        if self.title_ids.get(title) == track_id:
+            del self.title_ids[title]
+            self.unindex_name(title, 'tracks')
+        for kind, key in (('artists', track['artist']),
+                          ('albums', track['album']),
+                          ('genres', track['genre'])):
+            group = self.group_ids[kind]
+            if key in group and track_id in group[key]:
+                group[key].remove(track_id)
+                if not group[key]:
+                    del group[key]
+                    self.unindex_name(key, kind)
+
+    def fingerprint(self, file_path):
+        """Returns: the (size, mtime) a track or playlist file had when it
+        was last read, or None if it isn't in the database"""
+        track_id = self.store.id_of(file_path)
+        if track_id is not None:
+            return self.store.size[track_id], self.store.mtime[track_id]
+        playlist = self.playlist_records.get(file_path)
+        if playlist:
+            return playlist['size'], playlist['mtime']
+        return None
+
+    def memory_report(self):
+        """Approximate memory used by the database, to check how it scales
+        with the size of the library.
+        Returns: dict of part -> bytes, including a 'total'"""
+        with self.lock:
+            report = self.store.memory_report()
+            report['title lookup'] = sys.getsizeof(self.title_ids)
+            report['artist/album/genre lists'] = sum(
+                sys.getsizeof(group) +
+                sum(sys.getsizeof(ids) for ids in group.values())
+                for group in self.group_ids.values())
+            report['search index'] = (
+                sys.getsizeof(self.ngram_index.postings) +
+                sum(sys.getsizeof(names)
+                    for names in self.ngram_index.postings.values()) +
+                sys.getsizeof(self.ngram_index.sizes) +
+                sys.getsizeof(self.ngram_index.kinds))
+            if self.snapshot is not None:
+                report['snapshot (shared, mapped)'] = self.snapshot.size
+            report['total'] = sum(report.values())
+            report['tracks'] = len(self.track_records)
+        return report
+
+    def index_name(self, name, kind):
+        if self.ngram_ready:
+            self.ngram_index.add(name, kind)
+        self.sound_index.add(name, kind)
+
+    def unindex_name(self, name, kind):
+        if self.ngram_ready:
+            self.ngram_index.remove(name, kind)
+        self.sound_index.remove(name, kind)
+
+    def name_index(self):
+        """The n-gram index that narrows large search dicts down (the
+        snapshot, while queries are answered from one). The store's index
+        is only built when a search dict first grows past FULL_MATCH_LIMIT
+        and is searched; smaller ones are matched in full and don't need
+        it. Call with the lock held."""
+        if self.snapshot is not None:
+            return self.snapshot
+        if not self.ngram_ready:
+            self.ngram_index = self.build_ngram_index()
+            self.ngram_ready = True
+        return self.ngram_index
+
+    def build_ngram_index(self):
+        """Returns: a new NgramIndex of every name in the search dicts"""
+        index = NgramIndex()
+        for title in self.title_ids:
+            index.add(title, 'tracks')
+        for kind, group in self.group_ids.items():
+            for name in group:
+                index.add(name, kind)
+        for name in self.playlist_paths:
+            index.add(name, 'playlists')
+        return index
+
+    def track_title(self, track):
+        """The name a track is listed under in self.tracks"""
+        if track['title']:
+            return track['title']
+        return self.to_standard_title(os.path.basename(track['path']))
 
 def main():
     player = SongDatabase()
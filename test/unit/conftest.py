@@ -0,0 +1,39 @@
+"""Unit tests of the skill's modules.
+
+The skill folder is imported as the package 'offline_playback_skill'
+without running its __init__ (which needs a running Mycroft), the same way
+benchmark/run.py does. The database tests still need mycroft-core and
+tinytag installed. Run them with
+
+    python -m pytest test/unit
+"""
+import os
+import sys
+import types
+
+import pytest
+
+SKILL_DIR = os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))))
+PACKAGE = 'offline_playback_skill'
+
+if PACKAGE not in sys.modules:
+    package = types.ModuleType(PACKAGE)
+    package.__path__ = [SKILL_DIR]
+    sys.modules[PACKAGE] = package
+sys.path.insert(0, os.path.join(SKILL_DIR, 'benchmark'))
+
+
+@pytest.fixture
+def library(tmp_path):
+    """A small synthetic library (see benchmark/library_generator).
+    Returns: (music folder, manifest)"""
+    from library_generator import LibraryGenerator
+    music = str(tmp_path / 'Music')
+    manifest = LibraryGenerator(music, tracks=60, playlists=5).generate()
+    return music, manifest
+
+
+@pytest.fixture
+def index_path(tmp_path):
+    return str(tmp_path / 'library.db')
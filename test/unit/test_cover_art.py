@@ -0,0 +1,130 @@
+import os
+import threading
+
+import pytest
+
+from offline_playback_skill import cover_art
+from offline_playback_skill.cover_art import (CoverArtCache, folder_image,
+                                              image_extension)
+
+from library_generator import mp3_bytes
+
+
+def png(size):
+    return b'\x89PNG' + b'\x00' * (size - 4)
+
+
+def album(folder, name, image_size=100, image='cover.png'):
+    """A folder with one track and, if image_size, a cover image file.
+    Returns: the track's path"""
+    folder = os.path.join(str(folder), name)
+    os.makedirs(folder)
+    track = os.path.join(folder, '01.mp3')
+    with open(track, 'wb') as f:
+        f.write(mp3_bytes({'title': name, 'album': name}, 2))
+    if image_size:
+        with open(os.path.join(folder, image), 'wb') as f:
+            f.write(png(image_size))
+    return track
+
+
+@pytest.fixture(autouse=True)
+def without_pil(monkeypatch):
+    # store images as they are, whether or not PIL is installed
+    monkeypatch.setattr(cover_art, 'Image', None)
+
+
+def store(cache, track):
+    assert cache.extract(cache.key(track, None), track)
+    return cache.lookup(track)
+
+
+def test_image_extension():
+    assert image_extension(b'\xff\xd8\xff\xe0') == '.jpg'
+    assert image_extension(png(10)) == '.png'
+    assert image_extension(b'GIF89a') is None
+
+
+def test_folder_image(tmp_path):
+    assert folder_image(str(tmp_path)) is None
+    assert folder_image(str(tmp_path / 'missing')) is None
+    for name in ('Folder.JPG', 'back.jpg', 'cover.png', 'cover.gif'):
+        (tmp_path / name).write_bytes(b'')
+    assert folder_image(str(tmp_path)) == str(tmp_path / 'cover.png')
+    os.remove(str(tmp_path / 'cover.png'))
+    assert folder_image(str(tmp_path)) == str(tmp_path / 'Folder.JPG')
+
+
+def test_worker_stores_the_cover(tmp_path):
+    track = album(tmp_path / 'Music', 'One')
+    ready = threading.Event()
+    cache = CoverArtCache(str(tmp_path / 'covers'),
+                          on_ready=lambda path: ready.set())
+    cache.start()
+    try:
+        assert cache.lookup(track) == ''
+        assert cache.lookup(track) == ''  # queued once
+        assert ready.wait(10)
+        path = cache.lookup(track)
+        with open(path, 'rb') as f:
+            assert f.read() == png(100)
+        # the other tracks of the album share it
+        assert cache.lookup(os.path.join(os.path.dirname(track),
+                                         '02.mp3')) == path
+    finally:
+        cache.stop()
+
+
+def test_albums_without_art_are_not_tried_again(tmp_path):
+    track = album(tmp_path / 'Music', 'Bare', image_size=0)
+    cache = CoverArtCache(str(tmp_path / 'covers'))
+    cache.lookup(track)
+    cache.jobs.put(None)
+    cache.run()  # the worker, in this thread
+    assert cache.key(track, None) in cache.missing
+    assert cache.jobs.empty()
+    assert cache.lookup(track) == ''
+    assert cache.jobs.empty()
+
+
+def test_images_too_big_to_store_unscaled(tmp_path):
+    track = album(tmp_path / 'Music', 'Huge',
+                  image_size=cover_art.MAX_UNSCALED_BYTES + 1)
+    cache = CoverArtCache(str(tmp_path / 'covers'))
+    assert not cache.extract(cache.key(track, None), track)
+    assert os.listdir(str(tmp_path / 'covers')) == []
+
+
+def test_least_recently_used_are_evicted(tmp_path):
+    music = tmp_path / 'Music'
+    tracks = [album(music, name) for name in ('One', 'Two', 'Three')]
+    cache = CoverArtCache(str(tmp_path / 'covers'), budget=250)
+    first = store(cache, tracks[0])
+    second = store(cache, tracks[1])
+    assert cache.lookup(tracks[0]) == first  # used again
+    third = store(cache, tracks[2])
+
+    assert cache.total == 200
+    assert cache.lookup(tracks[1]) == ''
+    assert not os.path.exists(second)
+    assert os.path.exists(first) and os.path.exists(third)
+    assert sorted(os.listdir(str(tmp_path / 'covers'))) == sorted(
+        [os.path.basename(first), os.path.basename(third)])
+
+
+def test_budget_applies_to_saved_thumbnails(tmp_path):
+    music = tmp_path / 'Music'
+    tracks = [album(music, name) for name in ('One', 'Two', 'Three')]
+    cache = CoverArtCache(str(tmp_path / 'covers'))
+    paths = [store(cache, track) for track in tracks]
+    # the eviction order survives a restart through the files' mtimes
+    for mtime, path in zip((300, 100, 200), paths):
+        os.utime(path, (mtime, mtime))
+
+    restarted = CoverArtCache(str(tmp_path / 'covers'), budget=200)
+    assert restarted.total == 200
+    assert restarted.lookup(tracks[1]) == ''
+    assert restarted.lookup(tracks[0]) == paths[0]
+    assert restarted.lookup(tracks[2]) == paths[2]
+    # looking a thumbnail up refreshes its old mtime
+    assert os.stat(paths[0]).st_mtime > 300
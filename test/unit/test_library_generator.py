@@ -0,0 +1,45 @@
+import os
+
+from offline_playback_skill.song_database_manager import SongDatabase
+
+from library_generator import LibraryGenerator
+
+
+def tree(folder):
+    """Returns: dict of relative path -> contents of the music files
+    (playlists hold absolute paths, so only their names are compared)"""
+    files = {}
+    for root, folders, names in os.walk(folder):
+        for name in names:
+            path = os.path.join(root, name)
+            with open(path, 'rb') as f:
+                files[os.path.relpath(path, folder)] = (
+                    f.read() if name.endswith(('.mp3', '.flac')) else None)
+    return files
+
+
+def test_same_parameters_same_library(tmp_path):
+    first = LibraryGenerator(str(tmp_path / 'a'), tracks=40).generate()
+    second = LibraryGenerator(str(tmp_path / 'b'), tracks=40).generate()
+    assert first == second
+    assert tree(str(tmp_path / 'a')) == tree(str(tmp_path / 'b'))
+    other = LibraryGenerator(str(tmp_path / 'c'), tracks=40, seed=2)
+    assert other.generate()['titles'] != first['titles']
+
+
+def test_existing_library_is_reused(tmp_path):
+    generator = LibraryGenerator(str(tmp_path), tracks=20)
+    manifest = generator.generate()
+    assert generator.load_manifest() == manifest
+    assert LibraryGenerator(str(tmp_path), tracks=21).load_manifest() is None
+
+
+def test_the_skill_reads_the_library(library, index_path):
+    music, manifest = library
+    database = SongDatabase(index_path=index_path)
+    database.load_database(music)
+    assert (len(database.track_records) + len(database.playlists) ==
+            manifest['files'])
+    assert set(manifest['artists']) <= set(database.artists)
+    assert set(manifest['genres']) <= set(database.genres)
+    assert set(manifest['playlists']) == set(database.playlists)
@@ -0,0 +1,96 @@
+import os
+import sqlite3
+
+from offline_playback_skill import library_index
+from offline_playback_skill.library_index import TRACK_FIELDS, LibraryIndex
+from offline_playback_skill.song_database_manager import SongDatabase
+
+
+def track(path, **tags):
+    record = dict.fromkeys(TRACK_FIELDS)
+    record.update(path=path, title=os.path.basename(path), size=1, mtime=1.0,
+                  detailed=0)
+    record.update(tags)
+    return record
+
+
+def playlist(path):
+    return {'path': path, 'name': os.path.basename(path), 'size': 1,
+            'mtime': 1.0}
+
+
+def test_records_persist(index_path):
+    index = LibraryIndex(index_path)
+    index.save_records([track('/music/a.mp3', artist='Artist')],
+                       [playlist('/music/list.m3u')])
+    index.set_meta('directory', '/music')
+
+    index = LibraryIndex(index_path)
+    assert index.load_tracks() == [track('/music/a.mp3', artist='Artist')]
+    assert index.load_playlists() == [playlist('/music/list.m3u')]
+    assert index.get_meta('directory') == '/music'
+
+
+def test_records_are_replaced_and_removed():
+    index = LibraryIndex()
+    index.save_records([track('/music/a.mp3'), track('/music/b.mp3')], [])
+    index.save_records([track('/music/a.mp3', title='New')], [])
+    index.remove_records(['/music/b.mp3'])
+    assert index.load_tracks() == [track('/music/a.mp3', title='New')]
+
+
+def test_generation_changes_with_the_records():
+    index = LibraryIndex()
+    generations = [index.generation()]
+    index.save_records([track('/music/a.mp3')], [])
+    generations.append(index.generation())
+    index.save_details([('/music/a.mp3', 180.0, 320.0, 44100)])
+    generations.append(index.generation())
+    index.remove_records(['/music/a.mp3'])
+    generations.append(index.generation())
+    assert len(set(generations)) == 4
+
+
+def test_details():
+    index = LibraryIndex()
+    index.save_records([track('/music/a.mp3'), track('/music/b.mp3')], [])
+    index.save_details([('/music/a.mp3', 180.0, 320.0, 44100)])
+    assert index.undetailed_paths() == ['/music/b.mp3']
+    tracks = {record['path']: record for record in index.load_tracks()}
+    assert tracks['/music/a.mp3']['duration'] == 180.0
+    assert tracks['/music/a.mp3']['detailed'] == 1
+
+
+def test_other_schema_version_is_dropped(index_path):
+    LibraryIndex(index_path).save_records([track('/music/a.mp3')], [])
+    connection = sqlite3.connect(index_path)
+    with connection:
+        connection.execute("UPDATE meta SET value = '0' "
+                           "WHERE key = 'schema_version'")
+    connection.close()
+    index = LibraryIndex(index_path)
+    assert index.load_tracks() == []
+    assert (index.get_meta('schema_version') ==
+            str(library_index.SCHEMA_VERSION))
+
+
+def test_index_is_used_on_the_next_start(library, index_path):
+    music, manifest = library
+    first = SongDatabase(index_path=index_path)
+    first.load_database(music)
+    second = SongDatabase(index_path=index_path)
+    assert second.load_database(music) is None
+    second.ensure_loaded()
+    assert sorted(second.track_records) == sorted(first.track_records)
+    assert second.artists.keys() == first.artists.keys()
+
+
+def test_other_directory_starts_over(library, index_path, tmp_path):
+    music, manifest = library
+    SongDatabase(index_path=index_path).load_database(music)
+    other = str(tmp_path / 'Other')
+    os.makedirs(other)
+    database = SongDatabase(index_path=index_path)
+    database.load_database(other)
+    assert len(database.track_records) == 0
+    assert database.index.load_tracks() == []
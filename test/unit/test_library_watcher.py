@@ -0,0 +1,125 @@
+import threading
+
+import pytest
+
+from offline_playback_skill.library_watcher import (
+    IN_CLOSE_WRITE, IN_CREATE, IN_IGNORED, IN_ISDIR, IN_MOVED_FROM,
+    IN_Q_OVERFLOW, LibraryWatcher, filesystem_type)
+
+SUMMARY = {'added': 0, 'changed': 0, 'removed': 0}
+
+
+class Index:
+    def load_directories(self):
+        return {}
+
+
+class Database:
+    """Records the updates the watcher asks for."""
+    def __init__(self, changed=1):
+        self.index = Index()
+        self.changed = changed
+        self.updates = []
+        self.updated = threading.Event()
+
+    def rescan(self, directory):
+        return self.update({directory})
+
+    def update_files(self, paths):
+        return self.update(set(paths))
+
+    def update(self, paths):
+        self.updates.append(paths)
+        self.updated.set()
+        return dict(SUMMARY, changed=self.changed)
+
+
+def watcher(database=None, **kwargs):
+    watcher = LibraryWatcher(database or Database(), '/music', **kwargs)
+    watcher.watches = {1: '/music', 2: '/music/album'}
+    return watcher
+
+
+def test_events_are_collected():
+    library_watcher = watcher()
+    library_watcher.handle_events([
+        (2, IN_CLOSE_WRITE, 'one.mp3'),
+        (2, IN_CREATE, 'two.mp3'),  # not written yet
+        (1, IN_MOVED_FROM | IN_ISDIR, 'album'),
+        (9, IN_CLOSE_WRITE, 'unknown.mp3'),
+    ])
+    assert library_watcher.pending == {'/music/album/one.mp3',
+                                       '/music/album'}
+    # the moved folder's watch is forgotten
+    assert library_watcher.watches == {1: '/music'}
+
+
+def test_overflow_rescans_everything():
+    database = Database()
+    library_watcher = watcher(database)
+    library_watcher.handle_events([(0, IN_Q_OVERFLOW, ''),
+                                   (2, IN_CLOSE_WRITE, 'one.mp3')])
+    library_watcher.flush()
+    assert database.updates == [{'/music'}]
+
+
+def test_ignored_watch_is_dropped():
+    library_watcher = watcher()
+    library_watcher.handle_events([(2, IN_IGNORED, '')])
+    assert 2 not in library_watcher.watches
+    assert not library_watcher.pending
+
+
+def test_batches_wait_for_events_to_settle():
+    library_watcher = watcher(settle=60, max_delay=120)
+    assert not library_watcher.batch_due()
+    library_watcher.handle_events([(2, IN_CLOSE_WRITE, 'one.mp3')])
+    assert not library_watcher.batch_due()
+    library_watcher.last_event -= 61
+    assert library_watcher.batch_due()
+
+    library_watcher = watcher(settle=60, max_delay=120)
+    library_watcher.handle_events([(2, IN_CLOSE_WRITE, 'one.mp3')])
+    library_watcher.first_event -= 121  # a long copy
+    assert library_watcher.batch_due()
+
+
+def test_flush_updates_the_changed_files():
+    changes = []
+    database = Database()
+    library_watcher = watcher(database, on_change=changes.append)
+    library_watcher.handle_events([(2, IN_CLOSE_WRITE, 'one.mp3')])
+    library_watcher.flush()
+    assert database.updates == [{'/music/album/one.mp3'}]
+    assert len(changes) == 1
+    assert not library_watcher.pending
+
+
+def test_no_report_without_changes():
+    changes = []
+    library_watcher = watcher(Database(changed=0), on_change=changes.append)
+    library_watcher.handle_events([(2, IN_CLOSE_WRITE, 'one.mp3')])
+    library_watcher.flush()
+    assert changes == []
+
+
+def test_filesystem_type():
+    assert filesystem_type('/') is not None
+
+
+def test_inotify(tmp_path):
+    database = Database()
+    folder = tmp_path / 'album'
+    folder.mkdir()
+    library_watcher = LibraryWatcher(database, str(tmp_path), settle=0.1)
+    library_watcher.start()
+    try:
+        if library_watcher.mode != 'inotify':
+            pytest.skip('inotify is not available')
+        path = str(folder / 'new.mp3')
+        with open(path, 'wb') as f:
+            f.write(b'data')
+        assert database.updated.wait(5)
+        assert database.updates == [{path}]
+    finally:
+        library_watcher.stop()
@@ -0,0 +1,112 @@
+import json
+import time
+
+import pytest
+
+from offline_playback_skill import metrics, song_database_manager
+from offline_playback_skill.metrics import NULL_SPAN, Tracer, percentile
+from offline_playback_skill.song_database_manager import SongDatabase
+
+
+def test_percentile():
+    ordered = list(range(1, 101))
+    assert percentile(ordered, 0.5) == 50
+    assert percentile(ordered, 0.95) == 95
+    assert percentile(ordered, 0.0) == 1
+    assert percentile([7], 0.95) == 7
+
+
+def test_disabled_tracer_does_nothing():
+    tracer = Tracer()
+    assert tracer.trace('query') is NULL_SPAN
+    assert tracer.span('stage') is NULL_SPAN
+    tracer.count('things')
+    tracer.observe('latency', 1.0)
+    report = tracer.report()
+    assert report['traces'] == 0
+    assert report['stages'] == report['counters'] == {}
+
+
+def test_spans_and_counters():
+    tracer = Tracer(sample_rate=1.0)
+    for _ in range(3):
+        with tracer.trace('query'):
+            with tracer.span('match'):
+                time.sleep(0.001)
+            with tracer.span('match'):
+                pass
+            tracer.count('candidates', 5)
+    # outside a trace, counts go straight into the totals
+    tracer.count('files_read', 2)
+    # no span outside a trace, and no nested traces
+    assert tracer.span('match') is NULL_SPAN
+    with tracer.trace('query'):
+        assert tracer.trace('query') is NULL_SPAN
+
+    report = tracer.report()
+    assert report['traces'] == 4
+    assert report['stages']['query']['count'] == 4
+    assert report['stages']['match']['count'] == 3
+    assert report['stages']['match']['p50_ms'] >= 1.0
+    assert (report['stages']['match']['max_ms'] >=
+            report['stages']['match']['p95_ms'] >=
+            report['stages']['match']['p50_ms'])
+    assert report['counters'] == {'candidates': 15, 'files_read': 2}
+    # reporting starts over
+    assert tracer.report()['traces'] == 0
+
+
+def test_sample_rate(monkeypatch):
+    tracer = Tracer(sample_rate=0.5)
+    monkeypatch.setattr(metrics.random, 'random', lambda: 0.7)
+    assert tracer.trace('query') is NULL_SPAN
+    assert tracer.trace('load', always=True) is not NULL_SPAN
+    monkeypatch.setattr(metrics.random, 'random', lambda: 0.2)
+    assert tracer.trace('query') is not NULL_SPAN
+
+    tracer.configure(sample_rate=7)
+    assert tracer.sample_rate == 1.0
+    tracer.configure(sample_rate=-1)
+    assert tracer.sample_rate == 0.0
+
+
+def test_samples_are_bounded(monkeypatch):
+    monkeypatch.setattr(metrics, 'MAX_SAMPLES', 10)
+    tracer = Tracer(sample_rate=1.0)
+    for n in range(100):
+        tracer.observe('latency', n / 1000)
+    assert len(tracer.durations['latency']) == 10
+    report = tracer.report()['stages']['latency']
+    assert report['count'] == 100
+    assert report['max_ms'] == 99.0
+
+
+def test_trace_file(tmp_path):
+    path = str(tmp_path / 'traces.jsonl')
+    tracer = Tracer(sample_rate=1.0, trace_path=path)
+    with tracer.trace('query', utterance='play something'):
+        tracer.count('candidates', 3)
+    tracer.observe('first_audio', 0.25, source='local')
+    tracer.close()
+    with open(path) as f:
+        lines = [json.loads(line) for line in f]
+    assert [line['name'] for line in lines] == ['query', 'first_audio']
+    assert lines[0]['utterance'] == 'play something'
+    assert lines[0]['counters'] == {'candidates': 3}
+    assert lines[1]['spans_ms'] == {'first_audio': 250.0}
+    assert lines[1]['source'] == 'local'
+
+
+@pytest.mark.parametrize('search', ['search_tracks', 'search_all'])
+def test_database_queries_are_traced(library, index_path, monkeypatch,
+                                     search):
+    music, manifest = library
+    database = SongDatabase(index_path=index_path)
+    database.load_database(music)
+    tracer = Tracer(sample_rate=1.0)
+    monkeypatch.setattr(song_database_manager, 'tracer', tracer)
+    with tracer.trace('query'):
+        getattr(database, search)(manifest['titles'][0])
+    report = tracer.report()
+    assert {'query', 'fuzzy_match'} <= set(report['stages'])
+    assert report['counters']['candidates_scored'] >= len(manifest['titles'])
@@ -0,0 +1,133 @@
+import os
+
+import pytest
+
+from offline_playback_skill import song_database_manager
+from offline_playback_skill.mount_watcher import MountWatcher, unescape
+from offline_playback_skill.song_database_manager import SongDatabase
+
+from library_generator import mp3_bytes
+
+
+def test_unescape():
+    assert unescape('/media/pi/My\\040Drive') == '/media/pi/My Drive'
+    assert unescape('/media/tab\\011s') == '/media/tab\ts'
+    assert unescape('/media/plain') == '/media/plain'
+
+
+class Watcher(MountWatcher):
+    """Reads its mount table from 'table' instead of /proc/mounts."""
+    def __init__(self, **kwargs):
+        self.events = []
+        self.table = {}
+        super().__init__(lambda *drive: self.events.append(('attach',) +
+                                                           drive),
+                         lambda *drive: self.events.append(('detach',) +
+                                                           drive),
+                         **kwargs)
+
+    def mounted(self):
+        return dict(self.table)
+
+
+def test_attach_and_detach():
+    watcher = Watcher()
+    watcher.drives = {'known': '/media/known'}
+    watcher.table = {'known': '/media/known', 'new': '/media/new'}
+    watcher.check()
+    assert watcher.events == [('attach', 'new', '/media/new')]
+
+    watcher.events = []
+    watcher.check()
+    assert watcher.events == []
+
+    # unplugged, and mounted somewhere else
+    watcher.table = {'new': '/media/other'}
+    watcher.check()
+    assert watcher.events == [('detach', 'known', '/media/known'),
+                              ('detach', 'new', '/media/new'),
+                              ('attach', 'new', '/media/other')]
+
+
+def test_failing_callback_is_logged():
+    def fail(uuid, mount_point):
+        raise RuntimeError('drive handler broke')
+
+    watcher = Watcher()
+    watcher.on_attach = fail
+    watcher.table = {'one': '/media/one', 'two': '/media/two'}
+    watcher.check()
+    assert watcher.drives == watcher.table
+
+
+def test_start_and_stop():
+    watcher = Watcher(poll_interval=0.5)
+    watcher.table = {'one': '/media/one'}
+    watcher.start(known={'one': '/media/one'})
+    watcher.stop()
+    assert not watcher.thread.is_alive()
+    assert watcher.events == []
+
+
+def write_tracks(folder, count, artist):
+    paths = []
+    for number in range(count):
+        path = os.path.join(folder, artist, '{:02d}.mp3'.format(number))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(mp3_bytes({'title': '{} {}'.format(artist, number),
+                               'artist': artist}, 2))
+        paths.append(path)
+    return paths
+
+
+@pytest.fixture
+def roots(library, tmp_path, index_path):
+    music, manifest = library
+    drive = str(tmp_path / 'media' / 'drive')
+    paths = write_tracks(drive, 5, 'Drive Artist')
+    database = SongDatabase(index_path=index_path)
+    database.load_database(music)
+    return database, music, drive, paths
+
+
+def test_attach_and_detach_root(roots, tmp_path, monkeypatch):
+    database, music, drive, paths = roots
+    shard = str(tmp_path / 'drive.db')
+    library_size = len(database.track_records)
+
+    summary = database.attach_root(drive, shard)
+    assert summary['added'] == 5
+    assert sorted(database.artists['Drive Artist']) == paths
+    assert len(database.track_records) == library_size + 5
+
+    assert database.detach_root(drive) == 5
+    assert 'Drive Artist' not in database.artists
+    assert len(database.track_records) == library_size
+    assert database.detach_root(drive) == 0
+
+    # plugged in again: the tracks come from its shard
+    def no_reading(*args, **kwargs):
+        raise AssertionError('a file was opened')
+    monkeypatch.setattr(song_database_manager.TinyTag, 'get', no_reading)
+    summary = database.attach_root(drive, shard)
+    assert summary['files_read'] == 0
+    assert sorted(database.artists['Drive Artist']) == paths
+
+
+def test_detach_root_of_a_snapshot(roots, tmp_path, index_path):
+    database, music, drive, paths = roots
+    database.attach_root(drive, str(tmp_path / 'drive.db'))
+    library_size = len(database.track_records)
+
+    # a restart answers from the snapshot of both roots
+    restarted = SongDatabase(index_path=index_path)
+    restarted.add_root(drive, str(tmp_path / 'drive.db'))
+    restarted.load_database(music)
+    assert restarted.snapshot is not None
+    assert len(restarted.track_records) == library_size
+
+    assert restarted.detach_root(drive) == 5
+    assert restarted.snapshot is None
+    assert len(restarted.track_records) == library_size - 5
+    assert 'Drive Artist' not in restarted.artists
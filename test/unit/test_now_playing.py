@@ -0,0 +1,100 @@
+from types import SimpleNamespace
+
+import pytest
+
+from offline_playback_skill import now_playing
+from offline_playback_skill.now_playing import (DURATION_SLACK, NowPlaying,
+                                                normalize_track_info)
+
+STATUS = {'track': 'Song', 'artist': 'Artist', 'album': 'Album',
+          'image': '', 'path': '/music/song.mp3'}
+REPLY = {'title': 'Other', 'artists': ['Someone'], 'album': 'Live'}
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(now_playing, 'time', SimpleNamespace(monotonic=clock))
+    return clock
+
+
+class AudioService:
+    """Answers track info queries with 'reply', counting them."""
+    def __init__(self, reply=None):
+        self.reply = reply
+        self.queries = 0
+
+    def __call__(self):
+        self.queries += 1
+        return self.reply
+
+
+def test_normalize_track_info():
+    assert normalize_track_info(None) is None
+    assert normalize_track_info({}) is None
+    assert normalize_track_info({'album': 'Only An Album'}) is None
+    assert normalize_track_info(REPLY) == {
+        'track': 'Other', 'artist': 'Someone', 'album': 'Live', 'image': '',
+        'path': None}
+    assert normalize_track_info({'name': 'Stream', 'artist': 'Radio'})[
+        'track'] == 'Stream'
+
+
+def test_status_is_served_without_asking(clock):
+    audio = AudioService(REPLY)
+    status = NowPlaying(audio, ttl=60)
+    assert status.set(STATUS)
+    assert not status.set(dict(STATUS))
+    clock.now += 59
+    assert status.get() == STATUS
+    assert audio.queries == 0
+
+
+def test_expired_status_asks_the_audio_service(clock):
+    audio = AudioService(REPLY)
+    status = NowPlaying(audio, ttl=60)
+    status.set(STATUS)
+    clock.now += 61
+    assert status.get()['track'] == 'Other'
+    assert audio.queries == 1
+    # the answer is trusted for another ttl
+    clock.now += 30
+    assert status.get()['track'] == 'Other'
+    assert audio.queries == 1
+
+
+def test_long_tracks_are_trusted_until_they_should_end(clock):
+    audio = AudioService(REPLY)
+    status = NowPlaying(audio, ttl=60)
+    status.set(STATUS, duration=300)
+    clock.now += 300 + DURATION_SLACK - 1
+    assert status.get() == STATUS
+    clock.now += 2
+    assert status.get()['track'] == 'Other'
+    assert audio.queries == 1
+
+
+def test_expire_and_clear(clock):
+    audio = AudioService()
+    status = NowPlaying(audio)
+    status.set(STATUS)
+    status.expire()
+    # nothing playing according to the audio service
+    assert status.get() is None
+    assert audio.queries == 1
+
+    assert not status.clear()
+    status.set(STATUS)
+    assert status.clear()
+    # stopped stays stopped until the next track change
+    clock.now += 10 ** 6
+    assert status.get() is None
+    assert audio.queries == 1
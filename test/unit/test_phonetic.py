@@ -0,0 +1,89 @@
+import os
+
+import pytest
+
+from offline_playback_skill.phonetic import PhoneticEncoder, PhoneticIndex
+from offline_playback_skill.song_database_manager import (
+    PHONETIC_CONFIDENCE, SongDatabase)
+
+from library_generator import mp3_bytes
+
+
+@pytest.mark.parametrize('heard, name', [
+    ('beat alls', 'The Beatles'),
+    ('metal ica', 'Metallica'),
+    ('shopin', 'Chopin'),
+])
+def test_names_spelled_as_they_sound_match(heard, name):
+    assert PhoneticEncoder().similarity(heard, name) == 1.0
+
+
+def test_keys_with_and_without_the_article():
+    encoder = PhoneticEncoder()
+    assert encoder.keys('The Beatles') == {'0btls', 'btls'}
+    assert encoder.keys('Beatles') == {'btls'}
+    # a single word is never taken for an article
+    assert encoder.keys('A') == {'a'}
+
+
+def test_partial_matches_score_below_one():
+    encoder = PhoneticEncoder()
+    partial = encoder.similarity('a story', 'Star')
+    assert 0.5 < partial < 1.0
+    assert encoder.similarity('nothing alike', 'Star') < partial
+    assert encoder.similarity('', 'Star') == 0.0
+
+
+def test_language_rules():
+    assert PhoneticEncoder('de-de').key('Schwarz') == \
+        PhoneticEncoder('de-de').key('schwartz')
+    assert PhoneticEncoder('ru-ru').key('Чайковский') == \
+        PhoneticEncoder('en-us').key('Tchaikovsky')
+    # accents and letters without a base letter
+    assert PhoneticEncoder().key('Café Señor') == \
+        PhoneticEncoder().key('cafe senyor')
+    # unknown languages use the English rules
+    assert PhoneticEncoder('xx').key('Chopin') == \
+        PhoneticEncoder().key('Chopin')
+
+
+def test_index_add_remove_lookup():
+    index = PhoneticIndex()
+    index.add('The Beatles', 'artists')
+    index.add('Beatles Forever', 'albums')
+    index.add('The Beatles', 'albums')
+    found = index.lookup('beat alls', ('artists', 'albums', 'tracks'))
+    assert found == {'artists': {'The Beatles'}, 'albums': {'The Beatles'},
+                     'tracks': set()}
+
+    index.remove('The Beatles', 'albums')
+    assert index.lookup('beat alls', ('albums',)) == {'albums': set()}
+    index.remove('The Beatles', 'artists')
+    index.remove('Not Added', 'artists')
+    assert index.lookup('beat alls', ('artists',)) == {'artists': set()}
+    assert set(index.names) == {'btlsfrvr'}
+
+
+def test_database_second_chance(tmp_path, index_path):
+    music = tmp_path / 'Music'
+    for number, (title, artist) in enumerate([
+            ('Yesterday', 'The Beatles'), ('Star', 'Metallica'),
+            ('Ocean', 'Garden')]):
+        path = music / artist / '{}.mp3'.format(number)
+        os.makedirs(str(path.parent))
+        path.write_bytes(mp3_bytes({'title': title, 'artist': artist}, 2))
+    database = SongDatabase(index_path=index_path)
+    database.load_database(str(music))
+
+    results = database.sounds_like('beat alls', ('artists', 'tracks'))
+    assert results['artists'] == ('The Beatles', PHONETIC_CONFIDENCE)
+    assert results['tracks'] == (None, 0.0)
+
+    paths, confidence = database.match_in('beat alls', 'artists')
+    assert paths == [str(music / 'The Beatles' / '0.mp3')]
+    assert confidence == PHONETIC_CONFIDENCE
+
+    # only part of the key sounds alike
+    name, confidence = database.sounds_like('a story', ('tracks',))['tracks']
+    assert name == 'Star'
+    assert confidence < PHONETIC_CONFIDENCE
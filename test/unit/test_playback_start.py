@@ -0,0 +1,91 @@
+import threading
+import time
+
+from offline_playback_skill.playback_start import PlaybackStarter
+
+
+class Player:
+    """Records what it is asked to play."""
+    def __init__(self):
+        self.played = []
+        self.event = threading.Event()
+
+    def __call__(self, tracks):
+        self.played.append(list(tracks))
+        self.event.set()
+
+
+def starter(**timeouts):
+    player = Player()
+    return PlaybackStarter(player, **timeouts), player
+
+
+def test_plays_when_speech_ends(tmp_path):
+    track = str(tmp_path / 'one.mp3')
+    with open(track, 'wb') as f:
+        f.write(b'\0' * 1000)
+    start, player = starter(speech_start_timeout=5, speech_end_timeout=5)
+    start.begin([track, '/music/two.mp3'])
+    start.speech_started()
+    assert not player.event.wait(0.2)  # still speaking
+    start.speech_ended()
+    assert player.event.wait(5)
+    assert player.played == [[track, '/music/two.mp3']]
+    assert start.pending == 0
+    assert start.waited >= 0.2
+
+
+def test_plays_without_speech_after_the_timeout():
+    start, player = starter(speech_start_timeout=0.1)
+    began = time.monotonic()
+    start.begin(['/music/one.mp3'])
+    assert player.event.wait(5)
+    assert time.monotonic() - began >= 0.1
+
+
+def test_selection_is_taken_lazily():
+    start, player = starter(speech_start_timeout=0.05)
+    picked = []
+
+    def selection():
+        for n in range(3):
+            picked.append(n)
+            yield '/music/{}.mp3'.format(n)
+
+    start.begin(selection())
+    assert player.event.wait(5)
+    assert player.played == [['/music/0.mp3', '/music/1.mp3',
+                               '/music/2.mp3']]
+
+
+def test_nothing_to_play():
+    start, player = starter(speech_start_timeout=0.05)
+    start.begin(iter([]))
+    start.begin([])
+    time.sleep(0.2)
+    assert player.played == []
+
+
+def test_cancel_and_replace():
+    start, player = starter(speech_start_timeout=5, speech_end_timeout=5)
+    start.begin(['/music/first.mp3'])
+    start.begin(['/music/second.mp3'])
+    start.speech_ended()
+    assert player.event.wait(5)
+    time.sleep(0.1)
+    assert player.played == [['/music/second.mp3']]
+
+    player.event.clear()
+    start.begin(['/music/third.mp3'])
+    assert start.cancel()
+    assert not player.event.wait(0.2)
+    assert not start.cancel()
+
+
+def test_first_audio_is_measured_once():
+    start, player = starter(speech_start_timeout=0.05)
+    assert start.first_audio() is None
+    start.begin(['/music/one.mp3'])
+    assert player.event.wait(5)
+    assert start.first_audio() >= 0.05
+    assert start.first_audio() is None
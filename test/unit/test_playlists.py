@@ -0,0 +1,141 @@
+import os
+
+import pytest
+
+from offline_playback_skill.playlists import (PlaylistCache, entry_path,
+                                              playlist_paths)
+from offline_playback_skill.song_database_manager import SongDatabase
+
+from library_generator import mp3_bytes
+
+
+def write(folder, name, text, encoding='utf-8'):
+    path = os.path.join(str(folder), name)
+    with open(path, 'w', encoding=encoding) as f:
+        f.write(text)
+    return path
+
+
+@pytest.mark.parametrize('name', ['list.m3u', 'list.m3u8'])
+def test_m3u(tmp_path, name):
+    path = write(tmp_path, name,
+                 '#EXTM3U\n#EXTINF:123,Artist - Title\n'
+                 'a/one.mp3\n\n/music/two.mp3\n'
+                 'http://example.com/stream\n')
+    assert list(playlist_paths(path)) == [
+        str(tmp_path / 'a' / 'one.mp3'), '/music/two.mp3', None]
+
+
+def test_m3u_latin1(tmp_path):
+    path = write(tmp_path, 'list.m3u', 'caf\xe9.mp3\n', encoding='latin-1')
+    assert list(playlist_paths(path)) == [str(tmp_path / 'caf\xe9.mp3')]
+
+
+def test_xspf(tmp_path):
+    path = write(tmp_path, 'list.xspf',
+                 '<?xml version="1.0" encoding="UTF-8"?>\n'
+                 '<playlist version="1" xmlns="http://xspf.org/ns/0/">'
+                 '<trackList>'
+                 '<track><location>file:///music/a%20b.mp3</location></track>'
+                 '<track><location>c%20d.mp3</location></track>'
+                 '</trackList></playlist>\n')
+    assert list(playlist_paths(path)) == [
+        '/music/a b.mp3', str(tmp_path / 'c d.mp3')]
+
+
+def test_asx(tmp_path):
+    path = write(tmp_path, 'list.asx',
+                 '<asx version="3.0">'
+                 '<entry><ref href="/music/one.mp3"/></entry>'
+                 '<entry><REF HREF="two.mp3"/></entry></asx>\n')
+    assert list(playlist_paths(path)) == [
+        '/music/one.mp3', str(tmp_path / 'two.mp3')]
+
+
+def test_asx_not_well_formed(tmp_path):
+    path = write(tmp_path, 'list.asx',
+                 '<asx version="3.0">\n'
+                 '<entry><ref href="/music/one.mp3"/></entry>\n'
+                 '<entry><ref href="/music/two & three.mp3"/></entry>\n'
+                 '</asx>\n')
+    assert list(playlist_paths(path)) == [
+        '/music/one.mp3', '/music/two & three.mp3']
+
+
+def test_b4s(tmp_path):
+    path = write(tmp_path, 'list.b4s',
+                 '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+                 '<WinampXML><playlist num_entries="2">'
+                 '<entry Playstring="file:/music/one.mp3"/>'
+                 '<entry Playstring="file:C:\\Music\\two.mp3"/>'
+                 '</playlist></WinampXML>\n')
+    assert list(playlist_paths(path)) == ['/music/one.mp3', None]
+
+
+def test_unsupported_format(tmp_path):
+    path = write(tmp_path, 'list.pls', '[playlist]\n')
+    with pytest.raises(ValueError):
+        list(playlist_paths(path))
+
+
+def test_entry_path_home():
+    assert (entry_path('~/one.mp3', '/music') ==
+            os.path.expanduser('~/one.mp3'))
+
+
+def test_cache_follows_the_file(tmp_path):
+    path = write(tmp_path, 'list.m3u', 'one.mp3\n')
+    cache = PlaylistCache()
+    cache.put(path, os.stat(path), ('one.mp3',))
+    assert cache.get(path, os.stat(path)) == ('one.mp3',)
+    write(tmp_path, 'list.m3u', 'one.mp3\ntwo.mp3\n')
+    assert cache.get(path, os.stat(path)) is None
+
+
+def test_playlist_files_in_the_library(tmp_path, index_path):
+    music = tmp_path / 'Music'
+    os.makedirs(str(music / 'Songs'))
+    for name in ('one', 'two'):
+        (music / 'Songs' / (name + '.mp3')).write_bytes(
+            mp3_bytes({'title': name}, 2))
+    playlist = write(music, 'list.m3u', 'Songs/two.mp3\nSongs/missing.mp3\n'
+                     'http://example.com/stream\nSongs/one.mp3\n')
+    database = SongDatabase(index_path=index_path)
+    database.load_database(str(music))
+    assert database.playlist_files(playlist) == [
+        str(music / 'Songs' / 'two.mp3'), str(music / 'Songs' / 'one.mp3')]
+
+    # files leaving the library drop out without the playlist changing
+    os.remove(str(music / 'Songs' / 'two.mp3'))
+    database.rescan(str(music))
+    assert database.playlist_files(playlist) == [
+        str(music / 'Songs' / 'one.mp3')]
+
+    # a changed playlist is read again
+    write(music, 'list.m3u', 'Songs/one.mp3\nSongs/one.mp3\n')
+    os.utime(playlist, (1, 1))
+    assert database.playlist_files(playlist) == [
+        str(music / 'Songs' / 'one.mp3')] * 2
+    assert database.playlist_files(str(music / 'gone.m3u')) == []
+
+
+def test_playlist_files_are_looked_up_once(tmp_path, index_path):
+    music = tmp_path / 'Music'
+    os.makedirs(str(music / 'Songs'))
+    one = music / 'Songs' / 'one.mp3'
+    one.write_bytes(mp3_bytes({'title': 'one'}, 2))
+    playlist = write(music, 'list.m3u', 'Songs/one.mp3\nSongs/two.mp3\n')
+    database = SongDatabase(index_path=index_path)
+    database.load_database(str(music))
+    assert database.playlist_files(playlist) == [str(one)]
+
+    records = database.track_records
+    database.track_records = {}  # nothing would be found in it
+    assert database.playlist_files(playlist) == [str(one)]
+    database.track_records = records
+
+    # until the library changes
+    two = music / 'Songs' / 'two.mp3'
+    two.write_bytes(mp3_bytes({'title': 'two'}, 2))
+    database.update_files([str(two)])
+    assert database.playlist_files(playlist) == [str(one), str(two)]
@@ -0,0 +1,85 @@
+import time
+
+from offline_playback_skill import prefetch
+from offline_playback_skill.prefetch import CHUNK, Prefetcher, warm_file
+
+
+def chunks(prefetcher, sizes):
+    """Walk next_chunk as the worker would, with made-up file sizes.
+    Returns: list of (file path, offset, length) read"""
+    read = []
+    while True:
+        chunk = prefetcher.next_chunk()
+        if chunk is None:
+            return read
+        path, offset, length = chunk
+        if length is None:
+            prefetcher.progress[path][1] = sizes[path]
+        else:
+            read.append(chunk)
+            prefetcher.progress[path][0] = offset + length
+
+
+def test_upcoming_files_are_read_in_chunks():
+    prefetcher = Prefetcher(ahead=2, budget=10 * CHUNK)
+    prefetcher.update(['a', 'b', 'c'])
+    assert prefetcher.wanted == ['a', 'b']
+    read = chunks(prefetcher, {'a': CHUNK + 10, 'b': 100})
+    assert read == [('a', 0, CHUNK), ('a', CHUNK, 10), ('b', 0, 100)]
+
+
+def test_budget_covers_all_upcoming_files():
+    prefetcher = Prefetcher(ahead=3, budget=3 * CHUNK)
+    prefetcher.update(['a', 'b', 'c'])
+    read = chunks(prefetcher, {'a': 2 * CHUNK, 'b': 2 * CHUNK,
+                               'c': CHUNK})
+    assert read == [('a', 0, CHUNK), ('a', CHUNK, CHUNK), ('b', 0, CHUNK)]
+    assert sum(length for path, offset, length in read) == 3 * CHUNK
+
+
+def test_budget_moves_on_with_the_tracks():
+    prefetcher = Prefetcher(ahead=2, budget=2 * CHUNK)
+    sizes = {'a': 2 * CHUNK, 'b': CHUNK, 'c': CHUNK}
+    prefetcher.update(['a', 'b'])
+    assert [path for path, offset, length in chunks(prefetcher, sizes)] == [
+        'a', 'a']
+    # 'a' started playing: its read ahead is dropped, 'c' gets the budget
+    prefetcher.update(['b', 'c'])
+    assert 'a' not in prefetcher.progress
+    assert chunks(prefetcher, sizes) == [('b', 0, CHUNK), ('c', 0, CHUNK)]
+    prefetcher.update([])
+    assert prefetcher.next_chunk() is None
+
+
+def test_worker_reads_the_files(tmp_path, monkeypatch):
+    calls = []
+    monkeypatch.setattr(prefetch, 'read_ahead',
+                        lambda fd, offset, length: calls.append(
+                            (offset, length)))
+    paths = []
+    for name, size in (('one', 3000), ('two', 5000)):
+        path = tmp_path / (name + '.mp3')
+        path.write_bytes(b'\0' * size)
+        paths.append(str(path))
+
+    prefetcher = Prefetcher(budget=6000, rate=10 ** 9)
+    prefetcher.start()
+    try:
+        prefetcher.update(paths + [str(tmp_path / 'missing.mp3')])
+        deadline = time.monotonic() + 5
+        while len(calls) < 2 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        time.sleep(0.05)
+    finally:
+        prefetcher.stop()
+    assert calls == [(0, 3000), (0, 3000)]
+    assert prefetcher.progress[paths[0]] == [3000, 3000]
+    assert prefetcher.progress[paths[1]] == [3000, 5000]
+    assert not prefetcher.thread.is_alive()
+
+
+def test_warm_file(tmp_path):
+    path = tmp_path / 'one.mp3'
+    path.write_bytes(b'\0' * 1000)
+    assert warm_file(str(path))
+    assert not warm_file(str(tmp_path / 'missing.mp3'))
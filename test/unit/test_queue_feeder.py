@@ -0,0 +1,103 @@
+from offline_playback_skill.queue_feeder import QueueFeeder
+
+
+class AudioService:
+    """Records what the feeder hands over."""
+    def __init__(self):
+        self.tracks = []
+        self.plays = 0
+
+    def play(self, tracks, utterance=None, repeat=False):
+        self.tracks = list(tracks)
+        self.plays += 1
+
+    def queue(self, tracks):
+        self.tracks.extend(tracks)
+
+
+TRACKS = ['/music/{:02d} song.mp3'.format(n) for n in range(30)]
+
+
+def start(tracks=TRACKS, **kwargs):
+    audio = AudioService()
+    feeder = QueueFeeder(audio, start_window=5, low_water=2, top_up=10)
+    feeder.play(tracks, **kwargs)
+    return feeder, audio
+
+
+def test_starts_with_a_window():
+    feeder, audio = start()
+    assert audio.tracks == TRACKS[:5]
+    assert feeder.current() == TRACKS[0]
+    assert feeder.upcoming(2) == TRACKS[1:3]
+
+
+def test_follows_reported_tracks():
+    feeder, audio = start()
+    feeder.track_started(TRACKS[0])
+    feeder.track_started('file:///music/01%20song.mp3')
+    assert feeder.current() == TRACKS[1]
+    feeder.track_started('02 song.mp3')  # backends that report file names
+    assert feeder.current() == TRACKS[2]
+
+
+def test_going_back_and_resuming():
+    feeder, audio = start()
+    for track in TRACKS[:3]:
+        feeder.track_started(track)
+    feeder.track_started(TRACKS[1])  # previous track
+    assert feeder.current() == TRACKS[1]
+    feeder.track_started(TRACKS[1])  # resumed after a pause
+    assert feeder.current() == TRACKS[1]
+    assert feeder.upcoming(1) == [TRACKS[2]]
+
+
+def test_unknown_track_counts_on():
+    feeder, audio = start()
+    feeder.track_started(TRACKS[0])
+    feeder.track_started(None)
+    feeder.track_started('Some Title')
+    assert feeder.current() == TRACKS[2]
+
+
+def test_tops_up_before_running_out():
+    feeder, audio = start()
+    for track in TRACKS[:3]:
+        feeder.track_started(track)
+    assert audio.tracks == TRACKS[:5]
+    feeder.track_started(TRACKS[3])  # one left after this one
+    assert audio.tracks == TRACKS[:15]
+    assert feeder.upcoming(3) == TRACKS[4:7]
+
+
+def test_track_handed_over_twice_is_the_next_one():
+    a, b, c = TRACKS[:3]
+    feeder, audio = start([a, b, a, c])
+    for track in (a, b, a):
+        feeder.track_started(track)
+    assert feeder.upcoming(1) == [c]
+
+
+def test_repeat():
+    feeder, audio = start(TRACKS[:2], repeat=True)
+    assert audio.tracks == TRACKS[:2] * 2
+
+
+def test_queue_end_catches_up():
+    feeder, audio = start(TRACKS[:7])
+    feeder.queue_ended()
+    assert audio.plays == 2
+    assert audio.tracks == TRACKS[5:7]
+    feeder.track_started(TRACKS[5])
+    assert feeder.current() == TRACKS[5]
+    feeder.queue_ended()
+    assert not feeder.active
+    assert feeder.current() is None
+
+
+def test_stop():
+    feeder, audio = start()
+    feeder.stop()
+    feeder.track_started(TRACKS[1])
+    assert feeder.current() is None
+    assert feeder.upcoming(3) == []
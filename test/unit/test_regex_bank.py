@@ -0,0 +1,74 @@
+import os
+import re
+
+import pytest
+
+from offline_playback_skill.regex_bank import (FALLBACK_LANG, QUERY_REGEXES,
+                                               RegexBank, combine)
+
+LOCALE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__)))), 'locale')
+LANGS = sorted(os.listdir(LOCALE_DIR))
+PHRASES = [
+    'the album abbey road', 'the record thriller', 'the artist queen',
+    'something by the beatles', 'songs from abba', 'the song yesterday',
+    'track hey jude', 'my local playlist road trip',
+    'the offlineplaylist road trip', 'my offlinesaved songs',
+    'offlineliked songs', 'yesterday', 'the band', '', 'het album abbey road',
+    'das album abbey road', 'el álbum abbey road', 'la canción yesterday',
+    'альбом abbey road', 'nummeret yesterday', 'la canzone yesterday',
+]
+
+
+def read_regex(lang, name):
+    for folder in (lang, FALLBACK_LANG):
+        path = os.path.join(LOCALE_DIR, folder, name + '.regex')
+        if os.path.exists(path):
+            with open(path, encoding='utf-8') as f:
+                return f.read().strip()
+    return None
+
+
+def classify_one_by_one(phrase, lang):
+    """What the skill did before RegexBank: each regex in turn"""
+    for name in QUERY_REGEXES:
+        pattern = read_regex(lang, name)
+        match = re.match(pattern, phrase) if pattern else None
+        if match:
+            return name, match.groupdict()
+    return None, {}
+
+
+@pytest.fixture(scope='module')
+def bank():
+    return RegexBank(LOCALE_DIR)
+
+
+@pytest.mark.parametrize('lang', LANGS)
+def test_same_as_one_by_one(bank, lang):
+    assert bank.dispatchers[lang] is not None
+    for phrase in PHRASES:
+        assert (bank.classify(phrase, lang) ==
+                classify_one_by_one(phrase, lang)), phrase
+
+
+def test_unknown_lang_uses_fallback(bank):
+    assert (bank.classify('the album abbey road', 'xx-xx') ==
+            ('album', {'album': 'abbey road'}))
+
+
+def test_subset_of_regexes(bank):
+    assert bank.classify('the song yesterday', 'en-us',
+                         names=('album',)) == (None, {})
+
+
+def test_combine_keeps_order_and_groups():
+    patterns = [('first', re.compile('a (?P<x>.+)')),
+                ('second', re.compile('(?P<x>a) b'))]
+    pattern, groups = combine(patterns)
+    match = pattern.match('a b')
+    assert groups[match.lastgroup][0] == 'first'
+
+
+def test_combine_refuses_numbered_backreferences():
+    assert combine([('name', re.compile(r'(a)\1'))]) is None
@@ -0,0 +1,375 @@
+import os
+import shutil
+import threading
+
+import pytest
+
+from offline_playback_skill import song_database_manager
+from offline_playback_skill.song_database_manager import (ScanError,
+                                                          SongDatabase)
+
+from library_generator import mp3_bytes
+
+
+def music_files(folder):
+    return sorted(os.path.join(root, name)
+                  for root, folders, names in os.walk(folder)
+                  for name in names if name.endswith(('.mp3', '.flac')))
+
+
+def write_mp3(path, **tags):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(mp3_bytes(tags, 2))
+
+
+def test_first_scan(library, index_path):
+    music, manifest = library
+    database = SongDatabase(index_path=index_path)
+    summary = database.load_database(music)
+    assert summary['complete']
+    assert summary['added'] == summary['files_read'] == manifest['files']
+    assert len(database.track_records) == len(music_files(music))
+    assert len(database.playlists) == len(manifest['playlists'])
+
+
+def test_rescan_adds_removes_and_updates(library, index_path):
+    music, manifest = library
+    database = SongDatabase(index_path=index_path)
+    database.load_database(music)
+    files = music_files(music)
+
+    os.remove(files[0])
+    write_mp3(files[1], title='Changed Title', artist='New Artist')
+    added = os.path.join(music, 'New', 'added.mp3')
+    write_mp3(added, title='Added Title')
+
+    summary = database.rescan(music)
+    assert (summary['added'], summary['changed'], summary['removed']) == (
+        1, 1, 1)
+    assert summary['files_read'] == 2
+    assert files[0] not in database.track_records
+    assert database.track_records[files[1]]['title'] == 'Changed Title'
+    assert 'New Artist' in database.artists
+    assert database.tracks['Added Title'] == added
+
+    # nothing changed since
+    summary = database.rescan(music)
+    assert (summary['added'], summary['changed'], summary['removed'],
+            summary['files_read']) == (0, 0, 0, 0)
+
+
+def test_changes_are_saved(library, index_path):
+    music, manifest = library
+    database = SongDatabase(index_path=index_path)
+    database.load_database(music)
+    removed = music_files(music)[0]
+    os.remove(removed)
+    database.rescan(music)
+
+    database = SongDatabase(index_path=index_path)
+    database.load_database(music)
+    database.ensure_loaded()
+    assert removed not in database.track_records
+    assert len(database.track_records) == len(music_files(music))
+
+
+def test_removed_folder(library, index_path):
+    music, manifest = library
+    database = SongDatabase(index_path=index_path)
+    database.load_database(music)
+    folder = os.path.dirname(music_files(music)[0])
+    gone = [path for path in database.track_records
+            if os.path.dirname(path) == folder]
+    shutil.rmtree(folder)
+    summary = database.rescan(music)
+    assert summary['removed'] == len(gone)
+    assert not any(path in database.track_records for path in gone)
+
+
+def test_workers_give_the_same_library(library, tmp_path):
+    music, manifest = library
+    databases = []
+    for workers in (1, 4):
+        database = SongDatabase(
+            index_path=str(tmp_path / '{}.db'.format(workers)),
+            scan_workers=workers)
+        database.load_database(music)
+        databases.append(database)
+    single, pool = databases
+    assert list(single.tracks.items()) == list(pool.tracks.items())
+    for kind in ('artists', 'albums', 'genres'):
+        assert (dict(getattr(single, kind).items()) ==
+                dict(getattr(pool, kind).items()))
+
+
+def test_stop_scan_stops_every_scan(library, index_path):
+    music, manifest = library
+    database = SongDatabase(index_path=index_path)
+    database.throttle.pause('test')
+    scans = [threading.Thread(target=database.load_database, args=(music,))
+             for _ in range(2)]
+    for scan in scans:
+        scan.start()
+    for _ in range(500):
+        if len(database.active_scans) == 2:
+            break
+        threading.Event().wait(0.01)
+    database.stop_scan()
+    for scan in scans:
+        scan.join(5)
+        assert not scan.is_alive()
+    database.throttle.resume('test')
+    # a new scan isn't stopped by the earlier stop_scan
+    assert database.rescan(music)['complete']
+
+
+def test_update_files(library, index_path):
+    music, manifest = library
+    database = SongDatabase(index_path=index_path)
+    database.load_database(music)
+    removed = music_files(music)[0]
+    os.remove(removed)
+    added = os.path.join(music, 'New', 'added.mp3')
+    write_mp3(added, title='Added Title')
+
+    summary = database.update_files([removed, os.path.dirname(added)])
+    assert (summary['added'], summary['removed']) == (1, 1)
+    assert removed not in database.track_records
+    assert database.tracks['Added Title'] == added
+
+
+def test_details_read_in_a_second_pass(library, index_path):
+    music, manifest = library
+    database = SongDatabase(index_path=index_path)
+    database.load_database(music, details=False)
+    tracks = len(database.track_records)
+    assert len(database.index.undetailed_paths()) == tracks
+    assert all(record['duration'] is None
+               for record in database.track_records.values())
+
+    summary = database.read_details()
+    assert (summary['read'], summary['complete']) == (tracks, True)
+    assert database.index.undetailed_paths() == []
+    assert all(record['duration'] > 0
+               for record in database.track_records.values())
+    assert database.read_details()['read'] == 0
+
+
+def test_read_details_carries_on_after_stop_scan(library, index_path,
+                                                 monkeypatch):
+    music, manifest = library
+    monkeypatch.setattr(song_database_manager, 'SCAN_BATCH_SIZE', 10)
+    database = SongDatabase(index_path=index_path)
+    database.load_database(music, details=False)
+    tracks = len(database.track_records)
+
+    def stop(done, total):
+        database.stop_scan()
+    first = database.read_details(progress=stop)
+    assert (first['read'], first['complete']) == (10, False)
+    second = database.read_details()
+    assert (second['read'], second['complete']) == (tracks - 10, True)
+
+
+def test_unreadable_details_are_not_tried_again(library, index_path,
+                                                monkeypatch):
+    music, manifest = library
+    database = SongDatabase(index_path=index_path)
+    database.load_database(music, details=False)
+    broken = sorted(database.track_records)[0]
+    get = song_database_manager.TinyTag.get
+
+    def read(path, *args, **kwargs):
+        if path == broken:
+            raise OSError('unreadable')
+        return get(path, *args, **kwargs)
+    monkeypatch.setattr(song_database_manager.TinyTag, 'get', read)
+    assert database.read_details()['complete']
+    assert database.track_records[broken]['duration'] is None
+    assert database.index.undetailed_paths() == []
+
+
+@pytest.fixture
+def stuck_reads(monkeypatch):
+    """Makes reads of the files in the returned set hang until the test
+    ends"""
+    paths = set()
+    release = threading.Event()
+    read_track = SongDatabase.read_track
+
+    def slow_read(self, file_path, stat, details=True):
+        if file_path in paths:
+            release.wait()
+        return read_track(self, file_path, stat, details)
+    monkeypatch.setattr(SongDatabase, 'read_track', slow_read)
+    yield paths
+    release.set()
+
+
+def test_quarantine_on_timeout(library, index_path, stuck_reads):
+    music, manifest = library
+    stuck = music_files(music)[:2]
+    stuck_reads.update(stuck)
+    database = SongDatabase(index_path=index_path)
+    database.file_time_budget = 0.2
+    summary = database.load_database(music)
+    assert summary['complete']
+    assert summary['quarantined'] == 2
+    assert sorted(database.load_quarantine()) == stuck
+    assert not any(path in database.track_records for path in stuck)
+    assert len(database.track_records) == len(music_files(music)) - 2
+
+    # skipped until they change
+    assert database.rescan(music)['files_read'] == 0
+    os.utime(stuck[0], (1, 1))
+    stuck_reads.clear()
+    summary = database.rescan(music)
+    assert summary['added'] == 1
+    assert stuck[0] in database.track_records
+    assert list(database.load_quarantine()) == [stuck[1]]
+
+
+def test_too_many_stuck_reads(library, index_path, stuck_reads, monkeypatch):
+    music, manifest = library
+    monkeypatch.setattr(song_database_manager, 'MAX_STUCK_READS', 2)
+    stuck_reads.update(music_files(music)[:3])
+    database = SongDatabase(index_path=index_path)
+    database.file_time_budget = 0.2
+    with pytest.raises(ScanError):
+        database.load_database(music)
+    assert len(database.load_quarantine()) == 2
+
+
+def test_interrupted_scan_is_continued(library, index_path, monkeypatch):
+    music, manifest = library
+    monkeypatch.setattr(song_database_manager, 'SCAN_BATCH_SIZE', 10)
+    database = SongDatabase(index_path=index_path)
+
+    def progress(done, total):
+        if done >= 20:
+            database.stop_scan()
+    summary = database.load_database(music, progress=progress)
+    assert not summary['complete']
+    read = summary['files_read']
+    assert summary['added'] == read < manifest['files']
+
+    # the next start keeps what was read and reads only the rest
+    database = SongDatabase(index_path=index_path)
+    summary = database.load_database(music)
+    assert summary['complete']
+    assert summary['files_read'] == manifest['files'] - read
+    assert len(database.track_records) == len(music_files(music))
+
+    database = SongDatabase(index_path=index_path)
+    assert database.load_database(music) is None
+
+
+def test_unreadable_files_are_quarantined(library, index_path, monkeypatch):
+    music, manifest = library
+    denied, gone = music_files(music)[:2]
+    read_track = SongDatabase.read_track
+
+    def read(self, file_path, stat, details=True):
+        if file_path == denied:
+            raise PermissionError(13, 'Permission denied', file_path)
+        if file_path == gone:
+            raise FileNotFoundError(2, 'No such file', file_path)
+        return read_track(self, file_path, stat, details)
+    monkeypatch.setattr(SongDatabase, 'read_track', read)
+    database = SongDatabase(index_path=index_path)
+    summary = database.load_database(music)
+    assert summary['complete']
+    assert summary['quarantined'] == 1
+    assert 'PermissionError' in database.load_quarantine()[denied]['reason']
+    assert denied not in database.track_records
+
+    # tried again once it changes
+    monkeypatch.setattr(SongDatabase, 'read_track', read_track)
+    assert database.rescan(music)['files_read'] == 0
+    os.utime(denied, (1, 1))
+    summary = database.rescan(music)
+    assert summary['added'] == 1
+    assert denied in database.track_records
+    assert database.load_quarantine() == {}
+
+
+@pytest.fixture
+def stuck_details(monkeypatch):
+    """Makes detail reads of the files in the returned set hang until the
+    test ends"""
+    paths = set()
+    release = threading.Event()
+    read_track_details = SongDatabase.read_track_details
+
+    def slow_read(self, file_path):
+        if file_path in paths:
+            release.wait()
+        return read_track_details(self, file_path)
+    monkeypatch.setattr(SongDatabase, 'read_track_details', slow_read)
+    yield paths
+    release.set()
+
+
+def test_stuck_detail_reads_are_quarantined(library, index_path,
+                                            stuck_details):
+    music, manifest = library
+    database = SongDatabase(index_path=index_path)
+    database.load_database(music, details=False)
+    stuck = sorted(database.track_records)[:2]
+    stuck_details.update(stuck)
+    database.file_time_budget = 0.2
+    summary = database.read_details()
+    assert summary['complete']
+    assert summary['quarantined'] == 2
+    assert sorted(database.load_quarantine()) == stuck
+    # the tracks keep their tags, without details
+    for path in stuck:
+        assert database.track_records[path]['duration'] is None
+    assert database.index.undetailed_paths() == []
+    assert database.read_details()['read'] == 0
+
+
+def test_too_many_stuck_detail_reads(library, index_path, stuck_details,
+                                     monkeypatch):
+    music, manifest = library
+    monkeypatch.setattr(song_database_manager, 'MAX_STUCK_READS', 2)
+    database = SongDatabase(index_path=index_path)
+    database.load_database(music, details=False)
+    stuck = set(sorted(database.track_records)[:3])
+    stuck_details.update(stuck)
+    database.file_time_budget = 0.2
+    with pytest.raises(ScanError):
+        database.read_details()
+    quarantined = set(database.load_quarantine())
+    assert len(quarantined) == 2 and quarantined < stuck
+    # what was read is kept, the rest is read next time
+    undetailed = set(database.index.undetailed_paths())
+    assert stuck - quarantined <= undetailed
+    assert not quarantined & undetailed
+
+
+def test_interrupted_scan_of_a_new_directory_is_continued(
+        library, index_path, tmp_path, monkeypatch):
+    music, manifest = library
+    database = SongDatabase(index_path=index_path)
+    database.load_database(music)
+
+    # the library moved, and the first scan of its new place is stopped
+    moved = str(tmp_path / 'Moved')
+    shutil.copytree(music, moved)
+    monkeypatch.setattr(song_database_manager, 'SCAN_BATCH_SIZE', 10)
+    database = SongDatabase(index_path=index_path)
+
+    def progress(done, total):
+        if done >= 20:
+            database.stop_scan()
+    summary = database.load_database(moved, progress=progress)
+    assert not summary['complete']
+    read = summary['files_read']
+
+    database = SongDatabase(index_path=index_path)
+    summary = database.load_database(moved)
+    assert summary['complete']
+    assert summary['files_read'] == manifest['files'] - read
+    assert sorted(database.track_records) == music_files(moved)
@@ -0,0 +1,87 @@
+import threading
+import time
+
+from offline_playback_skill.scan_throttle import ScanThrottle
+
+
+def test_no_limit():
+    throttle = ScanThrottle()
+    abort = threading.Event()
+    start = time.monotonic()
+    assert all(throttle.take(abort) for _ in range(1000))
+    assert time.monotonic() - start < 0.5
+
+
+def test_rate():
+    throttle = ScanThrottle(files_per_second=50)
+    abort = threading.Event()
+    start = time.monotonic()
+    for _ in range(11):
+        assert throttle.take(abort)
+    # the first file goes straight away, the other ten 20 ms apart
+    assert 0.18 <= time.monotonic() - start < 1.0
+
+
+def test_pause_holds_until_resumed():
+    throttle = ScanThrottle()
+    abort = threading.Event()
+    throttle.pause('audio')
+    assert throttle.is_paused()
+    taken = threading.Event()
+    thread = threading.Thread(
+        target=lambda: throttle.take(abort) and taken.set())
+    thread.start()
+    assert not taken.wait(0.3)
+    throttle.resume('audio')
+    assert taken.wait(2)
+    thread.join()
+    assert not throttle.is_paused()
+
+
+def test_every_reason_has_to_end():
+    throttle = ScanThrottle()
+    throttle.pause('audio')
+    throttle.pause('listener')
+    throttle.resume('audio')
+    assert throttle.is_paused()
+    throttle.resume('listener')
+    assert not throttle.is_paused()
+
+
+def test_pause_timeout():
+    throttle = ScanThrottle()
+    throttle.pause('listener', timeout=0.2)
+    start = time.monotonic()
+    assert throttle.wait(threading.Event())
+    assert 0.15 <= time.monotonic() - start < 2
+    assert not throttle.is_paused()
+
+
+def test_abort_ends_the_wait():
+    throttle = ScanThrottle()
+    throttle.pause('audio')
+    abort = threading.Event()
+    threading.Timer(0.1, abort.set).start()
+    assert not throttle.take(abort)
+    assert throttle.is_paused()
+
+
+def test_abort_only_stops_its_own_scan():
+    throttle = ScanThrottle()
+    throttle.pause('audio', timeout=0.3)
+    stopped, running = threading.Event(), threading.Event()
+    stopped.set()
+    assert not throttle.take(stopped)
+    assert throttle.take(running)
+
+
+def test_pausing_again_renews_the_timeout():
+    throttle = ScanThrottle()
+    throttle.pause('audio', timeout=0.2)
+    time.sleep(0.1)
+    # the next track started
+    throttle.pause('audio', timeout=0.3)
+    time.sleep(0.2)
+    assert throttle.is_paused()
+    time.sleep(0.2)
+    assert not throttle.is_paused()
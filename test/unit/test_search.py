@@ -0,0 +1,71 @@
+import os
+
+import pytest
+
+from offline_playback_skill import song_database_manager
+from offline_playback_skill.song_database_manager import SongDatabase
+
+from library_generator import mp3_bytes
+
+
+@pytest.fixture
+def database(library, index_path):
+    music, manifest = library
+    database = SongDatabase(index_path=index_path)
+    database.load_database(music)
+    database.ensure_loaded()
+    return database, manifest
+
+
+def test_small_library_is_matched_in_full(database):
+    database, manifest = database
+    title = manifest['titles'][0]
+    match, confidence = database.search_tracks(title)
+    assert confidence == 1.0
+    assert database.track_records[match[0]]['title'] == title
+    assert not database.ngram_ready
+
+
+def test_ngram_index_is_built_when_needed(database, monkeypatch):
+    database, manifest = database
+    monkeypatch.setattr(song_database_manager, 'FULL_MATCH_LIMIT', 5)
+    title = manifest['titles'][0]
+    match, confidence = database.search_tracks(title)
+    assert database.ngram_ready
+    assert confidence == 1.0
+    assert database.track_records[match[0]]['title'] == title
+
+    # kept up to date once built
+    path = os.path.join(os.path.dirname(match[0]), 'new.mp3')
+    with open(path, 'wb') as f:
+        f.write(mp3_bytes({'title': 'Completely New Title'}, 2))
+    database.update_files([path])
+    assert 'Completely New Title' in database.ngram_index
+    assert database.search_tracks('Completely New Title') == ([path], 1.0)
+
+
+def test_nothing_to_match(index_path):
+    database = SongDatabase(index_path=index_path)
+    assert database.search_artists('anyone') == (None, 0.0)
+
+
+def queries(manifest):
+    names = (manifest['titles'][:10] + manifest['artists'][:10] +
+             manifest['albums'][:10] + manifest['playlists'])
+    return names + [name[:-2] for name in names] + [
+        'the', 'love', 'nothing like this at all']
+
+
+@pytest.mark.parametrize('limit', [5, song_database_manager.FULL_MATCH_LIMIT])
+def test_search_all_matches_each_search(database, monkeypatch, limit):
+    database, manifest = database
+    monkeypatch.setattr(song_database_manager, 'FULL_MATCH_LIMIT', limit)
+    kinds = ('playlists', 'artists', 'tracks', 'albums')
+    for query in queries(manifest):
+        results = database.search_all(query, kinds)
+        for kind in kinds:
+            name, match, confidence = results[kind]
+            expected = database.match_in(query, kind)
+            if kind == 'tracks' and expected[0] is not None:
+                expected = ([expected[0]], expected[1])
+            assert (match, confidence) == expected, (query, kind)
@@ -0,0 +1,64 @@
+import random
+from collections import Counter
+
+from offline_playback_skill.search_index import NgramIndex, ngrams, rank
+
+
+def test_ngrams():
+    assert ngrams('Ab', 3) == {' ab', 'ab '}
+    assert ngrams('  The   End ') == ngrams('the end')
+
+
+def test_candidates_best_first():
+    index = NgramIndex()
+    for name in ('Yellow Submarine', 'Yesterday', 'Let It Be', 'Help'):
+        index.add(name, 'tracks')
+    assert index.candidates('yesterdy', 'tracks', limit=2) == [
+        'Yesterday', 'Yellow Submarine']
+    assert index.candidates('zzz', 'tracks') == []
+
+
+def test_names_are_shared_between_kinds():
+    index = NgramIndex()
+    index.add('Abbey Road', 'albums')
+    index.add('Abbey Road', 'tracks')
+    assert len(index) == 1
+    assert index.search('abbey road', ('albums', 'tracks')) == {
+        'albums': ['Abbey Road'], 'tracks': ['Abbey Road']}
+
+    index.remove('Abbey Road', 'albums')
+    assert index.candidates('abbey road', 'albums') == []
+    assert index.candidates('abbey road', 'tracks') == ['Abbey Road']
+    index.remove('Abbey Road', 'tracks')
+    assert 'Abbey Road' not in index
+    assert index.postings == {}
+
+
+def test_remove_unknown_name():
+    index = NgramIndex()
+    index.add('Help', 'tracks')
+    index.remove('Help', 'albums')
+    index.remove('Other', 'tracks')
+    assert index.candidates('help', 'tracks') == ['Help']
+
+
+def test_ties_are_ranked_by_name():
+    names = ['band {}'.format(letter) for letter in 'edcbaf']
+    sizes = {name: 6 for name in names}
+    kinds = {name: {'artists'} for name in names}
+    ranked = []
+    for seed in range(5):
+        shuffled = names[:]
+        random.Random(seed).shuffle(shuffled)
+        counts = Counter({name: 4 for name in shuffled})
+        ranked.append(rank(counts, 6, sizes.__getitem__, kinds.__getitem__,
+                           ('artists',), limit=3)['artists'])
+    assert ranked == [['band a', 'band b', 'band c']] * 5
+
+
+def test_rank_only_lists_the_kind_asked_for():
+    counts = Counter({'Help': 3, 'Abbey Road': 1})
+    kinds = {'Help': {'tracks'}, 'Abbey Road': {'albums'}}
+    result = rank(counts, 4, lambda name: 4, kinds.__getitem__,
+                  ('albums', 'genres'))
+    assert result == {'albums': ['Abbey Road'], 'genres': []}
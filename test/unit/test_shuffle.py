@@ -0,0 +1,62 @@
+import os
+
+import pytest
+
+from offline_playback_skill.shuffle import FeistelPermutation
+from offline_playback_skill.song_database_manager import SongDatabase
+
+
+@pytest.mark.parametrize('size', [1, 2, 3, 7, 64, 1000, 4097])
+def test_full_permutation(size):
+    permutation = FeistelPermutation(size, seed=size)
+    assert len(permutation) == size
+    assert sorted(permutation) == list(range(size))
+
+
+def test_same_seed_same_order():
+    assert (list(FeistelPermutation(500, seed=3)) ==
+            list(FeistelPermutation(500, seed=3)))
+    assert (list(FeistelPermutation(500, seed=3)) !=
+            list(FeistelPermutation(500, seed=4)))
+
+
+def test_out_of_range():
+    permutation = FeistelPermutation(10, seed=1)
+    with pytest.raises(IndexError):
+        permutation[10]
+    with pytest.raises(IndexError):
+        permutation[-1]
+
+
+@pytest.fixture
+def database(library, index_path):
+    music, manifest = library
+    database = SongDatabase(index_path=index_path)
+    database.load_database(music)
+    return database
+
+
+def test_shuffle_plays_every_track_once(database):
+    tracks = list(database.shuffle_tracks(seed=5))
+    assert sorted(tracks) == sorted(database.track_records)
+    assert tracks == list(database.shuffle_tracks(seed=5))
+    assert tracks != sorted(tracks)
+
+
+def test_shuffle_skips_removed_tracks(database, library):
+    music, manifest = library
+    removed = sorted(database.track_records)[:10]
+    for path in removed:
+        os.remove(path)
+    database.update_files(removed)
+    tracks = list(database.shuffle_tracks(seed=5))
+    assert sorted(tracks) == sorted(database.track_records)
+    assert not set(removed) & set(tracks)
+
+
+def test_random_song_list(database):
+    library = set(database.track_records)
+    few = database.get_random_song_list(10)
+    assert len(set(few)) == 10 and set(few) <= library
+    everything = database.get_random_song_list(len(library) + 10)
+    assert sorted(everything) == sorted(library)
@@ -0,0 +1,204 @@
+import os
+import struct
+import threading
+import time
+
+import pytest
+
+from offline_playback_skill import song_database_manager
+from offline_playback_skill.snapshot import (HEADER, POSTINGS, SECTION,
+                                             SECTION_COUNT, SNAPSHOT_VERSION,
+                                             Snapshot, SnapshotError)
+from offline_playback_skill.song_database_manager import SongDatabase
+
+
+def wait_for(condition, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.02)
+    return True
+
+
+@pytest.fixture
+def scanned(library, index_path):
+    """A scanned library with its snapshot written.
+    Returns: (music folder, manifest, the database that scanned it)"""
+    music, manifest = library
+    database = SongDatabase(index_path=index_path)
+    database.load_database(music)
+    assert os.path.exists(database.snapshot_path)
+    return music, manifest, database
+
+
+def queries(manifest):
+    names = (manifest['titles'][:10] + manifest['artists'][:10] +
+             manifest['albums'][:10] + manifest['genres'][:5] +
+             manifest['playlists'])
+    return [name.lower() for name in names] + [
+        'the', 'love', 'a story', 'nothing like this at all']
+
+
+def test_answers_like_the_store(scanned, index_path):
+    music, manifest, store = scanned
+    database = SongDatabase(index_path=index_path)
+    assert database.load_database(music) is None
+    assert database.snapshot is not None
+    assert len(database.track_records) == len(store.track_records)
+    for query in queries(manifest):
+        for search in ('search_tracks', 'search_artists', 'search_albums',
+                       'search_genres', 'search_playlists'):
+            assert (getattr(database, search)(query) ==
+                    getattr(store, search)(query)), (search, query)
+        assert database.search_all(query) == store.search_all(query), query
+
+
+def test_switches_to_the_store_for_changes(scanned, index_path):
+    music, manifest, store = scanned
+    database = SongDatabase(index_path=index_path)
+    database.load_database(music)
+    snapshot = database.snapshot
+    summary = database.rescan(music)
+    assert summary['complete']
+    assert database.snapshot is None
+    assert snapshot.buffers == []  # closed
+    assert sorted(database.track_records) == sorted(store.track_records)
+
+
+def damage(path, offset, data):
+    with open(path, 'r+b') as f:
+        f.seek(offset)
+        f.write(data)
+
+
+def test_checksum_mismatch_falls_back_to_the_index(scanned, index_path):
+    music, manifest, store = scanned
+    size = os.path.getsize(store.snapshot_path)
+    with open(store.snapshot_path, 'rb') as f:
+        f.seek(size - 20)
+        byte = f.read(1)[0]
+    damage(store.snapshot_path, size - 20, bytes([byte ^ 0xff]))
+
+    database = SongDatabase(index_path=index_path)
+    assert database.load_database(music) is None
+    # queries are answered from it until the check in the background fails
+    assert wait_for(lambda: database.snapshot is None)
+    assert sorted(database.track_records) == sorted(store.track_records)
+    # and it is written again
+    assert wait_for(lambda: Snapshot(store.snapshot_path).verify())
+
+
+def test_other_version_is_not_used(scanned, index_path):
+    music, manifest, store = scanned
+    damage(store.snapshot_path, 8, struct.pack('<H', SNAPSHOT_VERSION + 1))
+    with pytest.raises(SnapshotError):
+        Snapshot(store.snapshot_path)
+
+    database = SongDatabase(index_path=index_path)
+    assert database.load_database(music) is None
+    assert database.snapshot is None
+    assert sorted(database.track_records) == sorted(store.track_records)
+    snapshot = Snapshot(store.snapshot_path)
+    assert snapshot.verify()
+    snapshot.close()
+
+
+def test_stale_snapshot_is_not_used(scanned, index_path):
+    music, manifest, store = scanned
+    with open(store.snapshot_path, 'rb') as f:
+        old = f.read()
+    os.remove(next(iter(store.track_records)))
+    store.rescan(music)
+    with open(store.snapshot_path, 'wb') as f:
+        f.write(old)
+
+    database = SongDatabase(index_path=index_path)
+    database.load_database(music)
+    assert database.snapshot is None
+    assert len(database.track_records) == len(store.track_records)
+
+
+def test_truncated_file(scanned):
+    music, manifest, store = scanned
+    with open(store.snapshot_path, 'r+b') as f:
+        f.truncate(HEADER.size - 1)
+    with pytest.raises(SnapshotError):
+        Snapshot(store.snapshot_path)
+
+
+def test_damaged_offsets_fall_back_to_the_index(scanned, index_path,
+                                                monkeypatch):
+    music, manifest, store = scanned
+    with open(store.snapshot_path, 'rb') as f:
+        header = f.read(HEADER.size + SECTION_COUNT * SECTION.size)
+    offset, length = SECTION.unpack_from(header,
+                                         HEADER.size + POSTINGS * SECTION.size)
+    damage(store.snapshot_path, offset, b'\xff' * length)
+
+    # queries come before the checksum was checked
+    monkeypatch.setattr(SongDatabase, 'check_snapshot',
+                        lambda database, snapshot: None)
+    database = SongDatabase(index_path=index_path)
+    assert database.load_database(music) is None
+    assert database.snapshot is not None
+    title = manifest['titles'][0]
+    assert database.search_tracks(title) == store.search_tracks(title)
+    assert database.snapshot is None
+    # and it is written again
+    assert wait_for(lambda: intact(store.snapshot_path))
+
+
+def intact(path):
+    try:
+        Snapshot(path).close()
+    except SnapshotError:
+        return False
+    return True
+
+
+def test_verified_snapshot_is_read_without_a_fallback(scanned, index_path):
+    music, manifest, store = scanned
+    database = SongDatabase(index_path=index_path)
+    database.load_database(music)
+    assert wait_for(lambda: database.snapshot.verified)
+    assert database.search_all(manifest['artists'][0]) == store.search_all(
+        manifest['artists'][0])
+    assert database.snapshot is not None
+
+
+def lock_is_free(lock):
+    """Returns: whether another thread can take 'lock'"""
+    taken = []
+
+    def take():
+        if lock.acquire(timeout=1):
+            lock.release()
+            taken.append(True)
+    thread = threading.Thread(target=take)
+    thread.start()
+    thread.join()
+    return bool(taken)
+
+
+def test_snapshot_is_written_from_a_copy(scanned, index_path, monkeypatch):
+    music, manifest, store = scanned
+    os.remove(store.snapshot_path)
+    written = []
+    write_snapshot = song_database_manager.write_snapshot
+
+    def write(path, library, generation, lang):
+        # the database can be searched and changed meanwhile
+        assert lock_is_free(store.lock)
+        assert library is not store
+        assert library.store is not store.store
+        written.append(write_snapshot(path, library, generation, lang))
+    monkeypatch.setattr(song_database_manager, 'write_snapshot', write)
+    store.snapshot_generation = None
+    assert store.save_snapshot()
+    assert written
+
+    database = SongDatabase(index_path=index_path)
+    database.load_database(music)
+    assert database.snapshot is not None
+    assert sorted(database.track_records) == sorted(store.track_records)
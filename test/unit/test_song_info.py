@@ -0,0 +1,58 @@
+import os
+
+import pytest
+
+from offline_playback_skill import song_database_manager
+from offline_playback_skill.song_database_manager import SongDatabase
+
+from library_generator import mp3_bytes
+
+TAGS = {'title': 'Known Song', 'artist': 'Known Artist',
+        'album': 'Known Album', 'albumartist': 'Various Artists',
+        'genre': 'Jazz', 'year': 1999, 'track': 3}
+
+
+@pytest.fixture
+def database(library, index_path, monkeypatch):
+    """A scanned library with one track of known tags. Files can't be
+    opened for their tags afterwards."""
+    music, manifest = library
+    path = os.path.join(music, 'Known', 'song.mp3')
+    os.makedirs(os.path.dirname(path))
+    with open(path, 'wb') as f:
+        f.write(mp3_bytes(TAGS, 2))
+    database = SongDatabase(index_path=index_path)
+    database.load_database(music)
+
+    def no_reading(*args, **kwargs):
+        raise AssertionError('a file was opened')
+    monkeypatch.setattr(song_database_manager.TinyTag, 'get', no_reading)
+    return database, path
+
+
+def test_song_info_from_the_tags_read_at_scan_time(database):
+    database, path = database
+    info = database.get_song_info('Known Song')
+    assert info == database.get_song_info(path)
+    assert (info['title'], info['artist'], info['album'],
+            info['album artist'], info['genre'], info['year'],
+            info['track'], info['dir']) == (
+        'Known Song', 'Known Artist', 'Known Album', 'Various Artists',
+        'Jazz', '1999', '3', path)
+    assert info['duration'] > 0
+
+
+def test_other_lookups(database):
+    database, path = database
+    assert database.get_artists([path]) == ['Known Artist']
+    assert database.get_album_info([path]) == ('Known Album',
+                                               'Various Artists')
+    assert database.get_genre_name([path]) == 'Jazz'
+    assert database.get_artist_info([path]) == ('Known Artist', [path])
+
+
+def test_unknown_song(database):
+    database, path = database
+    assert database.get_song_info('No Such Song') is None
+    assert database.get_album_info([]) == (None, None)
+    assert database.get_genre_name('/nowhere.mp3') is None
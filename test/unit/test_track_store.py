@@ -0,0 +1,123 @@
+import os
+
+from offline_playback_skill.track_store import (
+    PathListView, PathView, RecordView, StringTable, TrackStore)
+
+
+def track(path, **tags):
+    record = {'path': path, 'title': os.path.basename(path), 'artist': None,
+              'album': None, 'albumartist': None, 'genre': None,
+              'year': None, 'track': None, 'duration': 61.5, 'size': 1000,
+              'mtime': 12.0}
+    record.update(tags)
+    return record
+
+
+def test_string_table():
+    table = StringTable()
+    assert table.intern(None) == 0
+    rock = table.intern('Rock')
+    assert table.intern('Rock') == rock
+    assert table.get(rock) == 'Rock'
+    assert len(table) == 2
+
+
+def test_record_round_trip():
+    store = TrackStore()
+    added = track('/music/a/one.mp3', artist='Artist', year=1999, track=3)
+    track_id = store.add(added)
+    record = store.record(track_id)
+    # numbers in the tags come back as strings, like tinytag reads them
+    assert record == dict(added, year='1999', track='3')
+    assert '/music/a/one.mp3' in store
+    assert len(store) == 1
+
+
+def test_replace_remove_and_reuse_ids():
+    store = TrackStore()
+    first = store.add(track('/music/a/one.mp3'))
+    second = store.add(track('/music/a/two.mp3'))
+    # replacing a track keeps its id
+    assert store.add(track('/music/a/one.mp3', title='New')) == first
+    assert store.record(store.id_of('/music/a/one.mp3'))['title'] == 'New'
+    assert len(store) == 2
+
+    assert store.remove('/music/a/two.mp3') == second
+    assert store.remove('/music/a/two.mp3') is None
+    assert store.add(track('/music/b/three.mp3')) == second
+    assert not store.free
+    assert sorted(store.path(i) for i in store.ids()) == [
+        '/music/a/one.mp3', '/music/b/three.mp3']
+
+
+def test_missing_duration():
+    store = TrackStore()
+    track_id = store.add(track('/music/one.mp3', duration=None))
+    assert store.record(track_id)['duration'] is None
+    store.set_duration('/music/one.mp3', 12.5)
+    store.set_duration('/music/unknown.mp3', 12.5)
+    assert store.record(track_id)['duration'] == 12.5
+
+
+def test_paths_under():
+    store = TrackStore()
+    for path in ('/music/a/one.mp3', '/music/a/deep/two.mp3',
+                 '/music/ab/three.mp3', '/music/four.mp3'):
+        store.add(track(path))
+    assert sorted(store.paths_under('/music/a')) == [
+        '/music/a/deep/two.mp3', '/music/a/one.mp3']
+    assert sorted(store.paths_under('/music/a/')) == [
+        '/music/a/deep/two.mp3', '/music/a/one.mp3']
+    assert len(store.paths_under('/music')) == 4
+
+
+def test_views():
+    store = TrackStore()
+    one = store.add(track('/music/one.mp3', artist='Artist'))
+    two = store.add(track('/music/two.mp3', artist='Artist'))
+
+    records = RecordView(store)
+    assert sorted(records) == ['/music/one.mp3', '/music/two.mp3']
+    assert records['/music/one.mp3']['artist'] == 'Artist'
+    assert '/music/three.mp3' not in records
+    assert records.get('/music/three.mp3') is None
+
+    titles = PathView({'one.mp3': one}, store)
+    assert dict(titles) == {'one.mp3': '/music/one.mp3'}
+    artists = PathListView({'Artist': [one, two]}, store)
+    assert artists['Artist'] == ['/music/one.mp3', '/music/two.mp3']
+    assert len(artists) == 1
+
+
+def test_memory_report():
+    store = TrackStore()
+    store.add(track('/music/one.mp3'))
+    report = store.memory_report()
+    assert set(report) == {'folders', 'strings', 'file names', 'titles',
+                           'columns', 'path lookup'}
+    assert all(size > 0 for size in report.values())
+
+
+def test_copy_shares_nothing():
+    store = TrackStore()
+    store.add(track('/music/one.mp3', artist='Artist'))
+    copy = store.copy()
+    store.add(track('/music/two.mp3', artist='Other'))
+    store.remove('/music/one.mp3')
+    assert sorted(RecordView(copy)) == ['/music/one.mp3']
+    assert copy.record(copy.id_of('/music/one.mp3'))['artist'] == 'Artist'
+    assert len(copy) == 1
+
+
+def test_version_counts_changes():
+    store = TrackStore()
+    versions = [store.version]
+    store.add(track('/music/one.mp3'))
+    versions.append(store.version)
+    store.remove('/music/unknown.mp3')
+    assert store.version == versions[-1]
+    store.remove('/music/one.mp3')
+    versions.append(store.version)
+    store.clear()
+    versions.append(store.version)
+    assert len(set(versions)) == 4
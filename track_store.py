@@ -0,0 +1,274 @@
+import os
+import sys
+from array import array
+from collections.abc import Mapping
+
+
+# Tag fields with few distinct values, stored as ids into a string table
+INTERNED_FIELDS = ('artist', 'album', 'albumartist', 'genre', 'year',
+                   'track')
+
+
+class StringTable:
+    """Stores each distinct string once and refers to it by a small int.
+    Id 0 is None."""
+    def __init__(self):
+        self.strings = [None]
+        self.ids = {None: 0}
+
+    def __len__(self):
+        return len(self.strings)
+
+    def intern(self, string):
+        string_id = self.ids.get(string)
+        if string_id is None:
+            string_id = len(self.strings)
+            self.strings.append(string)
+            self.ids[string] = string_id
+        return string_id
+
+    def get(self, string_id):
+        return self.strings[string_id]
+
+    def copy(self):
+        table = StringTable()
+        table.strings = list(self.strings)
+        table.ids = dict(self.ids)
+        return table
+
+
+class TrackStore:
+    """Column-oriented storage for the tracks of a large library.
+
+    Every track gets an integer id. Its folder is stored once per folder,
+    repeated tag values (artist, album, genre...) once per distinct value,
+    and numbers in typed arrays, instead of a dict and a full path string
+    per track. Ids of removed tracks are reused.
+    """
+    def __init__(self):
+        self.version = 0  # changes whenever tracks are added or removed
+        self.clear()
+
+    def clear(self):
+        self.version += 1
+        self.folders = StringTable()
+        self.strings = StringTable()
+        self.folder = array('I')
+        self.filename = []  # None marks a free slot
+        self.title = []
+        self.tags = {field: array('I') for field in INTERNED_FIELDS}
+        self.duration = array('d')
+        self.size = array('q')
+        self.mtime = array('d')
+        self.by_folder = {}  # folder id -> {filename: track id}
+        self.free = []
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, path):
+        return self.id_of(path) is not None
+
+    def id_of(self, path):
+        folder, filename = os.path.split(path)
+        folder_id = self.folders.ids.get(folder)
+        if folder_id is None:
+            return None
+        return self.by_folder.get(folder_id, {}).get(filename)
+
+    def add(self, track):
+        """Store a track dict (see SongDatabase.read_track), replacing any
+        track with the same path.
+        Returns: the track's id"""
+        self.remove(track['path'])
+        folder, filename = os.path.split(track['path'])
+        folder_id = self.folders.intern(folder)
+        values = (folder_id, filename, track['title'],
+                  [self.strings.intern(None if track[field] is None
+                                       else str(track[field]))
+                   for field in INTERNED_FIELDS],
+                  track['duration'] or 0.0, track['size'] or 0,
+                  track['mtime'] or 0.0)
+
+        if self.free:
+            track_id = self.free.pop()
+            self._set(track_id, values)
+        else:
+            track_id = len(self.filename)
+            self._append(values)
+        self.by_folder.setdefault(folder_id, {})[filename] = track_id
+        self.count += 1
+        self.version += 1
+        return track_id
+
+    def _append(self, values):
+        folder_id, filename, title, tag_ids, duration, size, mtime = values
+        self.folder.append(folder_id)
+        self.filename.append(filename)
+        self.title.append(title)
+        for field, tag_id in zip(INTERNED_FIELDS, tag_ids):
+            self.tags[field].append(tag_id)
+        self.duration.append(duration)
+        self.size.append(size)
+        self.mtime.append(mtime)
+
+    def _set(self, track_id, values):
+        folder_id, filename, title, tag_ids, duration, size, mtime = values
+        self.folder[track_id] = folder_id
+        self.filename[track_id] = filename
+        self.title[track_id] = title
+        for field, tag_id in zip(INTERNED_FIELDS, tag_ids):
+            self.tags[field][track_id] = tag_id
+        self.duration[track_id] = duration
+        self.size[track_id] = size
+        self.mtime[track_id] = mtime
+
+    def remove(self, path):
+        """Returns: the removed track's id, or None if it wasn't stored"""
+        track_id = self.id_of(path)
+        if track_id is None:
+            return None
+        files = self.by_folder[self.folder[track_id]]
+        del files[self.filename[track_id]]
+        if not files:
+            del self.by_folder[self.folder[track_id]]
+        self.filename[track_id] = None
+        self.title[track_id] = None
+        self.free.append(track_id)
+        self.count -= 1
+        self.version += 1
+        return track_id
+
+    def copy(self):
+        """Returns: a TrackStore with the same tracks, sharing nothing
+        with this one"""
+        store = TrackStore()
+        store.folders = self.folders.copy()
+        store.strings = self.strings.copy()
+        store.folder = array('I', self.folder)
+        store.filename = list(self.filename)
+        store.title = list(self.title)
+        store.tags = {field: array('I', ids)
+                      for field, ids in self.tags.items()}
+        store.duration = array('d', self.duration)
+        store.size = array('q', self.size)
+        store.mtime = array('d', self.mtime)
+        store.by_folder = {folder_id: dict(files)
+                           for folder_id, files in self.by_folder.items()}
+        store.free = list(self.free)
+        store.count = self.count
+        store.version = self.version
+        return store
+
+    def set_duration(self, path, duration):
+        """Fill in the duration of a stored track, read after its tags"""
+        track_id = self.id_of(path)
+        if track_id is not None:
+            self.duration[track_id] = duration or 0.0
+
+    def path(self, track_id):
+        return os.path.join(self.folders.get(self.folder[track_id]),
+                            self.filename[track_id])
+
+    def record(self, track_id):
+        """Returns: the track as a dict, like SongDatabase.read_track"""
+        record = {'path': self.path(track_id),
+                  'title': self.title[track_id],
+                  'duration': self.duration[track_id] or None,
+                  'size': self.size[track_id],
+                  'mtime': self.mtime[track_id]}
+        for field in INTERNED_FIELDS:
+            record[field] = self.strings.get(self.tags[field][track_id])
+        return record
+
+    def ids(self):
+        """Returns: generator over the ids of all stored tracks"""
+        for files in self.by_folder.values():
+            yield from files.values()
+
+    def paths_under(self, folder):
+        """Returns: list of the paths of all tracks in 'folder' or below,
+        found by looking at each folder once rather than at every track"""
+        folder = folder.rstrip(os.sep) or os.sep
+        prefix = folder.rstrip(os.sep) + os.sep
+        paths = []
+        for folder_id, files in self.by_folder.items():
+            name = self.folders.get(folder_id)
+            if name == folder or name.startswith(prefix):
+                paths.extend(os.path.join(name, filename)
+                             for filename in files)
+        return paths
+
+    def memory_report(self):
+        """Returns: dict of approximate bytes used per part of the store"""
+        return {
+            'folders': table_size(self.folders),
+            'strings': table_size(self.strings),
+            'file names': container_size(self.filename),
+            'titles': container_size(self.title),
+            'columns': sum(sys.getsizeof(column) for column in
+                           [self.folder, self.duration, self.size,
+                            self.mtime] + list(self.tags.values())),
+            'path lookup': sys.getsizeof(self.by_folder) + sum(
+                sys.getsizeof(files) for files in self.by_folder.values()),
+        }
+
+
+def container_size(strings):
+    """Bytes used by a list of strings, including the strings"""
+    return sys.getsizeof(strings) + sum(sys.getsizeof(string)
+                                        for string in strings
+                                        if string is not None)
+
+
+def table_size(table):
+    return container_size(table.strings) + sys.getsizeof(table.ids)
+
+
+class RecordView(Mapping):
+    """Read-only file path -> track dict view of a TrackStore."""
+    def __init__(self, store):
+        self.store = store
+
+    def __getitem__(self, path):
+        track_id = self.store.id_of(path)
+        if track_id is None:
+            raise KeyError(path)
+        return self.store.record(track_id)
+
+    def __contains__(self, path):
+        return self.store.id_of(path) is not None
+
+    def __iter__(self):
+        return (self.store.path(track_id) for track_id in self.store.ids())
+
+    def __len__(self):
+        return len(self.store)
+
+
+class PathView(Mapping):
+    """Read-only name -> file path view of a dict of name -> track id,
+    like the old title -> path 'tracks' dict."""
+    def __init__(self, ids, store):
+        self.ids = ids
+        self.store = store
+
+    def __getitem__(self, name):
+        return self.store.path(self.ids[name])
+
+    def __contains__(self, name):
+        return name in self.ids
+
+    def __iter__(self):
+        return iter(self.ids)
+
+    def __len__(self):
+        return len(self.ids)
+
+
+class PathListView(PathView):
+    """Read-only name -> list of file paths view of a dict of
+    name -> array of track ids, like the old 'artists' dict."""
+    def __getitem__(self, name):
+        return [self.store.path(track_id) for track_id in self.ids[name]]